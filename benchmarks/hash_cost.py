@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+#
+# Cork password hashing benchmark and cost calibration
+#
+# Times Cork._hash and Cork._verify_password on this machine for each
+# supported hashing scheme over a range of costs, reports the latency and
+# the logins per second a single core can sustain, and recommends for each
+# scheme the highest cost meeting a target login latency.
+#
+# Usage: python benchmarks/hash_cost.py [--target-ms MS] [--runs N]
+#                                       [--schemes NAME [NAME ...]]
+#
+# Logins are dominated by the password verification: one core serves about
+# 1000 / verify p50 (ms) logins per second.
+
+from argparse import ArgumentParser
+from timeit import default_timer
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cork import Cork, MemoryBackend
+from cork import hashing
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def measure(hasher, runs):
+    """Time hashing and verification with a hasher
+
+    :returns: (hash timings, verify timings) in seconds
+    """
+    aaa = Cork(backend=MemoryBackend(), password_hasher=hasher)
+    hash_times, verify_times = [], []
+    for i in range(runs):
+        t = default_timer()
+        h = aaa._hash('user%d' % i, 'correct horse battery staple')
+        hash_times.append(default_timer() - t)
+        t = default_timer()
+        assert aaa._verify_password('user%d' % i,
+                                    'correct horse battery staple', h)
+        verify_times.append(default_timer() - t)
+    return hash_times, verify_times
+
+
+def pbkdf2_candidates(target):
+    """Iteration counts around the one meeting the target, extrapolated
+    from a quick probe: PBKDF2 time is linear in the iterations"""
+    probe = 20000
+    elapsed = min(measure(hashing.PBKDF2Hasher(probe), 3)[1])
+    best = int(probe * target / elapsed) // 10000 * 10000 or 10000
+    return [hashing.PBKDF2Hasher(i) for i in
+            sorted(set([100000, 300000, 600000, best // 2, best]))]
+
+
+def scrypt_candidates(target):
+    return [hashing.ScryptHasher(n=2 ** e) for e in range(13, 18)]
+
+
+def argon2_candidates(target):
+    return [hashing.Argon2Hasher(time_cost=t) for t in (1, 2, 3, 4, 6)]
+
+
+candidates = {
+    'pbkdf2-sha256': pbkdf2_candidates,
+    'scrypt': scrypt_candidates,
+    'argon2id': argon2_candidates,
+}
+
+
+def describe(hasher):
+    if isinstance(hasher, hashing.PBKDF2Hasher):
+        return "PBKDF2Hasher(iterations=%d)" % hasher.iterations
+    if isinstance(hasher, hashing.ScryptHasher):
+        return "ScryptHasher(n=2 ** %d, r=%d, p=%d)" % (
+            hasher.n.bit_length() - 1, hasher.r, hasher.p)
+    params = hasher._hasher
+    return "Argon2Hasher(time_cost=%d, memory_cost=%d, parallelism=%d)" % (
+        params.time_cost, params.memory_cost, params.parallelism)
+
+
+def main():
+    parser = ArgumentParser(description="Cork password hashing benchmark")
+    parser.add_argument('--target-ms', type=float, default=50.0,
+                        help="target login latency (p50)")
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--schemes', nargs='+', default=sorted(candidates),
+                        choices=sorted(candidates))
+    args = parser.parse_args()
+    target = args.target_ms / 1000.0
+
+    recommended = {}
+    skipped = []
+    print("%-44s %9s %11s %11s %14s" % ("hasher", "hash p50", "verify p50",
+                                        "verify p95", "logins/s/core"))
+    for scheme in args.schemes:
+        try:
+            hashers = candidates[scheme](target)
+        except RuntimeError as e:
+            print("%s: skipped, %s" % (scheme, e))
+            skipped.append(scheme)
+            continue
+        for hasher in hashers:
+            hash_times, verify_times = measure(hasher, args.runs)
+            p50 = percentile(verify_times, 50)
+            print("%-44s %7.1fms %9.1fms %9.1fms %14.1f" % (describe(hasher),
+                percentile(hash_times, 50) * 1000, p50 * 1000,
+                percentile(verify_times, 95) * 1000, 1 / p50))
+            if p50 <= target:
+                recommended[scheme] = hasher
+
+    print("\nhighest costs with a login p50 under %.0f ms:" % args.target_ms)
+    for scheme in args.schemes:
+        if scheme in skipped:
+            continue
+        if scheme in recommended:
+            print("  Cork(password_hasher=hashing.%s)"
+                  % describe(recommended[scheme]))
+        else:
+            print("  %s: no tested cost meets the target" % scheme)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
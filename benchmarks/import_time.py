@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+#
+# Cork import time benchmark
+#
+# Runs `python -X importtime -c "import cork"` in fresh interpreters and
+# reports the cumulative import time of the cork package, with the slowest
+# modules it pulls in.
+#
+# Usage: python benchmarks/import_time.py [--runs N] [--top N] [--max-ms MS]
+#
+# With --max-ms the exit status is 1 when the median import time exceeds the
+# budget, so the benchmark can be tracked by CI.
+
+from argparse import ArgumentParser
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(module='cork'):
+    """Import `module` in a fresh interpreter
+
+    :returns: {module name: (self us, cumulative us)} dict
+    """
+    env = dict(os.environ, PYTHONPATH=ROOT, PYTHONDONTWRITEBYTECODE='1')
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                           'import %s' % module],
+                          env=env, stderr=subprocess.PIPE, check=True,
+                          universal_newlines=True)
+    timings = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+    return timings
+
+
+def main():
+    parser = ArgumentParser(description="Cork import time benchmark")
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--max-ms', type=float, default=None)
+    args = parser.parse_args()
+
+    # the first run warms up the bytecode and filesystem caches
+    measure()
+    runs = [measure() for i in range(args.runs)]
+    totals = sorted(r['cork'][1] for r in runs)
+    median_ms = totals[len(totals) // 2] / 1000.0
+    print("import cork: median %.1f ms, min %.1f ms, max %.1f ms (%d runs)"
+          % (median_ms, totals[0] / 1000.0, totals[-1] / 1000.0, args.runs))
+
+    last = runs[-1]
+    print("slowest modules (cumulative, last run):")
+    slowest = sorted(last.items(), key=lambda i: i[1][1], reverse=True)
+    for name, (self_us, cumulative_us) in slowest[:args.top]:
+        print("  %8.1f ms  %s" % (cumulative_us / 1000.0, name))
+
+    if args.max_ms is not None and median_ms > args.max_ms:
+        print("import time over budget: %.1f ms > %.1f ms"
+              % (median_ms, args.max_ms))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1 +1,31 @@
 from .cork import Cork, AAAException, AuthException, Mailer
+from .base_backend import (Backend, BackendIOException, Table,
+    ConcurrentUpdateException)
+from .memory_backend import MemoryBackend
+from .hashing import HashingBusyException
+
+# imported on first access, keeping `import cork` fast
+_lazy_exports = {
+    'CouchbaseBackend': 'couchbase_backend',
+    'SqliteBackend': 'sqlite_backend',
+    'AsyncBackend': 'async_backend',
+    'AsyncTable': 'async_backend',
+    'ThreadedAsyncBackend': 'async_backend',
+    'AsyncCouchbaseBackend': 'acouchbase_backend',
+    'AsyncCork': 'aiocork',
+    'CorkPlugin': 'plugin',
+}
+
+
+def __getattr__(name):
+    module = _lazy_exports.get(name)
+    if module is None:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    from importlib import import_module
+    value = getattr(import_module('.' + module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_lazy_exports))
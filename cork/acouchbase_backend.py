@@ -0,0 +1,337 @@
+# Cork - Authentication module for the Bottle web framework
+# Copyright (C) 2012 Federico Ceratto
+#
+# This package is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This package is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Couchbase storage backend for asyncio, based on acouchbase
+#
+# Documents, counters and views are shared with couchbase_backend: both
+# backends can serve the same bucket.
+
+from logging import getLogger
+import asyncio
+import os
+
+from .async_backend import AsyncBackend, AsyncTable
+from .base_backend import (ConcurrentUpdateException, apply_mutations,
+    matches)
+from .couchbase_backend import (COUCHBASE_ENTRY_DESIGN_DOC,
+    COUCHBASE_ENTRY_VIEW, COUCHBASE_MAX_SUBDOC_SPECS, _CouchbaseNames,
+    _translate_errors)
+
+log = getLogger(__name__)
+
+_MISSING = object()
+
+
+class AsyncCouchbaseTable(_CouchbaseNames, AsyncTable):
+
+    def __init__(self, backend, table_name, page_size=100, cas_retries=10,
+            expiring=False):
+        """Table of couchbase entries, accessed through acouchbase.
+        Expiring tables keep no entry counter, see
+        :class:`cork.couchbase_backend.CouchbaseTable`
+
+        :param backend: the owning backend, providing the bucket
+        :type backend: AsyncCouchbaseBackend
+        :param table_name: the name (aka prefix) of the table entries
+        :type table_name: str.
+        :param page_size: number of entries fetched per round trip when
+            iterating over the table
+        :type page_size: int.
+        :param cas_retries: number of attempts of a compare-and-swap write
+            before giving up on conflicts
+        :type cas_retries: int.
+        :param expiring: support entry expiry
+        :type expiring: bool.
+        """
+        self._backend = backend
+        self.table_name = table_name
+        self.page_size = page_size
+        self.cas_retries = cas_retries
+        self.expiring = expiring
+
+    async def _collection(self):
+        bucket = await self._backend.connect()
+        return bucket.default_collection()
+
+    async def contains(self, item):
+        client = await self._collection()
+        with _translate_errors(item):
+            result = await client.exists(self._get_entry_key(item))
+        return result.exists
+
+    async def get(self, item, default=None):
+        client = await self._collection()
+        try:
+            with _translate_errors(item):
+                result = await client.get(self._get_entry_key(item))
+        except KeyError:
+            return default
+        return result.content_as[dict]
+
+    async def get_many(self, items):
+        """Fetch multiple entries with concurrent gets"""
+        items = list(set(items))
+        entries = await asyncio.gather(*[self.get(i, _MISSING)
+                                         for i in items])
+        return dict((i, e) for i, e in zip(items, entries)
+                    if e is not _MISSING)
+
+    async def set(self, key, value):
+        from couchbase.exceptions import DocumentNotFoundException
+        client = await self._collection()
+        entry_key = self._get_entry_key(key)
+        with _translate_errors(key):
+            try:
+                await client.replace(entry_key, value)
+            except DocumentNotFoundException:
+                if not await self.insert(key, value):
+                    # inserted concurrently
+                    await client.replace(entry_key, value)
+
+    async def insert(self, key, value, ttl=None):
+        from couchbase.exceptions import DocumentExistsException
+        client = await self._collection()
+        with _translate_errors(key):
+            try:
+                await client.insert(self._get_entry_key(key), value,
+                                    *self._insert_options(ttl))
+            except DocumentExistsException:
+                return False
+        await self._update_count(1)
+        return True
+
+    async def delete(self, item):
+        client = await self._collection()
+        try:
+            with _translate_errors(item):
+                await client.remove(self._get_entry_key(item))
+        except KeyError:
+            return
+        await self._update_count(-1)
+
+    async def pop(self, item):
+        from couchbase.exceptions import CasMismatchException
+        from couchbase.options import RemoveOptions
+        client = await self._collection()
+        entry_key = self._get_entry_key(item)
+        for attempt in range(self.cas_retries):
+            with _translate_errors(item):
+                result = await client.get(entry_key)
+                try:
+                    # only remove the version being returned
+                    await client.remove(entry_key,
+                                        RemoveOptions(cas=result.cas))
+                except CasMismatchException:
+                    continue
+            await self._update_count(-1)
+            return result.content_as[dict]
+        raise ConcurrentUpdateException("Too many concurrent updates on %r"
+                                        % item)
+
+    async def mutate(self, item, upsert=None, remove=(), expect=None,
+            increment=None):
+        """Change some fields of an entry using sub-document operations,
+        see :meth:`cork.couchbase_backend.CouchbaseTable.mutate`
+        """
+        import couchbase.subdocument as SD
+        from couchbase.exceptions import CasMismatchException
+        from couchbase.options import MutateInOptions
+        upsert = upsert or {}
+        increment = increment or {}
+        if expect or len(upsert) + len(remove) + len(increment) > \
+                COUCHBASE_MAX_SUBDOC_SPECS:
+            return await self._replace_mutated(item, upsert, remove, expect,
+                                               increment)
+        client = await self._collection()
+        entry_key = self._get_entry_key(item)
+        upserts = [SD.upsert(self._get_subdoc_path(path), value,
+                             create_parents=True)
+                   for path, value in upsert.items()]
+        upserts += [SD.counter(self._get_subdoc_path(path), delta,
+                               create_parents=True)
+                    for path, delta in increment.items()]
+        remove = [self._get_subdoc_path(path) for path in remove]
+        if not remove:
+            with _translate_errors(item):
+                await client.mutate_in(entry_key, upserts)
+            return True
+
+        for attempt in range(self.cas_retries):
+            with _translate_errors(item):
+                found = await client.lookup_in(entry_key,
+                    [SD.exists(p) for p in remove])
+                specs = upserts + [SD.remove(p) for n, p in enumerate(remove)
+                                   if found.exists(n)]
+                if not specs:
+                    return True
+                try:
+                    await client.mutate_in(entry_key, specs,
+                                           MutateInOptions(cas=found.cas))
+                except CasMismatchException:
+                    continue
+            return True
+        raise ConcurrentUpdateException("Too many concurrent updates on %r"
+                                        % item)
+
+    async def _replace_mutated(self, item, upsert, remove, expect=None,
+            increment=None):
+        """Replace the whole document, see
+        :meth:`cork.couchbase_backend.CouchbaseTable._replace_mutated`
+        """
+        from couchbase.exceptions import CasMismatchException
+        from couchbase.options import ReplaceOptions
+        client = await self._collection()
+        entry_key = self._get_entry_key(item)
+        for attempt in range(self.cas_retries):
+            with _translate_errors(item):
+                result = await client.get(entry_key)
+                entry = result.content_as[dict]
+                if not matches(entry, expect):
+                    return False
+                apply_mutations(entry, upsert, remove, increment)
+                try:
+                    await client.replace(entry_key, entry,
+                                         ReplaceOptions(cas=result.cas))
+                except CasMismatchException:
+                    continue
+            return True
+        raise ConcurrentUpdateException("Too many concurrent updates on %r"
+                                        % item)
+
+    async def _update_count(self, delta):
+        """Atomically add `delta` to the entry counter, see
+        :meth:`cork.couchbase_backend.CouchbaseTable._update_count`
+        """
+        if self.expiring:
+            return
+        from couchbase.exceptions import CouchbaseException
+        from couchbase.options import (DecrementOptions, DeltaValue,
+            IncrementOptions, SignedInt64)
+        binary = (await self._collection()).binary()
+        try:
+            if delta > 0:
+                await binary.increment(self._get_counter_key(),
+                    IncrementOptions(delta=DeltaValue(delta),
+                                     initial=SignedInt64(-1)))
+            else:
+                await binary.decrement(self._get_counter_key(),
+                    DecrementOptions(delta=DeltaValue(-delta),
+                                     initial=SignedInt64(-1)))
+        except CouchbaseException as e:
+            log.debug("Unable to update the %s counter: %s",
+                      self.table_name, e)
+
+    async def reconcile_count(self):
+        """Recount the table entries from the view and store the result in
+        the counter document
+
+        :returns: number of entries
+        """
+        count = 0
+        async for name in self.names():
+            count += 1
+        if self.expiring:
+            return count
+        client = await self._collection()
+        with _translate_errors():
+            await client.upsert(self._get_counter_key(), count)
+        return count
+
+    async def range(self, start_after=None, limit=None, skip=0,
+            descending=False, prefix=None):
+        """List entry names in order, see
+        :meth:`cork.couchbase_backend.CouchbaseTable.range`
+        """
+        bucket = await self._backend.connect()
+        opts = self._view_options(start_after, limit, skip, descending, prefix)
+        with _translate_errors():
+            result = bucket.view_query(COUCHBASE_ENTRY_DESIGN_DOC,
+                COUCHBASE_ENTRY_VIEW, opts)
+            names = [self._get_item_name(r.id) async for r in result]
+        return self._trim_page(names, start_after, limit, skip)
+
+    async def count(self):
+        if self.expiring:
+            return await self.reconcile_count()
+        client = await self._collection()
+        try:
+            with _translate_errors():
+                result = await client.get(self._get_counter_key())
+        except KeyError:
+            return await self.reconcile_count()
+        return result.content_as[int]
+
+
+class AsyncCouchbaseBackend(AsyncBackend):
+
+    def __init__(self, db_host='localhost', db_password='', db_bucket='default',
+            users_table_name='User', roles_table_name='Role',
+            pending_reg_table_name='Register', page_size=100,
+            email_index_table_name='Email',
+            company_index_table_name='UserByCompany',
+            role_index_table_name='UserByRole', meta_table_name='Meta'):
+        """Data storage class for asyncio code. The cluster connection is
+        opened by the first request, or by :meth:`connect`, on the running
+        event loop. A forked process opens its own connection.
+        Parameters as in :class:`cork.couchbase_backend.CouchbaseBackend`
+        """
+        self._conf = (db_host, db_password, db_bucket)
+        self._cluster = None
+        self._bucket = None
+        self._pid = None
+        self._lock = asyncio.Lock()
+        self.users = AsyncCouchbaseTable(self, users_table_name, page_size)
+        self.roles = AsyncCouchbaseTable(self, roles_table_name, page_size)
+        self.pending_registrations = AsyncCouchbaseTable(self,
+            pending_reg_table_name, page_size, expiring=True)
+        self.emails = AsyncCouchbaseTable(self, email_index_table_name,
+            page_size)
+        self.company_members = AsyncCouchbaseTable(self,
+            company_index_table_name, page_size)
+        self.role_members = AsyncCouchbaseTable(self, role_index_table_name,
+            page_size)
+        self.meta = AsyncCouchbaseTable(self, meta_table_name, page_size)
+
+    async def connect(self):
+        """Connect to the cluster, if needed
+
+        :returns: acouchbase Bucket
+        """
+        if self._bucket is not None and self._pid == os.getpid():
+            return self._bucket
+        async with self._lock:
+            if self._bucket is None or self._pid != os.getpid():
+                from acouchbase.cluster import Cluster
+                from couchbase.auth import PasswordAuthenticator
+                from couchbase.options import ClusterOptions
+                db_host, db_password, db_bucket = self._conf
+                with _translate_errors():
+                    cluster = await Cluster.connect(
+                        'couchbase://{0}'.format(db_host),
+                        ClusterOptions(PasswordAuthenticator(db_bucket,
+                                                             db_password)))
+                    bucket = cluster.bucket(db_bucket)
+                    await bucket.on_connect()
+                self._cluster = cluster
+                self._bucket = bucket
+                self._pid = os.getpid()
+        return self._bucket
+
+    async def close(self):
+        if self._cluster is not None:
+            await self._cluster.close()
+        self._cluster = None
+        self._bucket = None
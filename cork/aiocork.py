@@ -0,0 +1,746 @@
+# Cork - Authentication module for the Bottle web framework
+# Copyright (C) 2012 Federico Ceratto
+#
+# This package is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This package is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Asyncio variant of Cork, for ASGI applications
+#
+# The session and the per-request cache are carried by context variables:
+# the application sets them up for each request with
+# AsyncCork.request_context(). Storage calls go through an async backend and
+# password hashing runs in an executor, keeping the event loop free.
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import partial
+import asyncio
+
+from .async_backend import AsyncBackend, ThreadedAsyncBackend
+from .acouchbase_backend import AsyncCouchbaseBackend
+from .roles import ROLES_VERSION_KEY, RoleTable, new_version
+from . import hashing
+from .cork import AAAException, AuthException, BaseCork, BaseUser
+
+# session of the current request: a dict-like object
+_session = ContextVar('cork_session', default=None)
+# per-request lookup cache
+_request_cache = ContextVar('cork_request_cache', default=None)
+
+
+class AsyncCork(BaseCork):
+
+    def __init__(self, email_sender=None, db_host='localhost', db_password='',
+        db_bucket='default', users_table_name='User', roles_table_name='Role',
+        pending_reg_table_name='Register', smtp_url='localhost',
+        email_index_table_name='Email', company_index_table_name='UserByCompany',
+        role_index_table_name='UserByRole', backend=None, hash_executor=None,
+        password_hasher=None, hash_concurrency=None, hash_queue_timeout=10,
+        secret_keys=None, stateless_registration=False,
+        roles_refresh_interval=10):
+        """Auth/Authorization/Accounting class for asyncio applications.
+        Methods mirror :class:`cork.Cork` as coroutines. Failures are
+        reported by raising AAAException or AuthException: redirecting is up
+        to the application.
+
+        :param backend: storage backend instance (optional). Synchronous
+            backends are wrapped in a ThreadedAsyncBackend. If unset, an
+            AsyncCouchbaseBackend is created.
+        :type backend: cork.async_backend.AsyncBackend or
+            cork.base_backend.Backend
+        :param hash_executor: concurrent.futures executor running password
+            hashing, None for the event loop default one
+        :param hash_concurrency: maximum number of password hashes computed
+            at the same time, None for no limit. See
+            :class:`cork.hashing.HashingPool` for the cost of a hash.
+        :type hash_concurrency: int.
+        :param hash_queue_timeout: time a request waits for a free hashing
+            slot before failing with HashingBusyException (seconds)
+        :type hash_queue_timeout: float.
+
+        The other parameters are described in :class:`cork.Cork`
+        """
+        super(AsyncCork, self).__init__(email_sender, smtp_url,
+            password_hasher, secret_keys, stateless_registration,
+            roles_refresh_interval)
+        if backend is None:
+            backend = AsyncCouchbaseBackend(db_host, db_password, db_bucket,
+                users_table_name, roles_table_name, pending_reg_table_name,
+                email_index_table_name=email_index_table_name,
+                company_index_table_name=company_index_table_name,
+                role_index_table_name=role_index_table_name)
+        elif not isinstance(backend, AsyncBackend):
+            backend = ThreadedAsyncBackend(backend)
+        self._store = backend
+        self._hash_executor = hash_executor
+        self._hash_concurrency = hash_concurrency
+        # created in the event loop running the requests
+        self._hash_slots = None
+        self._hash_slots_loop = None
+        self._hash_queue_timeout = hash_queue_timeout
+
+    @contextmanager
+    def request_context(self, session):
+        """Bind a session to the current request, e.g. from an ASGI
+        middleware::
+
+            with aaa.request_context(request.session):
+                response = await call_next(request)
+
+        :param session: session of the current request
+        :type session: dict-like
+        """
+        session_token = _session.set(session)
+        cache_token = _request_cache.set({})
+        try:
+            yield
+        finally:
+            _request_cache.reset(cache_token)
+            _session.reset(session_token)
+
+    async def login(self, username, password):
+        """Check login credentials for an existing user and store the
+        username in the session.
+
+        :param username: username
+        :type username: str.
+        :param password: cleartext password
+        :type password: str.
+        :returns: True for successful logins, else False
+        """
+        assert isinstance(username, str), "the username must be a string"
+        assert isinstance(password, str), "the password must be a string"
+
+        user_data = await self._store.users.get(username)
+        if user_data is None:
+            return False
+        if not await self._verify_password(username, password,
+                                           user_data['hash']):
+            return False
+        if self.password_hasher.needs_rehash(user_data['hash']):
+            try:
+                await self._store.users.mutate(username, upsert={
+                    ('hash',): await self._hash(username, password)})
+            except KeyError:  # deleted in the meantime
+                pass
+        session = self._session
+        session['username'] = username
+        return True
+
+    async def logout(self):
+        """Log the user out, clearing the session
+
+        :raises: AuthException if no session is available
+        """
+        session = _session.get()
+        if session is None:
+            raise AuthException("No session available")
+        session.clear()
+        self._cache.clear()
+
+    async def require(self, username=None, company=None, role=None,
+        fixed_role=False):
+        """Ensure the user is logged in has the required role (or higher).
+        See :meth:`cork.Cork.require`
+
+        :raises: AuthException for unauthorized users, AAAException on
+            invalid parameters
+        """
+        if username is not None:
+            if not await self._store.users.contains(username):
+                raise AAAException("Nonexistent user")
+
+        self._check_requirement(fixed_role, role)
+
+        threshold_lvl = None
+        if role is not None:
+            role_info = await self._get_role(role)
+            if role_info is None:
+                raise AAAException("Role not found")
+            threshold_lvl = role_info["level"]
+
+        try:
+            cu = await self.current_user()
+        except AAAException:
+            raise AuthException("Unauthenticated user")
+
+        denial = self._access_denial(cu, username, company, role, fixed_role,
+                                     threshold_lvl)
+        if denial is not None:
+            raise AuthException(denial)
+
+    async def create_role(self, role, level):
+        """Create a new role.
+
+        :param role: role name
+        :type role: str.
+        :param level: role level (0=lowest, 100=admin)
+        :type level: int.
+        :raises: AuthException on errors
+        """
+        if (await self.current_user()).level < 100:
+            raise AuthException("The current user is not authorized to ")
+        try:
+            int(level)
+        except ValueError:
+            raise AAAException("The level must be numeric.")
+        if not await self._store.roles.insert(role, {"level": level}):
+            raise AAAException("The role is already existing")
+        await self._roles_changed()
+
+    async def delete_role(self, role):
+        """Delete a role.
+
+        :param role: role name
+        :type role: str.
+        :raises: AuthException on errors
+        """
+        if (await self.current_user()).level < 100:
+            raise AuthException("The current user is not authorized to ")
+        if not await self._store.roles.contains(role):
+            raise AAAException("Nonexistent role.")
+        if await self._store.role_members.range(
+                prefix=self._member_prefix(role), limit=1):
+            raise AAAException("The role is still assigned to some users.")
+        await self._store.roles.pop(role)
+        await self._roles_changed()
+
+    async def list_roles(self):
+        """List roles.
+
+        :returns: (role, role_level) async generator (sorted by role)
+        """
+        for role, level in (await self._roles()).items():
+            yield (role, level)
+
+    async def create_user(self, username, role, password, company,
+        email_addr=None, permissions={}):
+        """Create a new user account.
+        This method is available to users with level>=100
+
+        :raises: AuthException on errors
+        """
+        assert username, "Username must be provided."
+        assert company, "Company must be provided."
+        assert isinstance(permissions, dict), "Permissions must be a dictionary"
+        if (await self.current_user()).level < 100:
+            raise AuthException("The current user is not authorized to ")
+        if await self._store.users.contains(username):
+            raise AAAException("User is already existing.")
+        if await self._get_role(role) is None:
+            raise AAAException("Nonexistent user role.")
+        user_data = self._user_data(role, await self._hash(username, password),
+                                    email_addr, company, permissions)
+        if not await self._store.users.insert(username, user_data):
+            raise AAAException("User is already existing.")
+        await self._index_user(username, user_data)
+
+    async def delete_user(self, username):
+        """Delete a user account.
+        This method is available to users with level>=100
+
+        :raises: Exceptions on errors
+        """
+        if (await self.current_user()).level < 100:
+            raise AuthException("The current user is not authorized to ")
+        user = await self.user(username)
+        if user is None:
+            raise AAAException("Nonexistent user.")
+        await user.delete()
+
+    def list_users(self, offset=0, limit=None, cursor=None, order='asc',
+        page_size=100):
+        """List users, fetching them one page at a time.
+        See :meth:`cork.Cork.list_users`
+
+        :return: (username, validated, role, email_addr, company, permissions)
+            async generator (sorted by username)
+        """
+        if order not in ('asc', 'desc'):
+            raise AAAException("The order must be 'asc' or 'desc'.")
+        return self._list_indexed_users(self._store.users, '', cursor, limit,
+            page_size, offset=offset, descending=(order == 'desc'))
+
+    async def current_user(self):
+        """Current autenticated user
+
+        :returns: AsyncUser() instance, if authenticated
+        :raises: AuthException otherwise
+        """
+        session = _session.get()
+        username = None if session is None else session.get('username')
+        if username is None:
+            raise AuthException("Unauthenticated user")
+        cache = self._cache
+        cu = cache.get('current_user')
+        if cu is not None and cu.username == username:
+            return cu
+        info = await self._store.users.get(username)
+        if info is None:
+            raise AuthException("Unknown user: %s" % username)
+        cu = await self._make_user(username, info, session=session)
+        cache['current_user'] = cu
+        return cu
+
+    async def user(self, username):
+        """Existing user
+
+        :returns: AsyncUser() instance if the user exist, None otherwise
+        """
+        cu = self._cache.get('current_user')
+        if cu is not None and cu.username == username:
+            return cu
+        if username is None:
+            return None
+        info = await self._store.users.get(username)
+        if info is None:
+            return None
+        return await self._make_user(username, info)
+
+    async def users_bulk(self, usernames):
+        """Existing users, fetched with a single multi-get
+
+        :returns: {username: AsyncUser()} dict, nonexistent users and users
+            whose role no longer exists are omitted
+        """
+        docs = await self._store.users.get_many(set(usernames))
+        roles = await self._get_roles(set(d['role'] for d in docs.values()))
+        return dict(
+            (un, AsyncUser(un, self, d, roles[d['role']]))
+            for un, d in docs.items() if d['role'] in roles
+        )
+
+    async def register(self, username, password, email_addr, company,
+        role='user', max_level=50, subject="Signup confirmation",
+        email_template=None, permissions={}):
+        """Register a new user account. See :meth:`cork.Cork.register`
+        WARNING: this method is available to unauthenticated users
+
+        :returns: registration code
+        :raises: AssertError or AAAException on errors
+        """
+        assert username, "Username must be provided."
+        assert password, "A password must be provided."
+        assert email_addr, "An email address must be provided."
+        assert company, "An company must be provided."
+        assert isinstance(permissions, dict), "Permissions must be a dictionary"
+        if await self._store.users.contains(username):
+            raise AAAException("User is already existing.")
+        self._check_registration_role((await self._roles()).level(role),
+                                      max_level)
+
+        registration_code, pending = self._new_registration(username, role,
+            await self._hash(username, password), email_addr, company,
+            permissions)
+
+        if email_template:
+            self._send_registration_email(registration_code, pending,
+                                          subject, email_template)
+
+        if not self.stateless_registration:
+            await self._store.pending_registrations.insert(registration_code,
+                pending, ttl=self.registration_timeout)
+        return registration_code
+
+    async def validate_registration(self, registration_code):
+        """Validate pending account registration, create a new account if
+        successful.
+
+        :returns: username
+        """
+        data = self._sealed_registration(registration_code)
+        if data is not None:
+            # replay guard: remember the used code until it expires
+            key, entry = self._replay_guard(registration_code)
+            if not await self._store.pending_registrations.insert(key, entry,
+                    ttl=self.registration_timeout):
+                raise AuthException("Invalid registration code.")
+        else:
+            try:
+                data = await self._store.pending_registrations.pop(
+                    registration_code)
+            except KeyError:
+                raise AuthException("Invalid registration code.")
+
+        username = data['username']
+        user_data = self._registered_user_data(data)
+        if not await self._store.users.insert(username, user_data):
+            raise AAAException("User is already existing.")
+        await self._index_user(username, user_data)
+        return username
+
+    async def send_password_reset_email(self, username=None, email_addr=None,
+        subject="Password reset confirmation",
+        email_template='views/password_reset_email'):
+        """Email the user with a link to reset his/her password.
+        See :meth:`cork.Cork.send_password_reset_email`
+
+        :raises: AAAException on missing username, email_addr or
+            secret_keys, AuthException on incorrect username/email_addr pair
+        """
+        if username is None:
+            if email_addr is None:
+                raise AAAException("At least `username` or `email_addr` must" \
+                    " be specified.")
+            username = await self._lookup_email(email_addr)
+            if username is None:
+                raise AAAException("Email address not found.")
+
+        else:
+            email_addr = self._reset_email_addr(email_addr,
+                await self._store.users.get(username))
+
+        reset_code = await self._reset_code(username, email_addr)
+        self._send_reset_email(username, email_addr, reset_code, subject,
+                               email_template)
+
+    async def reset_password(self, reset_code, password):
+        """Validate reset_code and update the account password
+
+        :raises: AuthException for invalid reset tokens, AAAException
+        """
+        username, binding = self._check_reset_code(reset_code)
+        info = await self._store.users.get(username)
+        self._check_reset_binding(binding, info)
+        user = await self._make_user(username, info)
+        upsert = user._update_upsert(
+            pwd_hash=await self._hash(username, password))
+        # a concurrent use of the same token changes the hash first
+        if not await user._write_update(upsert, {'level': user.level},
+                                        expect={('hash',): info['hash']}):
+            raise AuthException("Invalid reset code.")
+
+    def users_by_company(self, company, cursor=None, limit=None,
+        page_size=100):
+        """List the users associated with a company, using the company index.
+
+        :return: (username, validated, role, email_addr, company, permissions)
+            async generator (sorted by username)
+        """
+        return self._list_indexed_users(self._store.company_members,
+            self._member_prefix(company), cursor, limit, page_size)
+
+    def users_by_role(self, role, cursor=None, limit=None, page_size=100):
+        """List the users having a role, using the role index.
+
+        :return: (username, validated, role, email_addr, company, permissions)
+            async generator (sorted by username)
+        """
+        return self._list_indexed_users(self._store.role_members,
+            self._member_prefix(role), cursor, limit, page_size)
+
+    async def rebuild_indexes(self):
+        """Add every existing user to the email, company and role indexes.
+
+        :returns: number of indexed users
+        """
+        count = 0
+        async for username, data in self._store.users.items():
+            await self._index_user(username, data)
+            count += 1
+        return count
+
+    async def connect(self):
+        """Open the storage connections now instead of on the first request
+        """
+        await self._store.connect()
+
+    async def verify_password(self, username, password):
+        user_data = await self._store.users.get(username)
+        if user_data is None:
+            raise KeyError(username)
+        return await self._verify_password(username, password,
+                                           user_data['hash'])
+
+    # # Private methods
+
+    @property
+    def _session(self):
+        session = _session.get()
+        if session is None:
+            raise AAAException("No session available: use request_context()")
+        return session
+
+    @property
+    def _cache(self):
+        """Per-request lookup cache. Outside of a request context a new,
+        throwaway dict is returned.
+        """
+        cache = _request_cache.get()
+        if cache is None:
+            return {}
+        return cache
+
+    def _hashing_slots(self):
+        """Semaphore limiting the concurrent password hashes, created in
+        the running event loop
+
+        :returns: asyncio.Semaphore, or None for no limit
+        """
+        if self._hash_concurrency is None:
+            return None
+        loop = asyncio.get_running_loop()
+        if self._hash_slots_loop is not loop:
+            self._hash_slots = asyncio.Semaphore(self._hash_concurrency)
+            self._hash_slots_loop = loop
+        return self._hash_slots
+
+    async def _run_hashing(self, func, *args):
+        loop = asyncio.get_running_loop()
+        slots = self._hashing_slots()
+        if slots is None:
+            return await loop.run_in_executor(self._hash_executor,
+                                              partial(func, *args))
+        try:
+            await asyncio.wait_for(slots.acquire(), self._hash_queue_timeout)
+        except asyncio.TimeoutError:
+            raise hashing.HashingBusyException(
+                "Too many concurrent password hashes")
+        try:
+            return await loop.run_in_executor(self._hash_executor,
+                                              partial(func, *args))
+        finally:
+            slots.release()
+
+    async def _hash(self, username, pwd):
+        return await self._run_hashing(self.password_hasher.hash,
+                                       self._cleartext(username, pwd))
+
+    async def _verify_password(self, username, pwd, salted_hash):
+        return await self._run_hashing(hashing.verify_password,
+            self._cleartext(username, pwd), salted_hash)
+
+    async def _roles(self):
+        """Roles snapshot, see :meth:`cork.Cork._roles`
+
+        :returns: RoleTable
+        """
+        table = self._fresh_roles()
+        if table is not None:
+            return table
+        version = await self._roles_version()
+        table = self._role_table
+        if self._outdated_roles(version):
+            levels = {}
+            async for name, data in self._store.roles.items():
+                levels[name] = data['level']
+            table = RoleTable(levels, version)
+        return self._set_roles(table)
+
+    async def _roles_version(self):
+        """Current roles version, None if unknown"""
+        meta = getattr(self._store, 'meta', None)
+        if meta is None:
+            return None
+        entry = await meta.get(ROLES_VERSION_KEY)
+        if entry is None:
+            return None
+        return entry['version']
+
+    async def _roles_changed(self):
+        """Publish a new roles version to every process and drop the local
+        snapshot"""
+        meta = getattr(self._store, 'meta', None)
+        if meta is not None:
+            await meta.set(ROLES_VERSION_KEY, {'version': new_version()})
+        self._role_table = None
+
+    async def _reset_code(self, username, email_addr):
+        """generate a reset_code token
+
+        :returns: signed, URL-safe token
+        :raises: AAAException for nonexistent users
+        """
+        user_data = await self._store.users.get(username)
+        if user_data is None:
+            raise AAAException("Nonexistent user.")
+        return self._sign_reset_code(username, user_data)
+
+    async def _make_user(self, username, info, session=None):
+        role_info = await self._get_role(info['role'])
+        return AsyncUser(username, self, info, role_info, session=session)
+
+    async def _get_role(self, role):
+        """Look up a role in the roles snapshot
+
+        :returns: role dict, or None if the role does not exist
+        """
+        return self._role_info(await self._roles(), role)
+
+    async def _get_roles(self, names):
+        """Look up multiple roles in the roles snapshot
+
+        :returns: {role: role dict} dict, nonexistent roles are omitted
+        """
+        return self._roles_info(await self._roles(), names)
+
+    async def _index_user(self, username, data, old=None):
+        """Add a user to the email, company and role indexes.
+        See :meth:`cork.Cork._index_user`
+        """
+        for table_name, key, entry in self._index_changes(username, data,
+                                                          old or {}):
+            table = getattr(self._store, table_name)
+            if entry is not None:
+                await table.set(key, entry)
+            elif table_name == 'emails':
+                await self._unindex_email(key, username)
+            else:
+                await table.delete(key)
+
+    async def _unindex_user(self, username, data):
+        """Remove a user from the email, company and role indexes"""
+        await self._index_user(username, {}, old=data)
+
+    async def _list_indexed_users(self, index, prefix, cursor, limit,
+            page_size, offset=0, descending=False):
+        """List users from the users table or from a membership index, one
+        page at a time. See :meth:`cork.Cork._list_indexed_users`
+        """
+        if cursor is not None:
+            cursor = prefix + cursor
+        remaining = limit
+        while remaining is None or remaining > 0:
+            if remaining is None:
+                count = page_size
+            else:
+                count = min(page_size, remaining)
+            names = await index.range(start_after=cursor, limit=count,
+                skip=offset, descending=descending, prefix=prefix or None)
+            offset = 0
+            usernames = [n[len(prefix):] for n in names]
+            docs = await self._store.users.get_many(usernames)
+            for un in usernames:
+                d = docs.get(un)
+                if d is None:  # deleted in the meantime
+                    continue
+                yield self._user_row(un, d)
+
+            if len(names) < count:
+                return
+            if remaining is not None:
+                remaining -= len(names)
+            cursor = names[-1]
+
+    async def _unindex_email(self, email_addr, username):
+        """Drop an email address from the email index, if it belongs to
+        `username`"""
+        if not email_addr:
+            return
+        entry = await self._store.emails.get(email_addr)
+        if entry is not None and entry['username'] == username:
+            await self._store.emails.delete(email_addr)
+
+    async def _lookup_email(self, email_addr):
+        """Find the user owning an email address
+
+        :returns: username, or None if not found
+        """
+        entry = await self._store.emails.get(email_addr)
+        if entry is None:
+            return None
+        return entry['username']
+
+    def _forget_user(self, username):
+        """Drop a user from the per-request cache"""
+        cache = self._cache
+        cu = cache.get('current_user')
+        if cu is not None and cu.username == username:
+            del cache['current_user']
+
+
+class AsyncUser(BaseUser):
+
+    def __init__(self, username, cork_obj, info, role_info, session=None):
+        """Represent a user, exposing the same attributes as
+        :class:`cork.cork.User`. Built by AsyncCork.
+
+        :param username: username
+        :type username: str.
+        :param cork_obj: instance of :class:`AsyncCork`
+        :param info: user data
+        :type info: dict
+        :param role_info: role data
+        :type role_info: dict
+        """
+        assert role_info is not None, "Unknown role"
+        self._cork = cork_obj
+        self.username = username
+        self.info = info
+        self._load_attributes(role_info)
+
+        if session is not None:
+            self._load_session(session)
+
+    async def update(self, role=None, pwd=None, email_addr=None,
+            validated=None, permissions=None, company=None):
+        """Update an user account data. See :meth:`cork.cork.User.update`
+
+        :raises: AAAException on nonexistent user or role.
+        """
+        username = self.username
+        role_info = {'level': self.level}
+        if role is not None:
+            role_info = await self._cork._get_role(role)
+            if role_info is None:
+                raise AAAException("Nonexistent role.")
+        pwd_hash = None
+        if pwd is not None:
+            pwd_hash = await self._cork._hash(username, pwd)
+        upsert = self._update_upsert(role, pwd_hash, email_addr, validated,
+                                     permissions, company)
+        await self._write_update(upsert, role_info)
+
+    async def _write_update(self, upsert, role_info, expect=None):
+        """Write the fields changed by an update.
+        See :meth:`cork.cork.User._write_update`
+        """
+        username = self.username
+        increment = self._update_increment(upsert)
+        try:
+            if not await self._cork._store.users.mutate(username,
+                    upsert=upsert, expect=expect, increment=increment):
+                return False
+        except KeyError:
+            raise AAAException("User does not exist.")
+
+        old = self._updated(upsert, increment, role_info)
+        await self._cork._index_user(username, self.info, old=old)
+        return True
+
+    async def remove_permissions(self, permissions):
+        """Remove permissions from a user account data
+
+        :raises: AAAException on nonexistent user or role.
+        """
+        assert isinstance(permissions, list), "Permissions must be list"
+
+        remove = [('perm', perm) for perm in permissions]
+        try:
+            await self._cork._store.users.mutate(self.username, remove=remove)
+        except KeyError:
+            raise AAAException("User does not exist.")
+
+        self._permissions_removed(remove)
+
+    async def delete(self):
+        """Delete user account
+
+        :raises: AAAException on nonexistent user.
+        """
+        try:
+            data = await self._cork._store.users.pop(self.username)
+        except KeyError:
+            raise AAAException("Nonexistent user.")
+        await self._cork._unindex_user(self.username, data)
+        self._cork._forget_user(self.username)
@@ -0,0 +1,190 @@
+# Cork - Authentication module for the Bottle web framework
+# Copyright (C) 2012 Federico Ceratto
+#
+# This package is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This package is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Asyncio storage backend interface
+#
+# Mirrors base_backend with coroutine methods, for use by AsyncCork.
+# Synchronous backends are adapted by running their calls in an executor.
+
+from functools import partial
+import asyncio
+
+from .base_backend import Backend
+
+
+class AsyncTable(object):
+    """Base class for a table of entries accessed from asyncio code.
+    Same semantics as :class:`cork.base_backend.Table`; the container
+    protocol is replaced by the contains, set, delete and count coroutines.
+    """
+
+    page_size = 100
+
+    async def contains(self, item):
+        raise NotImplementedError
+
+    async def get(self, item, default=None):
+        raise NotImplementedError
+
+    async def get_many(self, items):
+        raise NotImplementedError
+
+    async def set(self, key, value):
+        raise NotImplementedError
+
+    async def insert(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    async def purge_expired(self):
+        return 0
+
+    async def delete(self, item):
+        raise NotImplementedError
+
+    async def pop(self, item):
+        raise NotImplementedError
+
+    async def mutate(self, item, upsert=None, remove=(), expect=None,
+            increment=None):
+        raise NotImplementedError
+
+    async def range(self, start_after=None, limit=None, skip=0,
+            descending=False, prefix=None):
+        raise NotImplementedError
+
+    async def count(self):
+        raise NotImplementedError
+
+    async def names(self):
+        """Walk the table, fetching `page_size` names at a time
+
+        :returns: async generator of names, in order
+        """
+        cursor = None
+        while True:
+            names = await self.range(start_after=cursor, limit=self.page_size)
+            for name in names:
+                yield name
+            if len(names) < self.page_size:
+                return
+            cursor = names[-1]
+
+    async def items(self):
+        """Walk the table, fetching `page_size` entries at a time
+
+        :returns: async generator of (name, entry) tuples, in order
+        """
+        cursor = None
+        while True:
+            names = await self.range(start_after=cursor, limit=self.page_size)
+            entries = await self.get_many(names)
+            for name in names:
+                if name in entries:
+                    yield name, entries[name]
+            if len(names) < self.page_size:
+                return
+            cursor = names[-1]
+
+
+class AsyncBackend(object):
+    """Base class for asyncio storage backends"""
+
+    table_names = Backend.table_names
+
+    async def connect(self):
+        """Open the storage connections now instead of on first use"""
+        pass
+
+    async def close(self):
+        pass
+
+
+class ThreadedAsyncTable(AsyncTable):
+
+    def __init__(self, table, executor=None):
+        """Run the calls to a synchronous table in an executor
+
+        :param table: synchronous table
+        :type table: cork.base_backend.Table
+        :param executor: concurrent.futures executor, None for the event
+            loop default one
+        """
+        self._table = table
+        self._executor = executor
+        self.page_size = table.page_size
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args))
+
+    async def contains(self, item):
+        return await self._run(self._table.__contains__, item)
+
+    async def get(self, item, default=None):
+        return await self._run(self._table.get, item, default)
+
+    async def get_many(self, items):
+        return await self._run(self._table.get_many, list(items))
+
+    async def set(self, key, value):
+        await self._run(self._table.__setitem__, key, value)
+
+    async def insert(self, key, value, ttl=None):
+        return await self._run(self._table.insert, key, value, ttl)
+
+    async def purge_expired(self):
+        return await self._run(self._table.purge_expired)
+
+    async def delete(self, item):
+        await self._run(self._table.__delitem__, item)
+
+    async def pop(self, item):
+        return await self._run(self._table.pop, item)
+
+    async def mutate(self, item, upsert=None, remove=(), expect=None,
+            increment=None):
+        return await self._run(self._table.mutate, item, upsert, remove,
+                               expect, increment)
+
+    async def range(self, start_after=None, limit=None, skip=0,
+            descending=False, prefix=None):
+        return await self._run(self._table.range, start_after, limit, skip,
+                               descending, prefix)
+
+    async def count(self):
+        return await self._run(len, self._table)
+
+
+class ThreadedAsyncBackend(AsyncBackend):
+
+    def __init__(self, backend, executor=None):
+        """Expose a synchronous backend, e.g. MemoryBackend or SqliteBackend,
+        to asyncio code.
+
+        :param backend: synchronous backend
+        :type backend: cork.base_backend.Backend
+        :param executor: concurrent.futures executor, None for the event
+            loop default one
+        """
+        self.backend = backend
+        self._executor = executor
+        for name in self.table_names:
+            setattr(self, name,
+                    ThreadedAsyncTable(getattr(backend, name), executor))
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self.backend.connect)
@@ -0,0 +1,420 @@
+# Cork - Authentication module for the Bottle web framework
+# Copyright (C) 2012 Federico Ceratto
+#
+# This package is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This package is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Storage backend interface
+#
+# A backend exposes its data as a set of tables, each one mapping entry names
+# to dicts. Cork uses the following tables:
+#  - users, roles, pending_registrations
+#  - emails: email address -> {'username': ...} index
+#  - company_members, role_members: membership indexes, entry names are
+#    "<quoted company or role>:<username>"
+
+from collections import OrderedDict
+from copy import deepcopy
+from threading import Lock
+from time import time
+
+
+class BackendIOException(Exception):
+    """Failure of the underlying storage"""
+    pass
+
+
+class ConcurrentUpdateException(BackendIOException):
+    """A write kept conflicting with concurrent writers"""
+    pass
+
+
+def apply_mutations(entry, upsert=None, remove=(), increment=None):
+    """Apply field mutations to an entry, in place.
+    Paths are tuples of keys, e.g. ('perm', 'edit') for entry['perm']['edit'].
+    Missing parents are created by upserts and increments, missing counters
+    start from 0; missing paths are ignored by removals.
+
+    :returns: the entry
+    """
+    for path, value in (upsert or {}).items():
+        parent = entry
+        for key in path[:-1]:
+            parent = parent.setdefault(key, {})
+        parent[path[-1]] = value
+    for path, delta in (increment or {}).items():
+        parent = entry
+        for key in path[:-1]:
+            parent = parent.setdefault(key, {})
+        parent[path[-1]] = parent.get(path[-1], 0) + delta
+    for path in remove:
+        parent = entry
+        for key in path[:-1]:
+            parent = parent.get(key)
+            if not isinstance(parent, dict):
+                break
+        else:
+            parent.pop(path[-1], None)
+    return entry
+
+
+def matches(entry, expect):
+    """Tell if the fields of an entry have the expected values. Missing
+    fields are expected as None.
+
+    :param expect: {path: value} expected fields, paths as in
+        :func:`apply_mutations`
+    :type expect: dict
+    :returns: bool
+    """
+    for path, value in (expect or {}).items():
+        field = entry
+        for key in path:
+            field = field.get(key) if isinstance(field, dict) else None
+        if field != value:
+            return False
+    return True
+
+
+class Table(object):
+    """Base class for a table of entries, keyed by name.
+    Entries are dicts. Values returned by a table are copies: changes are
+    persisted only by writing the entry back.
+    """
+
+    page_size = 100
+
+    def __contains__(self, item):
+        raise NotImplementedError
+
+    def __getitem__(self, item):
+        """:raises: KeyError if the entry does not exist"""
+        raise NotImplementedError
+
+    def __setitem__(self, key, value):
+        """:raises: BackendIOException if the entry cannot be stored"""
+        raise NotImplementedError
+
+    def insert(self, key, value, ttl=None):
+        """Create an entry, atomically checking that it does not exist
+
+        :param ttl: time to live (seconds): the entry disappears once
+            expired (optional)
+        :type ttl: float.
+        :returns: False if the entry already exists, True otherwise
+        """
+        raise NotImplementedError
+
+    def purge_expired(self):
+        """Delete the expired entries still stored, for backends emulating
+        expiry. The cost depends on the number of expired entries only.
+
+        :returns: number of deleted entries
+        """
+        return 0
+
+    def __delitem__(self, item):
+        """Delete an entry. Deleting a nonexistent entry is not an error."""
+        raise NotImplementedError
+
+    def pop(self, item):
+        """Delete an entry and return it
+
+        :raises: KeyError if the entry does not exist
+        """
+        raise NotImplementedError
+
+    def get(self, item, default=None):
+        """Fetch an entry
+
+        :returns: the entry, or `default` if it does not exist
+        """
+        raise NotImplementedError
+
+    def get_many(self, items):
+        """Fetch multiple entries
+
+        :param items: entry names
+        :type items: iterable
+        :returns: {name: entry} dict, nonexistent entries are omitted
+        """
+        raise NotImplementedError
+
+    def mutate(self, item, upsert=None, remove=(), expect=None,
+            increment=None):
+        """Change some fields of an entry without rewriting it as a whole.
+        The change is applied atomically: concurrent mutations of different
+        fields of the same entry are never lost.
+
+        :param upsert: {path: value} fields to set, paths being tuples of keys
+        :type upsert: dict
+        :param remove: paths of the fields to remove, if present
+        :type remove: iterable
+        :param increment: {path: delta} integer counters to add to, missing
+            counters starting from 0 (optional)
+        :type increment: dict
+        :param expect: {path: value} fields the entry must have for the
+            change to be applied, checked atomically with it (optional)
+        :type expect: dict
+        :returns: False if the entry did not have the `expect` fields, True
+            otherwise
+        :raises: KeyError if the entry does not exist,
+            ConcurrentUpdateException if the update keeps conflicting
+        """
+        raise NotImplementedError
+
+    def range(self, start_after=None, limit=None, skip=0, descending=False,
+            prefix=None):
+        """List entry names in order, one page at a time
+
+        :param start_after: cursor: only list names following this one
+        :type start_after: str.
+        :param limit: maximum number of names (optional)
+        :type limit: int.
+        :param skip: number of names to skip
+        :type skip: int.
+        :param descending: list names in descending order
+        :type descending: bool.
+        :param prefix: only list names starting with this prefix (optional)
+        :type prefix: str.
+        :returns: list of names
+        """
+        raise NotImplementedError
+
+    def __iter__(self):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def items(self):
+        """(name, entry) generator"""
+        raise NotImplementedError
+
+    iteritems = items
+
+    def keys(self):
+        return iter(self)
+
+    iterkeys = keys
+
+    def values(self):
+        for name, entry in self.items():
+            yield entry
+
+    itervalues = values
+
+    def reconcile_count(self):
+        """Recompute the number of entries, for backends keeping a counter
+
+        :returns: number of entries
+        """
+        return len(self)
+
+
+class Backend(object):
+    """Base class for storage backends"""
+
+    table_names = ('users', 'roles', 'pending_registrations', 'emails',
+                   'company_members', 'role_members', 'meta')
+
+    def connect(self):
+        """Open the storage connections now instead of on first use.
+        Backends connecting eagerly, or not at all, do nothing.
+        """
+        pass
+
+    def reconcile_counts(self):
+        """Recompute every table entry counter.
+        Meant to be run periodically, e.g. from a maintenance job.
+
+        :returns: {table_name: number of entries}
+        """
+        return dict(
+            (name, getattr(self, name).reconcile_count())
+            for name in self.table_names
+        )
+
+    def cache_stats(self):
+        """Users and roles cache statistics
+
+        :returns: {table_name: stats dict}, empty if caching is disabled
+        """
+        return dict(
+            (name, getattr(self, name).stats())
+            for name in ('users', 'roles')
+            if isinstance(getattr(self, name), CachedTable)
+        )
+
+
+class CachedTable(object):
+
+    def __init__(self, table, max_size=1000, ttl=60):
+        """Process-local read-through cache in front of a table.
+        Entries are evicted in LRU order when `max_size` is reached and
+        expire after `ttl` seconds. Writes performed through the cache
+        invalidate the cached entry; writes from other processes become
+        visible once the entry expires.
+
+        :param table: the cached table
+        :type table: Table
+        :param max_size: maximum number of cached entries
+        :type max_size: int.
+        :param ttl: entry time-to-live (seconds)
+        :type ttl: float.
+        """
+        self._table = table
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getattr__(self, name):
+        # anything not cached is delegated to the underlying table
+        return getattr(self._table, name)
+
+    def _lookup(self, item):
+        with self._lock:
+            entry = self._entries.get(item)
+            if entry is not None:
+                expiry, value = entry
+                if expiry > time():
+                    self._entries.move_to_end(item)
+                    self.hits += 1
+                    return deepcopy(value)
+                del self._entries[item]
+            self.misses += 1
+            generation = self._generation
+
+        value = self._table[item]
+        self._remember({item: value}, generation)
+        return value
+
+    def _remember(self, values, generation):
+        with self._lock:
+            # do not cache values fetched while a write was in progress
+            if generation != self._generation:
+                return
+            expiry = time() + self.ttl
+            for item, value in values.items():
+                self._entries[item] = (expiry, deepcopy(value))
+                self._entries.move_to_end(item)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, item=None):
+        """Drop an entry from the cache, or every entry if `item` is None"""
+        with self._lock:
+            self._generation += 1
+            if item is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(item, None)
+
+    def stats(self):
+        """Cache statistics
+
+        :returns: dict with hits, misses, evictions, size and hit_rate
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            }
+
+    def __contains__(self, item):
+        with self._lock:
+            entry = self._entries.get(item)
+            if entry is not None and entry[0] > time():
+                self.hits += 1
+                return True
+            self.misses += 1
+        return item in self._table
+
+    def __getitem__(self, item):
+        return self._lookup(item)
+
+    def get(self, item, default=None):
+        try:
+            return self._lookup(item)
+        except KeyError:
+            return default
+
+    def get_many(self, items):
+        found = {}
+        missing = []
+        now = time()
+        with self._lock:
+            for item in items:
+                entry = self._entries.get(item)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(item)
+                    self.hits += 1
+                    found[item] = deepcopy(entry[1])
+                else:
+                    self.misses += 1
+                    missing.append(item)
+            generation = self._generation
+
+        if missing:
+            fetched = self._table.get_many(missing)
+            self._remember(fetched, generation)
+            found.update(fetched)
+        return found
+
+    def __setitem__(self, key, value):
+        self.invalidate(key)
+        self._table[key] = value
+        self.invalidate(key)
+
+    def insert(self, key, value, ttl=None):
+        self.invalidate(key)
+        try:
+            return self._table.insert(key, value, ttl)
+        finally:
+            self.invalidate(key)
+
+    def __delitem__(self, item):
+        self.invalidate(item)
+        del self._table[item]
+        self.invalidate(item)
+
+    def pop(self, item):
+        self.invalidate(item)
+        try:
+            return self._table.pop(item)
+        finally:
+            self.invalidate(item)
+
+    def mutate(self, item, upsert=None, remove=(), expect=None,
+            increment=None):
+        self.invalidate(item)
+        try:
+            return self._table.mutate(item, upsert, remove, expect, increment)
+        finally:
+            self.invalidate(item)
+
+    def __iter__(self):
+        return iter(self._table)
+
+    def __len__(self):
+        return len(self._table)
@@ -18,7 +18,7 @@
 #
 #
 # Cork is designed for web application with a small userbase. User credentials
-# are stored in a JSON file.
+# are stored in a pluggable storage backend (Couchbase by default).
 #
 # Features:
 #  - basic role support
@@ -27,178 +27,406 @@
 # Roadmap:
 #  - add hooks to provide logging or user-defined functions in case of
 #     login/require failure
-#  - decouple authentication logic from data storage to allow multiple backends
-#    (e.g. a key/value database)
-
-from base64 import b64encode, b64decode
-from beaker import crypto
-from datetime import datetime, timedelta
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+
+# Bottle, Beaker, email and SMTP support are imported on first use: tools
+# and workers using the storage only do not pay for them at import time.
+
+from copy import deepcopy
 from logging import getLogger
-from smtplib import SMTP, SMTP_SSL
 from threading import Thread
-from time import time
-import bottle
-import os
+from time import monotonic, time
+from urllib.parse import quote
 import re
-import shutil
-import uuid
 
-try:
-    import json
-except ImportError:  # pragma: no cover
-    import simplejson as json
+from .base_backend import CachedTable, apply_mutations
+from .exceptions import AAAException, AuthException
+from .roles import ROLES_VERSION_KEY, RoleTable, new_version
+from . import hashing, tokens
 
 
 log = getLogger(__name__)
 
-COUCHBASE_ENTRY_DESIGN_DOC = "admin"
-COUCHBASE_ENTRY_VIEW = "keys_by_table"
+# WSGI environ key holding the per-request lookup cache
+REQUEST_CACHE_KEY = "cork.request_cache"
+
+_bottle_module = None
+
+
+def _bottle():
+    """The bottle module, imported on first use"""
+    global _bottle_module
+    if _bottle_module is None:
+        import bottle
+        _bottle_module = bottle
+    return _bottle_module
 
-class AAAException(Exception):
-    """Generic Authentication/Authorization Exception"""
-    pass
 
+class BaseCork(object):
+    """Storage and request independent logic shared by :class:`Cork` and
+    :class:`cork.aiocork.AsyncCork`, which only differ in how they reach
+    the storage and the session"""
 
-class AuthException(AAAException):
-    """Authentication Exception: incorrect username/password pair"""
-    pass
+    def __init__(self, email_sender, smtp_url, password_hasher, secret_keys,
+            stateless_registration, roles_refresh_interval):
+        if stateless_registration and secret_keys is None:
+            raise AAAException("Stateless registration requires "
+                               "secret_keys.")
+        if stateless_registration and not tokens.sealing_available():
+            raise RuntimeError("Stateless registration requires the "
+                               "cryptography package")
+        self.mailer = Mailer(email_sender, smtp_url)
+        self.password_hasher = hashing.get_hasher(password_hasher)
+        self._signer = tokens.TokenSigner(secret_keys)
+        # without secret_keys the signer key is only known to this process
+        self._shared_keys = secret_keys is not None
+        self.stateless_registration = stateless_registration
+        self.password_reset_timeout = 3600 * 24
+        # pending registrations expire after this time (seconds)
+        self.registration_timeout = 3600 * 96
+        self.roles_refresh_interval = roles_refresh_interval
+        self._role_table = None
+        self._role_table_checked = 0
+
+    # Roles snapshot
 
-class CouchbaseTable(dict):
-    def __init__(self, bucket, table_name):
-        """ Wrapper class to manage a table of couchbase entries
+    def _fresh_roles(self):
+        """Roles snapshot, if checked within the refresh interval
 
-        :param bucket: couchbase Bucket
-        :type bucket: couchbase.bucket.Bucket
-        :param table_name: the name (aka prefix) of the table entries
-        :type table_name: str.
+        :returns: RoleTable, or None if the roles version must be checked
         """
-        self.bucket = bucket
-        self.client = bucket.default_collection()
-        self.table_name = table_name
+        table = self._role_table
+        if table is not None and monotonic() - self._role_table_checked < \
+                self.roles_refresh_interval:
+            return table
+        return None
 
-    def _get_entry_key(self, item):
-        return "%s:%s" % (self.table_name, item)
+    def _outdated_roles(self, version):
+        """Tell if the roles snapshot must be reloaded
 
-    def __contains__(self, item):
-        try:
-            result = self.client.get(self._get_entry_key(item))
-        except:
-            return False
-        return result.content_as[dict] is not None
+        :param version: current roles version, None if unknown
+        """
+        table = self._role_table
+        return table is None or version is None or version != table.version
 
-    def __getitem__(self, item):
-        try:
-            result = self.client.get(self._get_entry_key(item))
-        except:
-            raise KeyError()
+    def _set_roles(self, table):
+        """Keep a roles snapshot, checked as of now
 
-        return result.content_as[dict]
+        :returns: RoleTable
+        """
+        self._role_table = table
+        self._role_table_checked = monotonic()
+        return table
 
-    def __setitem__(self, key, value):
-        try:
-            self.client.upsert(self._get_entry_key(key), value)
-        except:
-            pass
+    @staticmethod
+    def _role_info(roles, role):
+        """Look up a role in a roles snapshot
+
+        :returns: role dict, or None if the role does not exist
+        """
+        level = roles.level(role)
+        if level is None:
+            return None
+        return {'level': level}
+
+    @staticmethod
+    def _roles_info(roles, names):
+        """Look up multiple roles in a roles snapshot
+
+        :returns: {role: role dict} dict, nonexistent roles are omitted
+        """
+        levels = roles.levels
+        return dict((r, {'level': levels[r]}) for r in names if r in levels)
+
+    # Authorization
+
+    @staticmethod
+    def _check_requirement(fixed_role, role):
+        """Validate the parameters of a requirement
+
+        :raises: AAAException
+        """
+        if fixed_role and role is None:
+            raise AAAException(
+                """A role must be specified if fixed_role has been set""")
+
+    @staticmethod
+    def _access_denial(cu, username, company, role, fixed_role,
+            threshold_lvl):
+        """Check the current user against a requirement
+
+        :returns: the reason to deny access, None if access is granted
+        """
+        if username is not None and username != cu.username:
+            return "Unauthorized access: incorrect username"
+
+        if company is not None and cu.level < 200:
+            if cu.company != company:
+                return "Unauthorized access: user is not associated with " \
+                    "company"
+
+        if fixed_role:
+            if role != cu.role:
+                return "Unauthorized access: incorrect role"
+
+        elif threshold_lvl is not None:
+            # Any role with higher level is allowed
+            if cu.level < threshold_lvl:
+                return "Unauthorized access: "
+
+        return None
+
+    # Users
+
+    @staticmethod
+    def _user_data(role, pwd_hash, email_addr, company, permissions,
+            validated=True, creation_date=None):
+        """New user data"""
+        if creation_date is None:
+            creation_date = int(time())
+        return {
+            'role': role,
+            'hash': pwd_hash,
+            'email_addr': email_addr,
+            'company': company,
+            'perm': permissions,
+            'validated': validated,
+            'creation_date': creation_date
+        }
+
+    @staticmethod
+    def _user_row(username, data):
+        """User listing entry
+
+        :returns: (username, validated, role, email_addr, company,
+            permissions) tuple
+        """
+        return (username, data['validated'], data['role'], data['email_addr'],
+                data['company'], data['perm'])
+
+    @staticmethod
+    def _member_prefix(value):
+        """Membership index key prefix for a company or role"""
+        return "%s:" % quote(value, safe='')
+
+    def _index_changes(self, username, data, old):
+        """Index entries to update after a user change. Only the entries of
+        the changed fields are listed.
+
+        :param data: new user data, empty for deleted users
+        :param old: previous user data, empty for new users
+        :returns: list of (table name, key, entry) tuples. The entry is None
+            for deleted entries: email entries are then only deleted if
+            they still belong to the user.
+        """
+        changes = []
+        if data.get('email_addr') != old.get('email_addr'):
+            if old.get('email_addr'):
+                changes.append(('emails', old['email_addr'], None))
+            if data.get('email_addr'):
+                changes.append(('emails', data['email_addr'],
+                                {'username': username}))
+        for field, table_name in (('company', 'company_members'),
+                                  ('role', 'role_members')):
+            if data.get(field) == old.get(field):
+                continue
+            if old.get(field) is not None:
+                changes.append((table_name,
+                                self._member_prefix(old[field]) + username,
+                                None))
+            if data.get(field) is not None:
+                changes.append((table_name,
+                                self._member_prefix(data[field]) + username,
+                                {'username': username}))
+        return changes
+
+    # Registration
+
+    @staticmethod
+    def _check_registration_role(level, max_level):
+        """Check the level of the role requested by a registration
+
+        :param level: role level, None for nonexistent roles
+        :raises: AAAException
+        """
+        if level is None:
+            raise AAAException("Nonexistent role")
+        if level > max_level:
+            raise AAAException("Unauthorized role")
+
+    def _new_registration(self, username, role, pwd_hash, email_addr,
+            company, permissions):
+        """Pending registration and its code. With stateless registration
+        the code carries the pending registration itself.
+
+        :returns: (registration code, pending registration dict) tuple
+        """
+        pending = {
+            'username': username,
+            'role': role,
+            'hash': pwd_hash,
+            'email_addr': email_addr,
+            'company': company,
+            'perm': permissions,
+            'creation_date': int(time()),
+        }
+        if self.stateless_registration:
+            registration_code = self._signer.seal('register', [pending],
+                                                  self.registration_timeout)
+        else:
+            import uuid
+            registration_code = uuid.uuid4().hex
+        return registration_code, pending
+
+    def _send_registration_email(self, registration_code, pending, subject,
+            email_template):
+        email_text = _bottle().template(email_template,
+            username=pending['username'],
+            email_addr=pending['email_addr'],
+            company=pending['company'],
+            role=pending['role'],
+            creation_date=pending['creation_date'],
+            registration_code=registration_code
+        )
+        self.mailer.send_email(pending['email_addr'], subject, email_text)
 
-    def __delitem__(self, item):
+    def _sealed_registration(self, registration_code):
+        """Decrypt a stateless registration code
+
+        :returns: pending registration dict, or None for the codes of stored
+            registrations, which are plain hex strings
+        :raises: AuthException for invalid or expired codes
+        """
+        if not (self.stateless_registration and '.' in registration_code):
+            return None
         try:
-            self.client.remove(self._get_entry_key(item))
-        except:
-            pass
+            data, = self._signer.unseal('register', registration_code)
+        except tokens.ExpiredTokenException:
+            raise AuthException("Expired registration code.")
+        except (tokens.InvalidTokenException, ValueError):
+            raise AuthException("Invalid registration code.")
+        return data
+
+    @staticmethod
+    def _replay_guard(registration_code):
+        """Entry remembering a used stateless registration code until it
+        expires
+
+        :returns: (key, entry) tuple
+        """
+        return ('used.' + tokens.fingerprint(registration_code),
+                {'creation_date': int(time())})
+
+    @staticmethod
+    def _registered_user_data(pending):
+        """User data created by validating a pending registration"""
+        return BaseCork._user_data(pending['role'], pending['hash'],
+            pending['email_addr'], pending['company'], pending['perm'],
+            validated=False, creation_date=pending['creation_date'])
+
+    # Password reset
+
+    @staticmethod
+    def _reset_email_addr(email_addr, user_data):
+        """Email address receiving a password reset, checked against the
+        user data
+
+        :raises: AAAException on nonexistent user or missing email
+            address, AuthException on incorrect username/email_addr pair
+        """
+        if user_data is None:
+            raise AAAException("Nonexistent user.")
+        if email_addr is None:
+            email_addr = user_data.get('email_addr', None)
+            if not email_addr:
+                raise AAAException("Email address not available.")
+        elif email_addr != user_data['email_addr']:
+            raise AuthException("Username/email address pair not found.")
+        return email_addr
+
+    def _check_reset_keys(self):
+        """Reset tokens must be verifiable by every worker, and after a
+        restart
+
+        :raises: AAAException if no secret_keys were configured
+        """
+        if not self._shared_keys:
+            raise AAAException("Password reset requires secret_keys.")
+
+    def _sign_reset_code(self, username, user_data):
+        """Reset token bound to the current user data
 
-    def pop(self, item):
+        :returns: signed, URL-safe token
+        :raises: AAAException if no secret_keys were configured
+        """
+        self._check_reset_keys()
+        return self._signer.sign('reset', [username,
+            self._reset_binding(user_data)], self.password_reset_timeout)
+
+    def _send_reset_email(self, username, email_addr, reset_code, subject,
+            email_template):
+        email_text = _bottle().template(email_template,
+            username=username,
+            email_addr=email_addr,
+            reset_code=reset_code
+        )
+        self.mailer.send_email(email_addr, subject, email_text)
+
+    @staticmethod
+    def _reset_binding(user_data):
+        """Fingerprint of the user data a reset token is bound to"""
+        return tokens.fingerprint(user_data['hash'],
+                                  user_data.get('email_addr') or '')
+
+    def _check_reset_code(self, reset_code):
+        """Check a reset_code token signature and expiry, without
+        accessing the storage. The binding must then be checked against
+        the current user data.
+
+        :returns: (username, binding) tuple
+        :raises: AuthException for invalid reset tokens, AAAException if
+            no secret_keys were configured
+        """
+        self._check_reset_keys()
         try:
-            result = self.client.get(self._get_entry_key(item))
-            self.client.remove(self._get_entry_key(item))
-        except:
-            raise KeyError()
-
-        return result.content_as[dict]
-
-    def _get_keys(self, include_docs=False):
-        from couchbase.options import ViewOptions
-        view_values = [v for v in self.bucket.view_query(COUCHBASE_ENTRY_DESIGN_DOC, COUCHBASE_ENTRY_VIEW, ViewOptions(key=self.table_name, reduce=False)).rows()]
-        # seems that couchbase sdk removed include_docs
-        if include_docs:
-            doc_ids = [r.id for r in view_values]
-            multi_response = self.client.get_multi(doc_ids)
-            multi_results = multi_response.results
-            for value in view_values:
-                value.document = multi_results[value.id]
-        return view_values
-
-    def __iter__(self):
-        values = self._get_keys()
-        for item in values:
-            yield item.key
-
-    def __len__(self):
-        values = self._get_keys()
-        return len(values)
-
-    def items(self):
-        values = self._get_keys(include_docs=True)
-        yield [(item.key, item.document.content_as[dict]) for item in values]
-
-    def iteritems(self, *args, **kwargs):
-        values = self._get_keys(include_docs=True)
-        for item in values:
-            yield item.key, item.document.content_as[dict]
-
-    def keys(self):
-        values = self._get_keys()
-        yield [item.key for item in values]
-
-    def iterkeys(self):
-        values = self._get_keys()
-        for item in values:
-            yield item.key
-
-    def values(self):
-        values = self._get_keys(include_docs=True)
-        yield [item.document.content_as[dict] for item in values]
-
-    def itervalues(self):
-        values = self._get_keys(include_docs=True)
-        for item in values:
-            yield item.document.content_as[dict]
-
-class CouchbaseBackend(object):
-
-    def __init__(self, db_host='localhost', db_password='', db_bucket='default', users_table_name='User',
-            roles_table_name='Role', pending_reg_table_name='Register'):
-        """Data storage class. Handles JSON Docs in Couchbase
+            username, binding = self._signer.verify('reset', reset_code)
+        except tokens.ExpiredTokenException:
+            raise AuthException("Expired reset code.")
+        except (tokens.InvalidTokenException, ValueError):
+            raise AuthException("Invalid reset code.")
+        return username, binding
 
-        :param db_host: hostname of couchbase server to use
-        :type db_host: str.
-        :param db_password: password used to log into couchbase server
-        :type db_password: str.
-        :param db_bucket: couchbase bucket that contains the data
-        :type db_bucket: str.
-        :param users_table_name: prefix for user keys
-        :type users_table_name: str.
-        :param roles_table_name: prefix for role keys
-        :type roles_table_name: str.
-        :param pending_reg_table_name: prefix for pending registration keys
-        :type pending_reg_table_name: str.
+    def _check_reset_binding(self, binding, user_data):
+        """Check that the user data did not change since the reset token
+        was issued: a token can be used only once
+
+        :raises: AAAException on nonexistent user, AuthException for used
+            tokens
         """
-        from couchbase.cluster import Cluster
-        from couchbase.options import ClusterOptions
-        from couchbase.auth import PasswordAuthenticator
-        cluster = Cluster('couchbase://{0}'.format(db_host), ClusterOptions(PasswordAuthenticator(db_bucket, db_password)))
-        bucket = cluster.bucket(db_bucket)
-        self.users = CouchbaseTable(bucket, users_table_name)
-        self.roles = CouchbaseTable(bucket, roles_table_name)
-        self.pending_registrations = CouchbaseTable(bucket, pending_reg_table_name)
+        if user_data is None:
+            raise AAAException("Nonexistent user.")
+        if binding != self._reset_binding(user_data):
+            raise AuthException("Invalid reset code.")
 
+    # Password hashing
 
-class Cork(object):
+    @staticmethod
+    def _cleartext(username, pwd):
+        return ("%s\0%s" % (username, pwd)).encode('utf-8')
+
+
+class Cork(BaseCork):
 
     def __init__(self, email_sender=None, db_host='localhost', db_password='', db_bucket='default',
         users_table_name='User', roles_table_name='Role', pending_reg_table_name='Register',
-        session_domain=None, smtp_url='localhost', smtp_server=None):
+        session_domain=None, smtp_url='localhost', smtp_server=None,
+        cache_size=0, users_cache_ttl=30, roles_cache_ttl=3600,
+        email_index_table_name='Email', company_index_table_name='UserByCompany',
+        role_index_table_name='UserByRole', backend=None,
+        password_hasher=None, hash_executor=None, hash_concurrency=None,
+        hash_queue_timeout=10, secret_keys=None,
+        stateless_registration=False, session_mode='beaker',
+        session_cookie_name='cork', session_ttl=3600 * 24,
+        session_revalidate=300, roles_refresh_interval=10):
         """Auth/Authorization/Accounting class
 
         :param db_host: hostname of couchbase server to use
@@ -213,14 +441,92 @@ class Cork(object):
         :type roles_table_name: str.
         :param pending_reg_table_name: prefix for pending registration keys
         :type pending_reg_table_name: str.
+        :param cache_size: size of the process-local users and roles cache,
+            0 to disable caching
+        :type cache_size: int.
+        :param users_cache_ttl: users cache time-to-live (seconds)
+        :type users_cache_ttl: float.
+        :param roles_cache_ttl: roles cache time-to-live (seconds)
+        :type roles_cache_ttl: float.
+        :param email_index_table_name: prefix for email address index keys
+        :type email_index_table_name: str.
+        :param company_index_table_name: prefix for company membership keys
+        :type company_index_table_name: str.
+        :param role_index_table_name: prefix for role membership keys
+        :type role_index_table_name: str.
+        :param backend: storage backend instance (optional). If set, the
+            Couchbase and cache parameters are ignored.
+        :type backend: cork.base_backend.Backend
+        :param password_hasher: hashing policy for new password hashes: a
+            :class:`cork.hashing.Hasher` instance or a registered scheme
+            name. Defaults to PBKDF2-SHA256. Existing hashes are upgraded to
+            the policy on login.
+        :type password_hasher: cork.hashing.Hasher or str.
+        :param hash_executor: concurrent.futures executor computing password
+            hashes, e.g. a ProcessPoolExecutor. By default hashes are
+            computed in the request thread.
+        :param hash_concurrency: maximum number of password hashes computed
+            at the same time, None for no limit. Requests over the limit
+            wait for a free slot. See :class:`cork.hashing.HashingPool` for
+            the cost of a hash.
+        :type hash_concurrency: int.
+        :param hash_queue_timeout: time a request waits for a free hashing
+            slot before failing with HashingBusyException (seconds)
+        :type hash_queue_timeout: float.
+        :param secret_keys: keys signing the password reset tokens, newest
+            first: tokens signed with any of them are accepted, which allows
+            rotating keys. Shared by every worker. Required by password
+            reset, by the cookie session mode and by stateless registration.
+        :type secret_keys: list of str.
+        :param stateless_registration: carry pending registrations in
+            encrypted registration codes instead of storing them. Requires
+            the cryptography package and `secret_keys`, shared by every
+            worker.
+        :type stateless_registration: bool.
+        :param session_mode: 'beaker' to keep the username in the Beaker
+            session, 'cookie' to keep username, role, level and company in
+            a signed cookie, sparing storage reads on most requests.
+            Requires `secret_keys`, shared by every worker.
+        :type session_mode: str.
+        :param session_cookie_name: name of the signed cookie
+        :type session_cookie_name: str.
+        :param session_ttl: signed cookie lifetime, extended on every
+            revalidation (seconds)
+        :type session_ttl: int.
+        :param session_revalidate: time after which the signed cookie is
+            checked against the stored user and role (seconds)
+        :type session_revalidate: int.
+        :param roles_refresh_interval: roles are read from a process-local
+            snapshot, checked for changes made by other processes at most
+            once per interval (seconds)
+        :type roles_refresh_interval: float.
         """
+        if session_mode not in ('beaker', 'cookie'):
+            raise AAAException("The session mode must be 'beaker' or "
+                               "'cookie'.")
+        if session_mode == 'cookie' and secret_keys is None:
+            raise AAAException("The cookie session mode requires "
+                               "secret_keys.")
         if smtp_server:
             smtp_url = smtp_server
-        self.mailer = Mailer(email_sender, smtp_url)
-        self._store = CouchbaseBackend(db_host, db_password, db_bucket, users_table_name,
-                                       roles_table_name, pending_reg_table_name)
-        self.password_reset_timeout = 3600 * 24
+        super(Cork, self).__init__(email_sender, smtp_url, password_hasher,
+            secret_keys, stateless_registration, roles_refresh_interval)
+        if backend is None:
+            from .couchbase_backend import CouchbaseBackend
+            backend = CouchbaseBackend(db_host, db_password, db_bucket, users_table_name,
+                                       roles_table_name, pending_reg_table_name,
+                                       cache_size, users_cache_ttl, roles_cache_ttl,
+                                       email_index_table_name=email_index_table_name,
+                                       company_index_table_name=company_index_table_name,
+                                       role_index_table_name=role_index_table_name)
+        self._store = backend
+        self._hashing = hashing.HashingPool(hash_executor, hash_concurrency,
+                                            hash_queue_timeout)
         self.session_domain = session_domain
+        self.session_mode = session_mode
+        self.session_cookie_name = session_cookie_name
+        self.session_ttl = session_ttl
+        self.session_revalidate = session_revalidate
 
     def login(self, username, password, success_redirect=None,
         fail_redirect=None):
@@ -236,21 +542,30 @@ class Cork(object):
         :param fail_redirect: redirect unauthorized users (optional)
         :type fail_redirect: str.
         :returns: True for successful logins, else False
+        :raises: HashingBusyException if password hashing is saturated
         """
         assert isinstance(username, str), "the username must be a string"
         assert isinstance(password, str), "the password must be a string"
 
-        if username in self._store.users:
-            if self._verify_password(username, password,
-                    self._store.users[username]['hash']):
+        user_data = self._store.users.get(username)
+        if user_data is not None:
+            if self._verify_password(username, password, user_data['hash']):
+                self._upgrade_hash(username, password, user_data['hash'])
                 # Setup session data
-                self._setup_cookie(username)
+                if self.session_mode == 'cookie':
+                    role_info = self._get_role(user_data['role'])
+                    if role_info is None:
+                        raise AAAException("Role not found for the user")
+                    self._set_session_cookie(username, user_data,
+                                             role_info['level'])
+                else:
+                    self._setup_cookie(username)
                 if success_redirect:
-                    bottle.redirect(success_redirect)
+                    _bottle().redirect(success_redirect)
                 return True
 
         if fail_redirect:
-            bottle.redirect(fail_redirect)
+            _bottle().redirect(fail_redirect)
 
         return False
 
@@ -262,12 +577,18 @@ class Cork(object):
         :param fail_redirect: redirect the user if it is not logged in
         :type fail_redirect: str.
         """
+        if self.session_mode == 'cookie':
+            if self._read_session_cookie() is None:
+                _bottle().redirect(fail_redirect)
+            self._request_cache.pop('current_user', None)
+            self._delete_session_cookie()
+            _bottle().redirect(success_redirect)
         try:
-            session = bottle.request.environ.get('beaker.session')
+            session = _bottle().request.environ.get('beaker.session')
             session.delete()
-            bottle.redirect(success_redirect)
+            _bottle().redirect(success_redirect)
         except:
-            bottle.redirect(fail_redirect)
+            _bottle().redirect(fail_redirect)
 
     def require(self, username=None, company=None, role=None, fixed_role=False,
         fail_redirect=None):
@@ -288,69 +609,60 @@ class Cork(object):
         :param redirect: redirect unauthorized users (optional)
         :type redirect: str.
         """
+        self._requirement(username, company, role, fixed_role,
+                          fail_redirect)()
+
+    def _requirement(self, username=None, company=None, role=None,
+            fixed_role=False, fail_redirect=None, http_errors=False):
+        """Validate the parameters of :meth:`require` and resolve the role
+        level once, e.g. when setting up a route
+
+        :param http_errors: deny access with HTTP 401 or 403 errors instead
+            of raising AuthException, if fail_redirect is unset
+        :type http_errors: bool.
+        :returns: function checking the current user against the
+            requirement
+        :raises: AAAException on invalid parameters
+        """
         # Parameter validation
         if username is not None:
             if username not in self._store.users:
                 raise AAAException("Nonexistent user")
 
-        if fixed_role and role is None:
-            raise AAAException(
-                """A role must be specified if fixed_role has been set""")
-
-        if role is not None and role not in self._store.roles:
-            raise AAAException("Role not found")
-
-        # Authentication
-        try:
-            cu = self.current_user
-        except AAAException:
-            if fail_redirect is None:
-                raise AuthException("Unauthenticated user")
-            else:
-                bottle.redirect(fail_redirect)
-
-        if cu.role not in self._store.roles:
-            raise AAAException("Role not found for the current user")
-
-        if username is not None:
-            if username != self.current_user.username:
-                if fail_redirect is None:
-                    raise AuthException("""Unauthorized access: incorrect
-                        username""")
-                else:
-                    bottle.redirect(fail_redirect)
+        self._check_requirement(fixed_role, role)
 
-        if company is not None and cu.level < 200:
-            if cu.info["company"] != company:
-                if fail_redirect is None:
-                    raise AuthException("""Unauthorized access: user is not
-                        associated with company""")
-                else:
-                    bottle.redirect(fail_redirect)
-
-        if fixed_role:
-            if role == self.current_user.role:
-                return
+        threshold_lvl = None
+        if role is not None:
+            role_info = self._get_role(role)
+            if role_info is None:
+                raise AAAException("Role not found")
+            threshold_lvl = role_info["level"]
+
+        def deny(message, authenticated=True):
+            if fail_redirect is not None:
+                _bottle().redirect(fail_redirect)
+            if http_errors:
+                _bottle().abort(403 if authenticated else 401, message)
+            raise AuthException(message)
+
+        def check():
+            # Authentication
+            try:
+                cu = self.current_user
+            except AAAException:
+                return deny("Unauthenticated user", authenticated=False)
 
-            if fail_redirect is None:
-                raise AuthException("Unauthorized access: incorrect role")
-            else:
-                bottle.redirect(fail_redirect)
+            # signed cookies are checked against the roles on revalidation
+            if self.session_mode != 'cookie' and \
+                    self._get_role(cu.role) is None:
+                raise AAAException("Role not found for the current user")
 
-        else:
-            if role is not None:
-                # Any role with higher level is allowed
-                current_lvl = self._store.roles[self.current_user.role]["level"]
-                threshold_lvl = self._store.roles[role]["level"]
-                if current_lvl >= threshold_lvl:
-                    return
-
-                if fail_redirect is None:
-                    raise AuthException("Unauthorized access: ")
-                else:
-                    bottle.redirect(fail_redirect)
+            denial = self._access_denial(cu, username, company, role,
+                                         fixed_role, threshold_lvl)
+            if denial is not None:
+                return deny(denial)
 
-        return
+        return check
 
     def create_role(self, role, level):
         """Create a new role.
@@ -369,7 +681,9 @@ class Cork(object):
             int(level)
         except ValueError:
             raise AAAException("The level must be numeric.")
-        self._store.roles[role] = {"level": level}
+        if not self._store.roles.insert(role, {"level": level}):
+            raise AAAException("The role is already existing")
+        self._roles_changed()
 
     def delete_role(self, role):
         """Deleta a role.
@@ -382,15 +696,19 @@ class Cork(object):
             raise AuthException("The current user is not authorized to ")
         if role not in self._store.roles:
             raise AAAException("Nonexistent role.")
+        if self._store.role_members.range(prefix=self._member_prefix(role),
+                limit=1):
+            raise AAAException("The role is still assigned to some users.")
         self._store.roles.pop(role)
+        self._roles_changed()
 
     def list_roles(self):
         """List roles.
 
         :returns: (role, role_level) generator (sorted by role)
         """
-        for role in sorted(self._store.roles):
-            yield (role, self._store.roles[role]["level"])
+        for role, level in self._roles().items():
+            yield (role, level)
 
     def create_user(self, username, role, password, company, email_addr=None,
         permissions={}):
@@ -416,18 +734,14 @@ class Cork(object):
             raise AuthException("The current user is not authorized to ")
         if username in self._store.users:
             raise AAAException("User is already existing.")
-        if role not in self._store.roles:
+        if role not in self._roles():
             raise AAAException("Nonexistent user role.")
-        tstamp = int(time())
-        self._store.users[username] = {
-            'role': role,
-            'hash': self._hash(username, password),
-            'email_addr': email_addr,
-            'company': company,
-            'perm': permissions,
-            'validated': True,
-            'creation_date': tstamp
-        }
+        user_data = self._user_data(role, self._hash(username, password),
+                                    email_addr, company, permissions)
+        # created concurrently by another worker
+        if not self._store.users.insert(username, user_data):
+            raise AAAException("User is already existing.")
+        self._index_user(username, user_data)
 
     def delete_user(self, username):
         """Delete a user account.
@@ -443,15 +757,27 @@ class Cork(object):
             raise AAAException("Nonexistent user.")
         self.user(username).delete()
 
-    def list_users(self):
-        """List users.
-
-        :return: (username, role, email_addr, description) generator (sorted by
-        username)
+    def list_users(self, offset=0, limit=None, cursor=None, order='asc',
+        page_size=100):
+        """List users, fetching them one page at a time.
+
+        :param offset: number of users to skip
+        :type offset: int.
+        :param limit: maximum number of users (optional)
+        :type limit: int.
+        :param cursor: only list users following this username (optional)
+        :type cursor: str.
+        :param order: 'asc' or 'desc'
+        :type order: str.
+        :param page_size: number of users fetched per round trip
+        :type page_size: int.
+        :return: (username, validated, role, email_addr, company, permissions)
+            generator (sorted by username)
         """
-        for un in sorted(self._store.users):
-            d = self._store.users[un]
-            yield (un, d['validated'], d['role'], d['email_addr'], d['company'], d['perm'])
+        if order not in ('asc', 'desc'):
+            raise AAAException("The order must be 'asc' or 'desc'.")
+        return self._list_indexed_users(self._store.users, '', cursor, limit,
+            page_size, offset=offset, descending=(order == 'desc'))
 
     @property
     def current_user(self):
@@ -460,22 +786,52 @@ class Cork(object):
         :returns: User() instance, if authenticated
         :raises: AuthException otherwise
         """
+        if self.session_mode == 'cookie':
+            return self._cookie_session_user()
         session = self._beaker_session
         username = session.get('username', None)
         if username is None:
             raise AuthException("Unauthenticated user")
-        if username is not None and username in self._store.users:
-            return User(username, self, session=session)
-        raise AuthException("Unknown user: %s" % username)
+        cache = self._request_cache
+        cu = cache.get('current_user')
+        if cu is not None and cu.username == username:
+            return cu
+        info = self._store.users.get(username)
+        if info is None:
+            raise AuthException("Unknown user: %s" % username)
+        cu = User(username, self, session=session, info=info)
+        cache['current_user'] = cu
+        return cu
 
     def user(self, username):
         """Existing user
 
         :returns: User() instance if the user exist, None otherwise
         """
-        if username is not None and username in self._store.users:
-            return User(username, self)
-        return None
+        cu = self._request_cache.get('current_user')
+        if cu is not None and cu.username == username:
+            return cu
+        if username is None:
+            return None
+        info = self._store.users.get(username)
+        if info is None:
+            return None
+        return User(username, self, info=info)
+
+    def users_bulk(self, usernames):
+        """Existing users, fetched with a single multi-get
+
+        :param usernames: usernames
+        :type usernames: iterable
+        :returns: {username: User()} dict, nonexistent users and users whose
+            role no longer exists are omitted
+        """
+        docs = self._store.users.get_many(set(usernames))
+        roles = self._get_roles(set(d['role'] for d in docs.values()))
+        return dict(
+            (un, User(un, self, info=d, role_info=roles[d['role']]))
+            for un, d in docs.items() if d['role'] in roles
+        )
 
     def register(self, username, password, email_addr, company, role='user',
         max_level=50, subject="Signup confirmation",
@@ -509,36 +865,19 @@ class Cork(object):
         assert isinstance(permissions, dict), "Permissions must be a dictionary"
         if username in self._store.users:
             raise AAAException("User is already existing.")
-        if role not in self._store.roles:
-            raise AAAException("Nonexistent role")
-        if self._store.roles[role]["level"] > max_level:
-            raise AAAException("Unauthorized role")
+        self._check_registration_role(self._roles().level(role), max_level)
 
-        registration_code = uuid.uuid4().hex
-        creation_date = int(time())
+        registration_code, pending = self._new_registration(username, role,
+            self._hash(username, password), email_addr, company, permissions)
 
         if email_template:
-            # send registration email
-            email_text = bottle.template(email_template,
-                username=username,
-                email_addr=email_addr,
-                company=company,
-                role=role,
-                creation_date=creation_date,
-                registration_code=registration_code
-            )
-            self.mailer.send_email(email_addr, subject, email_text)
-
-        # store pending registration
-        self._store.pending_registrations[registration_code] = {
-            'username': username,
-            'role': role,
-            'hash': self._hash(username, password),
-            'email_addr': email_addr,
-            'company': company,
-            'perm': permissions,
-            'creation_date': creation_date,
-        }
+            self._send_registration_email(registration_code, pending,
+                                          subject, email_template)
+
+        if not self.stateless_registration:
+            # store pending registration, expired by the backend
+            self._store.pending_registrations.insert(registration_code,
+                pending, ttl=self.registration_timeout)
 
         return registration_code
 
@@ -549,25 +888,29 @@ class Cork(object):
         :param registration_code: registration code
         :type registration_code: str.
         """
-        try:
-            data = self._store.pending_registrations.pop(registration_code)
-        except KeyError:
-            raise AuthException("Invalid registration code.")
+        data = self._sealed_registration(registration_code)
+        if data is not None:
+            # replay guard: remember the used code until it expires
+            key, entry = self._replay_guard(registration_code)
+            if not self._store.pending_registrations.insert(key, entry,
+                    ttl=self.registration_timeout):
+                raise AuthException("Invalid registration code.")
+        else:
+            try:
+                data = self._store.pending_registrations.pop(
+                    registration_code)
+            except KeyError:
+                raise AuthException("Invalid registration code.")
 
         username = data['username']
         if username in self._store.users:
             raise AAAException("User is already existing.")
 
         # the user data is moved from pending_registrations to _users
-        self._store.users[username] = {
-            'role': data['role'],
-            'hash': data['hash'],
-            'email_addr': data['email_addr'],
-            'company': data['company'],
-            'perm': data['perm'],
-            'validated': False,
-            'creation_date': data['creation_date']
-        }
+        user_data = self._registered_user_data(data)
+        if not self._store.users.insert(username, user_data):
+            raise AAAException("User is already existing.")
+        self._index_user(username, user_data)
         return username
 
     def send_password_reset_email(self, username=None, email_addr=None,
@@ -586,8 +929,8 @@ class Cork(object):
         :type subject: str.
         :param email_template: email template filename
         :type email_template: str.
-        :raises: AAAException on missing username or email_addr,
-            AuthException on incorrect username/email_addr pair
+        :raises: AAAException on missing username, email_addr or
+            secret_keys, AuthException on incorrect username/email_addr pair
         """
         if username is None:
             if email_addr is None:
@@ -595,39 +938,24 @@ class Cork(object):
                     " be specified.")
 
             # only email_addr is specified: fetch the username
-            for k, v in self._store.users.iteritems():
-                if v['email_addr'] == email_addr:
-                    username = k
-                    break
+            username = self._lookup_email(email_addr)
+            if username is None:
                 raise AAAException("Email address not found.")
 
         else:  # username is provided
-            if username not in self._store.users:
-                raise AAAException("Nonexistent user.")
-            if email_addr is None:
-                email_addr = self._store.users[username].get('email_addr', None)
-                if not email_addr:
-                    raise AAAException("Email address not available.")
-            else:
-                # both username and email_addr are provided: check them
-                stored_email_addr = self._store.users[username]['email_addr']
-                if email_addr != stored_email_addr:
-                    raise AuthException("Username/email address pair not found.")
+            email_addr = self._reset_email_addr(email_addr,
+                self._store.users.get(username))
 
         # generate a reset_code token
         reset_code = self._reset_code(username, email_addr)
-
-        # send reset email
-        email_text = bottle.template(email_template,
-            username=username,
-            email_addr=email_addr,
-            reset_code=reset_code
-        )
-        self.mailer.send_email(email_addr, subject, email_text)
+        self._send_reset_email(username, email_addr, reset_code, subject,
+                               email_template)
 
     def reset_password(self, reset_code, password):
         """Validate reset_code and update the account password
-        The username is extracted from the reset_code token
+        The username is extracted from the reset_code token. A token is
+        valid until it expires or the password or email address change:
+        it can be used only once.
 
         :param reset_code: reset token
         :type reset_code: str.
@@ -635,20 +963,71 @@ class Cork(object):
         :type password: str.
         :raises: AuthException for invalid reset tokens, AAAException
         """
-        try:
-            reset_code = b64decode(reset_code)
-            username, email_addr, tstamp, h = reset_code.split(':', 3)
-            tstamp = int(tstamp)
-        except (TypeError, ValueError):
-            raise AuthException("Invalid reset code.")
-        if time() - tstamp > self.password_reset_timeout:
-            raise AuthException("Expired reset code.")
-        if not self._verify_password(username, email_addr, h):
+        username, binding = self._check_reset_code(reset_code)
+        users = self._store.users
+        # the binding is checked against storage even if the table is cached
+        if isinstance(users, CachedTable):
+            users.invalidate(username)
+        info = users.get(username)
+        self._check_reset_binding(binding, info)
+        user = User(username, self, info=info)
+        upsert = user._update_upsert(pwd_hash=self._hash(username, password))
+        # a concurrent use of the same token changes the hash first
+        if not user._write_update(upsert, {'level': user.level},
+                                  expect={('hash',): info['hash']}):
             raise AuthException("Invalid reset code.")
-        user = self.user(username)
-        if user is None:
-            raise AAAException("Nonexistent user.")
-        user.update(pwd=password)
+
+    def users_by_company(self, company, cursor=None, limit=None,
+        page_size=100):
+        """List the users associated with a company, using the company index.
+
+        :param company: company
+        :type company: str.
+        :param cursor: only list users following this username (optional)
+        :type cursor: str.
+        :param limit: maximum number of users (optional)
+        :type limit: int.
+        :param page_size: number of users fetched per round trip
+        :type page_size: int.
+        :return: (username, validated, role, email_addr, company, permissions)
+            generator (sorted by username)
+        """
+        return self._list_indexed_users(self._store.company_members,
+            self._member_prefix(company), cursor, limit, page_size)
+
+    def users_by_role(self, role, cursor=None, limit=None, page_size=100):
+        """List the users having a role, using the role index.
+
+        :param role: role
+        :type role: str.
+        :param cursor: only list users following this username (optional)
+        :type cursor: str.
+        :param limit: maximum number of users (optional)
+        :type limit: int.
+        :param page_size: number of users fetched per round trip
+        :type page_size: int.
+        :return: (username, validated, role, email_addr, company, permissions)
+            generator (sorted by username)
+        """
+        return self._list_indexed_users(self._store.role_members,
+            self._member_prefix(role), cursor, limit, page_size)
+
+    def rebuild_indexes(self):
+        """Add every existing user to the email, company and role indexes.
+        Meant to be run once on databases created before the indexes existed.
+
+        :returns: number of indexed users
+        """
+        count = 0
+        for username, data in self._store.users.items():
+            self._index_user(username, data)
+            count += 1
+        return count
+
+    def connect(self):
+        """Open the storage connections now, e.g. in a worker start-up
+        hook, instead of on the first request"""
+        self._store.connect()
 
     def verify_password(self, username, password):
         return self._verify_password(username, password,
@@ -656,64 +1035,289 @@ class Cork(object):
 
     # # Private methods
 
+    @property
+    def _request_cache(self):
+        """Per-request lookup cache, stored in the WSGI environ.
+        Outside of a request a new, throwaway dict is returned.
+        """
+        try:
+            environ = _bottle().request.environ
+        except RuntimeError:
+            return {}
+        if 'REQUEST_METHOD' not in environ:
+            return {}
+        return environ.setdefault(REQUEST_CACHE_KEY, {})
+
+    def _roles(self):
+        """Roles snapshot. The roles version is checked at most once per
+        `roles_refresh_interval`, the roles are reloaded when it changed.
+        Backends without a meta table are reloaded every interval.
+
+        :returns: RoleTable
+        """
+        table = self._fresh_roles()
+        if table is not None:
+            return table
+        version = self._roles_version()
+        table = self._role_table
+        if self._outdated_roles(version):
+            table = RoleTable.load(self._store.roles, version)
+        return self._set_roles(table)
+
+    def _roles_version(self):
+        """Current roles version, None if unknown"""
+        meta = getattr(self._store, 'meta', None)
+        if meta is None:
+            return None
+        # the version is read from storage even if the table is cached
+        if isinstance(meta, CachedTable):
+            meta.invalidate(ROLES_VERSION_KEY)
+        entry = meta.get(ROLES_VERSION_KEY)
+        if entry is None:
+            return None
+        return entry['version']
+
+    def _roles_changed(self):
+        """Publish a new roles version to every process and drop the local
+        snapshot"""
+        meta = getattr(self._store, 'meta', None)
+        if meta is not None:
+            meta[ROLES_VERSION_KEY] = {'version': new_version()}
+        self._role_table = None
+
+    def _get_role(self, role):
+        """Look up a role in the roles snapshot
+
+        :returns: role dict, or None if the role does not exist
+        """
+        return self._role_info(self._roles(), role)
+
+    def _get_roles(self, names):
+        """Look up multiple roles in the roles snapshot
+
+        :returns: {role: role dict} dict, nonexistent roles are omitted
+        """
+        return self._roles_info(self._roles(), names)
+
+    def _index_user(self, username, data, old=None):
+        """Add a user to the email, company and role indexes.
+        If the previous user data is given, only the changed entries are
+        updated.
+        """
+        for table_name, key, entry in self._index_changes(username, data,
+                                                          old or {}):
+            table = getattr(self._store, table_name)
+            if entry is not None:
+                table[key] = entry
+            elif table_name == 'emails':
+                self._unindex_email(key, username)
+            else:
+                del table[key]
+
+    def _unindex_user(self, username, data):
+        """Remove a user from the email, company and role indexes"""
+        self._index_user(username, {}, old=data)
+
+    def _list_indexed_users(self, index, prefix, cursor, limit, page_size,
+            offset=0, descending=False):
+        """List users from the users table or from a membership index, one
+        page at a time. Index entry names are `prefix` + username.
+        """
+        if cursor is not None:
+            cursor = prefix + cursor
+        remaining = limit
+        while remaining is None or remaining > 0:
+            if remaining is None:
+                count = page_size
+            else:
+                count = min(page_size, remaining)
+            names = index.range(start_after=cursor, limit=count, skip=offset,
+                descending=descending, prefix=prefix or None)
+            offset = 0
+            usernames = [n[len(prefix):] for n in names]
+            docs = self._store.users.get_many(usernames)
+            for un in usernames:
+                d = docs.get(un)
+                if d is None:  # deleted in the meantime
+                    continue
+                yield self._user_row(un, d)
+
+            if len(names) < count:
+                return
+            if remaining is not None:
+                remaining -= len(names)
+            cursor = names[-1]
+
+    def _unindex_email(self, email_addr, username):
+        """Drop an email address from the email index, if it belongs to
+        `username`"""
+        if not email_addr:
+            return
+        entry = self._store.emails.get(email_addr)
+        if entry is not None and entry['username'] == username:
+            del self._store.emails[email_addr]
+
+    def _lookup_email(self, email_addr):
+        """Find the user owning an email address
+
+        :returns: username, or None if not found
+        """
+        entry = self._store.emails.get(email_addr)
+        if entry is None:
+            return None
+        return entry['username']
+
+    def _forget_user(self, username):
+        """Drop a user from the per-request cache"""
+        cache = self._request_cache
+        cu = cache.get('current_user')
+        if cu is not None and cu.username == username:
+            del cache['current_user']
+
     @property
     def _beaker_session(self):
         """Get Beaker session"""
-        return bottle.request.environ.get('beaker.session')
+        return _bottle().request.environ.get('beaker.session')
 
     def _setup_cookie(self, username):
         """Setup cookie for a user that just logged in"""
-        session = bottle.request.environ.get('beaker.session')
+        session = _bottle().request.environ.get('beaker.session')
         session['username'] = username
         if self.session_domain is not None:
             session.domain = self.session_domain
         session.save()
 
-    @staticmethod
-    def _hash(username, pwd, salt=None):
-        """Hash username and password, generating salt value if required
-        Use PBKDF2 from Beaker
-
-        :returns: base-64 encoded str.
-        """
-        if salt is None:
-            salt = os.urandom(32)
-        assert len(salt) == 32, "Incorrect salt length"
+    def _set_session_cookie(self, username, user_data, level,
+            login_time=None):
+        """Issue a signed session cookie, describing the user as of now"""
+        now = int(time())
+        token = self._signer.sign('session', [username, user_data['role'],
+            level, user_data['company'], user_data.get('gen', 0),
+            login_time or now, now], self.session_ttl)
+        _bottle().response.set_cookie(self.session_cookie_name, token,
+            max_age=self.session_ttl, httponly=True, samesite='lax',
+            secure=_bottle().request.urlparts.scheme == 'https',
+            **self._session_cookie_scope())
+
+    def _delete_session_cookie(self):
+        _bottle().response.delete_cookie(self.session_cookie_name,
+                                      **self._session_cookie_scope())
+
+    def _session_cookie_scope(self):
+        scope = {'path': '/'}
+        if self.session_domain is not None:
+            scope['domain'] = self.session_domain
+        return scope
 
-        cleartext = "%s\0%s" % (username, pwd)
-        h = crypto.generateCryptoKeys(cleartext, salt, 10, 32)
-        if len(h) != 32:
-            raise RuntimeError("The PBKDF2 hash is not 32bytes long")
+    def _read_session_cookie(self):
+        """Signed session cookie fields
 
-        # 'p' for PBKDF2
-        return b64encode(b'p' + salt + h).decode("utf-8")
+        :returns: list, or None if missing, forged or expired
+        """
+        token = _bottle().request.get_cookie(self.session_cookie_name)
+        if not token:
+            return None
+        try:
+            return self._signer.verify('session', token)
+        except tokens.InvalidTokenException:
+            return None
+
+    def _cookie_session_user(self):
+        """Current user from the signed session cookie. Storage is read
+        only when the cookie is due for revalidation: the user is then
+        logged out if deleted, if its role is gone or if its generation
+        changed, e.g. after a password change. Role, level and company
+        are refreshed.
+
+        :returns: SessionUser instance
+        :raises: AuthException for unauthenticated users
+        """
+        cache = self._request_cache
+        cu = cache.get('current_user')
+        if cu is not None:
+            return cu
+        fields = self._read_session_cookie()
+        if fields is None:
+            raise AuthException("Unauthenticated user")
+        username, role, level, company, gen, login_time, checked = fields
+        if time() - checked >= self.session_revalidate:
+            info = self._store.users.get(username)
+            role_info = info and self._get_role(info['role'])
+            if not role_info or info.get('gen', 0) != gen:
+                self._delete_session_cookie()
+                raise AuthException("Unauthenticated user")
+            self._set_session_cookie(username, info, role_info['level'],
+                                     login_time)
+            role, level, company = info['role'], role_info['level'], \
+                info['company']
+        cu = SessionUser(username, self, role, level, company, login_time)
+        cache['current_user'] = cu
+        return cu
+
+    def _session_user_updated(self, user):
+        """Reissue the signed session cookie if `user` is the current one,
+        keeping its session valid after a change"""
+        if self.session_mode != 'cookie':
+            return
+        cu = self._request_cache.get('current_user')
+        if cu is None or cu.username != user.username:
+            return
+        fields = self._read_session_cookie()
+        if fields is not None:
+            self._set_session_cookie(user.username, user.info, user.level,
+                                     fields[5])
+
+    def _hash(self, username, pwd, salt=None):
+        """Hash username and password with the current hashing policy,
+        generating salt value if required
+
+        :returns: str.
+        """
+        return self._hashing.run(self.password_hasher.hash,
+                                 self._cleartext(username, pwd), salt)
 
-    @classmethod
-    def _verify_password(cls, username, pwd, salted_hash):
-        """Verity username/password pair against a salted hash
+    def _verify_password(self, username, pwd, salted_hash):
+        """Verity username/password pair against a salted hash, whatever its
+        hashing scheme
 
         :returns: bool
         """
-        decoded = b64decode(salted_hash)
-        hash_type = chr(decoded[0])
-        if hash_type != 'p':  # 'p' for PBKDF2
-            return False  # Only PBKDF2 is supported
-
-        salt = decoded[1:33]
-        return cls._hash(username, pwd, salt) == salted_hash
+        return self._hashing.run(hashing.verify_password,
+                                 self._cleartext(username, pwd), salted_hash)
+
+    def _upgrade_hash(self, username, pwd, salted_hash):
+        """Rehash a verified password if its hash does not follow the current
+        hashing policy"""
+        if not self.password_hasher.needs_rehash(salted_hash):
+            return
+        try:
+            self._store.users.mutate(username,
+                upsert={('hash',): self._hash(username, pwd)})
+        except KeyError:  # deleted in the meantime
+            pass
 
-    def _purge_expired_registrations(self, exp_time=96):
+    def _purge_expired_registrations(self, exp_time=None):
         """Purge expired registration requests.
+        Registrations expire on their own: this only deletes the expired
+        entries still stored by backends emulating expiry.
+        Registrations stored without expiry, e.g. by older releases, are
+        purged by setting `exp_time`, at the cost of a full table scan.
 
-        :param exp_time: expiration time (hours)
+        :param exp_time: expiration time (hours) of the registrations
+            stored without expiry (optional)
         :type exp_time: float.
+        :returns: number of purged registrations
         """
-        for uuid, data in self._store.pending_registrations.items():
-            creation = data['creation_date']
-            now = int(time())
-            maxdelta = (exp_time * 60 * 60)
-            if now - creation > maxdelta:
-                self._store.pending_registrations.pop(uuid)
+        count = self._store.pending_registrations.purge_expired()
+        if exp_time is None:
+            return count
+        now = int(time())
+        maxdelta = (exp_time * 60 * 60)
+        for code, data in self._store.pending_registrations.items():
+            if now - data['creation_date'] >= maxdelta:
+                self._store.pending_registrations.pop(code)
+                count += 1
+        return count
 
     def _reset_code(self, username, email_addr):
         """generate a reset_code token
@@ -722,16 +1326,87 @@ class Cork(object):
         :type username: str.
         :param email_addr: email address
         :type email_addr: str.
-        :returns: Base-64 encoded token
+        :returns: signed, URL-safe token
+        :raises: AAAException for nonexistent users
+        """
+        user_data = self._store.users.get(username)
+        if user_data is None:
+            raise AAAException("Nonexistent user.")
+        return self._sign_reset_code(username, user_data)
+
+class BaseUser(object):
+    """User attributes and update logic shared by :class:`User` and
+    :class:`cork.aiocork.AsyncUser`"""
+
+    def _load_attributes(self, role_info):
+        self.company = self.info['company']
+        self.email_addr = self.info['email_addr']
+        self.permissions = self.info['perm']
+        self.role = self.info['role']
+        self.level = role_info['level']
+
+    def _load_session(self, session):
+        """Set the session-related attributes"""
+        try:
+            self.session_creation_time = session['_creation_time']
+            self.session_accessed_time = session['_accessed_time']
+            self.session_id = session['_id']
+        except KeyError:
+            pass
+
+    def _update_upsert(self, role=None, pwd_hash=None, email_addr=None,
+            validated=None, permissions=None, company=None):
+        """Fields changed by an account update, see :meth:`User.update`
+
+        :returns: upsert dict, as taken by Table.mutate
+        """
+        upsert = {}
+        if role is not None:
+            upsert[('role',)] = role
+        if pwd_hash is not None:
+            upsert[('hash',)] = pwd_hash
+        if email_addr is not None:
+            upsert[('email_addr',)] = email_addr
+        if permissions is not None:
+            assert isinstance(permissions, dict), "Permissions must be a dictionary"
+            for perm, value in permissions.items():
+                upsert[('perm', perm)] = value
+        if validated is not None:
+            upsert[('validated',)] = True
+        if company is not None:
+            upsert[('company',)] = company
+        return upsert
+
+    @staticmethod
+    def _update_increment(upsert):
+        """Counters bumped by an account update, see :meth:`User.update`
+
+        :returns: increment dict, as taken by Table.mutate
+        """
+        if ('hash',) in upsert:
+            # sessions in signed cookies issued before are dropped
+            return {('gen',): 1}
+        return {}
+
+    def _updated(self, upsert, increment, role_info):
+        """Apply a stored account update to the user attributes
+
+        :returns: the previous user data
         """
-        h = self._hash(username, email_addr)
-        t = "%d" % time()
-        reset_code = ':'.join((username, email_addr, t, h))
-        return b64encode(reset_code)
+        old = self.info
+        self.info = apply_mutations(deepcopy(old), upsert, increment=increment)
+        self._load_attributes(role_info)
+        return old
 
-class User(object):
+    def _permissions_removed(self, remove):
+        """Apply a stored permissions removal to the user attributes"""
+        apply_mutations(self.info, remove=remove)
+        self._load_attributes({'level': self.level})
 
-    def __init__(self, username, cork_obj, session=None):
+class User(BaseUser):
+
+    def __init__(self, username, cork_obj, session=None, info=None,
+            role_info=None):
         """Represent an authenticated user, exposing useful attributes:
         username, role, level, session_creation_time, session_accessed_time,
         session_id. The session-related attributes are available for the
@@ -740,28 +1415,23 @@ class User(object):
         :param username: username
         :type username: str.
         :param cork_obj: instance of :class:`Cork`
+        :param info: user data, if already fetched
+        :type info: dict
+        :param role_info: role data, if already fetched
+        :type role_info: dict
         """
         self._cork = cork_obj
-        assert username in self._cork._store.users, "Unknown user"
+        if info is None:
+            info = self._cork._store.users.get(username)
+        assert info is not None, "Unknown user"
         self.username = username
-        self.info = self._cork._store.users[username]
-        self.__load_attributes()
+        self.info = info
+        if role_info is None:
+            role_info = self._cork._get_role(info['role'])
+        self._load_attributes(role_info)
 
         if session is not None:
-            try:
-                self.session_creation_time = session['_creation_time']
-                self.session_accessed_time = session['_accessed_time']
-                self.session_id = session['_id']
-            except:
-                pass
-
-    def __load_attributes(self):
-        self.company = self.info['company']
-        self.permissions = self.info['perm']
-        self.email_addr = self.info['email_addr']
-        self.permissions = self.info["perm"]
-        self.role = self.info['role']
-        self.level = self._cork._store.roles[self.role]["level"]
+            self._load_session(session)
 
     def update(self, role=None, pwd=None, email_addr=None, validated=None, permissions=None, company=None):
         """Update an user account data
@@ -777,30 +1447,41 @@ class User(object):
         :raises: AAAException on nonexistent user or role.
         """
         username = self.username
-        if username not in self._cork._store.users:
-            raise AAAException("User does not exist.")
-
-        user_obj = self._cork._store.users[username]
-
+        role_info = {'level': self.level}
         if role is not None:
-            if role not in self._cork._store.roles:
+            role_info = self._cork._get_role(role)
+            if role_info is None:
                 raise AAAException("Nonexistent role.")
-            user_obj['role'] = role
+        pwd_hash = None
         if pwd is not None:
-            user_obj['hash'] = self._cork._hash(username, pwd)
-        if email_addr is not None:
-            user_obj['email_addr'] = email_addr
-        if permissions is not None:
-            assert isinstance(permissions, dict), "Permissions must be a dictionary"
-            user_obj['perm'].update(permissions)
-        if validated is not None:
-            user_obj['validated'] = True
-        if company is not None:
-            user_obj['company'] = company
+            pwd_hash = self._cork._hash(username, pwd)
+        upsert = self._update_upsert(role, pwd_hash, email_addr, validated,
+                                     permissions, company)
+        self._write_update(upsert, role_info)
 
-        self.info = user_obj
-        self.__load_attributes()
-        self._cork._store.users[username] = user_obj
+    def _write_update(self, upsert, role_info, expect=None):
+        """Write the fields changed by an update, see :meth:`update`
+
+        :returns: False if the stored user did not have the `expect` fields,
+            True otherwise
+        :raises: AAAException on nonexistent user
+        """
+        username = self.username
+        increment = self._update_increment(upsert)
+        # session users load their data on first access: before the change
+        old = self.info
+        # only the changed fields are written
+        try:
+            if not self._cork._store.users.mutate(username, upsert=upsert,
+                    expect=expect, increment=increment):
+                return False
+        except KeyError:
+            raise AAAException("User does not exist.")
+
+        self._updated(upsert, increment, role_info)
+        self._cork._index_user(username, self.info, old=old)
+        self._cork._session_user_updated(self)
+        return True
 
     def remove_permissions(self, permissions):
         """Remove permissions from a user account data
@@ -811,21 +1492,13 @@ class User(object):
         """
         assert isinstance(permissions, list), "Permissions must be list"
 
-        username = self.username
-        if username not in self._cork._store.users:
+        remove = [('perm', perm) for perm in permissions]
+        try:
+            self._cork._store.users.mutate(self.username, remove=remove)
+        except KeyError:
             raise AAAException("User does not exist.")
 
-        user_obj = self._cork._store.users[username]
-
-        for perm in permissions:
-            try:
-                del user_obj["perm"][perm]
-            except:
-                pass
-
-        self.info = user_obj
-        self.__load_attributes()
-        self._cork._store.users[username] = user_obj
+        self._permissions_removed(remove)
 
     def delete(self):
         """Delete user account
@@ -833,9 +1506,41 @@ class User(object):
         :raises: AAAException on nonexistent user.
         """
         try:
-            self._cork._store.users.pop(self.username)
+            data = self._cork._store.users.pop(self.username)
         except KeyError:
             raise AAAException("Nonexistent user.")
+        self._cork._unindex_user(self.username, data)
+        self._cork._forget_user(self.username)
+
+class SessionUser(User):
+
+    def __init__(self, username, cork_obj, role, level, company,
+            session_creation_time):
+        """Current user as described by a signed session cookie. username,
+        role, level, company and session_creation_time come from the
+        cookie; the other attributes are fetched on first access.
+
+        :param username: username
+        :type username: str.
+        :param cork_obj: instance of :class:`Cork`
+        """
+        self._cork = cork_obj
+        self.username = username
+        self.role = role
+        self.level = level
+        self.company = company
+        self.session_creation_time = session_creation_time
+
+    def __getattr__(self, name):
+        if name not in ('info', 'email_addr', 'permissions'):
+            raise AttributeError(name)
+        info = self._cork._store.users.get(self.username)
+        if info is None:
+            raise AuthException("Unknown user: %s" % self.username)
+        self.info = info
+        self.email_addr = info['email_addr']
+        self.permissions = info['perm']
+        return getattr(self, name)
 
 class Mailer(object):
 
@@ -899,6 +1604,8 @@ class Mailer(object):
         :type email_text: str.
         :raises: AAAException if smtp_server and/or sender are not set
         """
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
         if not (self._conf['fqdn'] and self.sender):
             raise AAAException("SMTP server or sender not set")
         msg = MIMEMultipart('alternative')
@@ -921,6 +1628,7 @@ class Mailer(object):
         :param msg: email text
         :type msg: str.
         """
+        from smtplib import SMTP, SMTP_SSL
         proto = self._conf['proto']
         assert proto in ('smtp', 'starttls', 'ssl'), \
             "Incorrect protocol: %s" % proto
@@ -0,0 +1,555 @@
+# Cork - Authentication module for the Bottle web framework
+# Copyright (C) 2012 Federico Ceratto
+#
+# This package is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This package is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Couchbase storage backend
+
+from contextlib import contextmanager
+from logging import getLogger
+from threading import Lock
+import os
+
+from .base_backend import (Backend, BackendIOException, CachedTable,
+    ConcurrentUpdateException, Table, apply_mutations, matches)
+
+log = getLogger(__name__)
+
+COUCHBASE_ENTRY_DESIGN_DOC = "admin"
+COUCHBASE_ENTRY_VIEW = "keys_by_table"
+# prefix of the per-table entry counter documents
+COUCHBASE_COUNTER_PREFIX = "_count"
+# maximum number of operations in a sub-document request
+COUCHBASE_MAX_SUBDOC_SPECS = 16
+
+
+@contextmanager
+def _translate_errors(item=None):
+    """Turn Couchbase SDK errors into KeyError or BackendIOException"""
+    from couchbase.exceptions import (CouchbaseException,
+        DocumentNotFoundException)
+    try:
+        yield
+    except DocumentNotFoundException:
+        raise KeyError(item)
+    except CouchbaseException as e:
+        raise BackendIOException("Couchbase error on %r: %s" % (item, e))
+
+
+# process-wide registry: (db_host, db_bucket) -> (pid, cluster, bucket,
+# default collection)
+_buckets = {}
+_buckets_lock = Lock()
+
+
+def _reset_buckets():
+    """Drop the connections inherited from the parent process"""
+    global _buckets_lock
+    _buckets.clear()
+    _buckets_lock = Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_buckets)
+
+
+def _open_bucket(db_host, db_password, db_bucket):
+    """Connect to a cluster and open a bucket
+
+    :returns: (cluster, bucket) tuple
+    """
+    from couchbase.auth import PasswordAuthenticator
+    from couchbase.cluster import Cluster
+    from couchbase.options import ClusterOptions
+    with _translate_errors():
+        cluster = Cluster('couchbase://{0}'.format(db_host),
+            ClusterOptions(PasswordAuthenticator(db_bucket, db_password)))
+        return cluster, cluster.bucket(db_bucket)
+
+
+class SharedBucket(object):
+
+    def __init__(self, db_host, db_password, db_bucket):
+        """Handle on a bucket from the process-wide registry, connected on
+        first use. Every handle on the same host and bucket shares one
+        cluster connection. A forked process opens its own connection.
+
+        :param db_host: hostname of couchbase server to use
+        :type db_host: str.
+        :param db_password: password used to log into couchbase server
+        :type db_password: str.
+        :param db_bucket: couchbase bucket that contains the data
+        :type db_bucket: str.
+        """
+        self.db_host = db_host
+        self.db_bucket = db_bucket
+        self._db_password = db_password
+
+    def _entry(self):
+        key = (self.db_host, self.db_bucket)
+        pid = os.getpid()
+        entry = _buckets.get(key)
+        if entry is not None and entry[0] == pid:
+            return entry
+        with _buckets_lock:
+            entry = _buckets.get(key)
+            if entry is None or entry[0] != pid:
+                cluster, bucket = _open_bucket(self.db_host,
+                    self._db_password, self.db_bucket)
+                entry = (pid, cluster, bucket, bucket.default_collection())
+                _buckets[key] = entry
+        return entry
+
+    def connect(self):
+        """Open the connection now instead of on first use
+
+        :returns: couchbase Bucket
+        """
+        return self._entry()[2]
+
+    def default_collection(self):
+        return self._entry()[3]
+
+    def view_query(self, *args, **kwargs):
+        return self._entry()[2].view_query(*args, **kwargs)
+
+
+class _CouchbaseNames(object):
+    """Document naming and view queries shared by the synchronous and the
+    asyncio Couchbase tables"""
+
+    def _get_entry_key(self, item):
+        return "%s:%s" % (self.table_name, item)
+
+    def _get_item_name(self, entry_key):
+        return entry_key[len(self.table_name) + 1:]
+
+    def _get_counter_key(self):
+        return "%s:%s" % (COUCHBASE_COUNTER_PREFIX, self.table_name)
+
+    @staticmethod
+    def _get_subdoc_path(path):
+        """Sub-document path, with every component quoted"""
+        return '.'.join('`%s`' % k.replace('`', '``') for k in path)
+
+    def _view_options(self, start_after, limit, skip, descending, prefix):
+        """ViewOptions selecting a range of the table entries"""
+        from couchbase.options import ViewOptions
+        from couchbase.views import ViewOrdering
+        opts = dict(startkey=self.table_name, endkey=self.table_name,
+                    reduce=False, skip=skip)
+        if prefix is not None:
+            first = self._get_entry_key(prefix)
+            last = self._get_entry_key(prefix + u'\uffff')
+            if descending:
+                first, last = last, first
+            opts['startkey_docid'] = first
+            opts['endkey_docid'] = last
+        if descending:
+            opts['order'] = ViewOrdering.DESCENDING
+        if start_after is not None:
+            # startkey_docid is inclusive and the cursor entry may be gone:
+            # fetch one more row, skip and limit are applied by _trim_page
+            opts['startkey_docid'] = self._get_entry_key(start_after)
+            opts['skip'] = 0
+            if limit is not None:
+                limit = skip + limit + 1
+        if limit is not None:
+            opts['limit'] = limit
+        return ViewOptions(**opts)
+
+    @staticmethod
+    def _trim_page(names, start_after, limit, skip):
+        """Drop the cursor row fetched by an inclusive view query, if the
+        cursor entry still exists, then apply skip and limit"""
+        if start_after is None:
+            return names
+        if names and names[0] == start_after:
+            names = names[1:]
+        names = names[skip:]
+        if limit is not None:
+            names = names[:limit]
+        return names
+
+    def _insert_options(self, ttl):
+        """InsertOptions setting the document expiry, if any"""
+        if ttl is None:
+            return ()
+        if not self.expiring:
+            raise ValueError("The %s table does not support expiry"
+                             % self.table_name)
+        from datetime import timedelta
+        from couchbase.options import InsertOptions
+        return (InsertOptions(expiry=timedelta(seconds=ttl)),)
+
+
+class CouchbaseTable(_CouchbaseNames, Table):
+    def __init__(self, bucket, table_name, page_size=100, cas_retries=10,
+            expiring=False):
+        """ Wrapper class to manage a table of couchbase entries.
+        The server deletes expired entries on its own, without updating the
+        entry counter: expiring tables keep no counter and are counted from
+        the view instead.
+
+        :param bucket: couchbase Bucket
+        :type bucket: couchbase.bucket.Bucket or SharedBucket
+        :param table_name: the name (aka prefix) of the table entries
+        :type table_name: str.
+        :param page_size: number of entries fetched per round trip when
+            iterating over the table
+        :type page_size: int.
+        :param cas_retries: number of attempts of a compare-and-swap write
+            before giving up on conflicts
+        :type cas_retries: int.
+        :param expiring: support entry expiry
+        :type expiring: bool.
+        """
+        self.bucket = bucket
+        self.table_name = table_name
+        self.page_size = page_size
+        self.cas_retries = cas_retries
+        self.expiring = expiring
+
+    @property
+    def client(self):
+        return self.bucket.default_collection()
+
+    def __contains__(self, item):
+        with _translate_errors(item):
+            result = self.client.exists(self._get_entry_key(item))
+        return result.exists
+
+    def __getitem__(self, item):
+        with _translate_errors(item):
+            result = self.client.get(self._get_entry_key(item))
+        return result.content_as[dict]
+
+    def get(self, item, default=None):
+        """Fetch an entry with a single round trip
+
+        :returns: the entry, or `default` if it does not exist
+        """
+        try:
+            return self[item]
+        except KeyError:
+            return default
+
+    def get_many(self, items):
+        """Fetch multiple entries with a single multi-get
+
+        :param items: entry names
+        :type items: iterable
+        :returns: {name: entry} dict, nonexistent entries are omitted
+        """
+        from couchbase.exceptions import DocumentNotFoundException
+        entry_keys = dict((self._get_entry_key(i), i) for i in items)
+        if not entry_keys:
+            return {}
+        with _translate_errors():
+            response = self.client.get_multi(list(entry_keys),
+                                             return_exceptions=True)
+        for k, e in (response.exceptions or {}).items():
+            if not isinstance(e, DocumentNotFoundException):
+                raise BackendIOException("Couchbase error on %r: %s"
+                                         % (entry_keys[k], e))
+        return dict((entry_keys[k], r.content_as[dict])
+                    for k, r in response.results.items())
+
+    def __setitem__(self, key, value):
+        from couchbase.exceptions import DocumentNotFoundException
+        entry_key = self._get_entry_key(key)
+        with _translate_errors(key):
+            try:
+                self.client.replace(entry_key, value)
+            except DocumentNotFoundException:
+                if not self.insert(key, value):
+                    # inserted concurrently
+                    self.client.replace(entry_key, value)
+
+    def insert(self, key, value, ttl=None):
+        """Create an entry. The expiry is handled natively by the server."""
+        from couchbase.exceptions import DocumentExistsException
+        with _translate_errors(key):
+            try:
+                self.client.insert(self._get_entry_key(key), value,
+                                   *self._insert_options(ttl))
+            except DocumentExistsException:
+                return False
+        self._update_count(1)
+        return True
+
+    def __delitem__(self, item):
+        try:
+            with _translate_errors(item):
+                self.client.remove(self._get_entry_key(item))
+        except KeyError:
+            return
+        self._update_count(-1)
+
+    def pop(self, item):
+        from couchbase.exceptions import CasMismatchException
+        from couchbase.options import RemoveOptions
+        entry_key = self._get_entry_key(item)
+        for attempt in range(self.cas_retries):
+            with _translate_errors(item):
+                result = self.client.get(entry_key)
+                try:
+                    # only remove the version being returned
+                    self.client.remove(entry_key, RemoveOptions(cas=result.cas))
+                except CasMismatchException:
+                    continue
+            self._update_count(-1)
+            return result.content_as[dict]
+        raise ConcurrentUpdateException("Too many concurrent updates on %r"
+                                        % item)
+
+    def mutate(self, item, upsert=None, remove=(), expect=None,
+            increment=None):
+        """Change some fields of an entry using sub-document operations:
+        only the changed paths are sent over the wire.
+        Removals are checked and applied against the same document version,
+        retrying on concurrent changes.
+        Changes exceeding the size of a sub-document request, or expecting
+        some field values, replace the whole document instead, see
+        :meth:`_replace_mutated`.
+        """
+        import couchbase.subdocument as SD
+        from couchbase.exceptions import CasMismatchException
+        from couchbase.options import MutateInOptions
+        upsert = upsert or {}
+        increment = increment or {}
+        if expect or len(upsert) + len(remove) + len(increment) > \
+                COUCHBASE_MAX_SUBDOC_SPECS:
+            return self._replace_mutated(item, upsert, remove, expect,
+                                         increment)
+        entry_key = self._get_entry_key(item)
+        upserts = [SD.upsert(self._get_subdoc_path(path), value,
+                             create_parents=True)
+                   for path, value in upsert.items()]
+        # counters are incremented server side, without reading them first
+        upserts += [SD.counter(self._get_subdoc_path(path), delta,
+                               create_parents=True)
+                    for path, delta in increment.items()]
+        remove = [self._get_subdoc_path(path) for path in remove]
+        if not remove:
+            # plain upserts cannot conflict with concurrent writers
+            with _translate_errors(item):
+                self.client.mutate_in(entry_key, upserts)
+            return True
+
+        for attempt in range(self.cas_retries):
+            with _translate_errors(item):
+                # removing a missing path would fail the whole mutation
+                found = self.client.lookup_in(entry_key,
+                    [SD.exists(p) for p in remove])
+                specs = upserts + [SD.remove(p) for n, p in enumerate(remove)
+                                   if found.exists(n)]
+                if not specs:
+                    return True
+                try:
+                    self.client.mutate_in(entry_key, specs,
+                                          MutateInOptions(cas=found.cas))
+                except CasMismatchException:
+                    continue
+            return True
+        raise ConcurrentUpdateException("Too many concurrent updates on %r"
+                                        % item)
+
+    def _replace_mutated(self, item, upsert, remove, expect=None,
+            increment=None):
+        """Apply changes too large for a single sub-document request, or
+        expecting some field values, by replacing the whole document,
+        retrying on concurrent changes: the changes are applied atomically
+        either way.
+
+        :returns: False if the entry did not have the `expect` fields, True
+            otherwise
+        """
+        from couchbase.exceptions import CasMismatchException
+        from couchbase.options import ReplaceOptions
+        entry_key = self._get_entry_key(item)
+        for attempt in range(self.cas_retries):
+            with _translate_errors(item):
+                result = self.client.get(entry_key)
+                entry = result.content_as[dict]
+                if not matches(entry, expect):
+                    return False
+                apply_mutations(entry, upsert, remove, increment)
+                try:
+                    self.client.replace(entry_key, entry,
+                                        ReplaceOptions(cas=result.cas))
+                except CasMismatchException:
+                    continue
+            return True
+        raise ConcurrentUpdateException("Too many concurrent updates on %r"
+                                        % item)
+
+    def _update_count(self, delta):
+        """Atomically add `delta` to the entry counter. A missing counter is
+        not created here: it is rebuilt by the next len() call.
+        """
+        if self.expiring:
+            return
+        from couchbase.options import (DecrementOptions, DeltaValue,
+            IncrementOptions, SignedInt64)
+        from couchbase.exceptions import CouchbaseException
+        binary = self.client.binary()
+        try:
+            if delta > 0:
+                binary.increment(self._get_counter_key(), IncrementOptions(
+                    delta=DeltaValue(delta), initial=SignedInt64(-1)))
+            else:
+                binary.decrement(self._get_counter_key(), DecrementOptions(
+                    delta=DeltaValue(-delta), initial=SignedInt64(-1)))
+        except CouchbaseException as e:
+            # the counter is rebuilt by the next reconcile
+            log.debug("Unable to update the %s counter: %s",
+                      self.table_name, e)
+
+    def reconcile_count(self):
+        """Recount the table entries from the view and store the result in
+        the entry counter
+
+        :returns: number of entries
+        """
+        count = sum(len(names) for names in self._iter_pages())
+        if self.expiring:
+            return count
+        with _translate_errors():
+            self.client.upsert(self._get_counter_key(), count)
+        return count
+
+    def range(self, start_after=None, limit=None, skip=0, descending=False,
+            prefix=None):
+        """List entry names in order, one page at a time
+
+        :param start_after: cursor: only list names following this one
+        :type start_after: str.
+        :param limit: maximum number of names (optional)
+        :type limit: int.
+        :param skip: number of names to skip
+        :type skip: int.
+        :param descending: list names in descending order
+        :type descending: bool.
+        :param prefix: only list names starting with this prefix (optional)
+        :type prefix: str.
+        :returns: list of names
+        """
+        opts = self._view_options(start_after, limit, skip, descending, prefix)
+        with _translate_errors():
+            rows = self.bucket.view_query(COUCHBASE_ENTRY_DESIGN_DOC,
+                COUCHBASE_ENTRY_VIEW, opts).rows()
+            names = [self._get_item_name(r.id) for r in rows]
+        return self._trim_page(names, start_after, limit, skip)
+
+    def _iter_pages(self):
+        """Walk the table view, yielding lists of up to `page_size` names"""
+        cursor = None
+        while True:
+            names = self.range(start_after=cursor, limit=self.page_size)
+            if names:
+                yield names
+            if len(names) < self.page_size:
+                return
+            cursor = names[-1]
+
+    def __iter__(self):
+        for names in self._iter_pages():
+            for name in names:
+                yield name
+
+    def __len__(self):
+        if self.expiring:
+            return self.reconcile_count()
+        try:
+            with _translate_errors():
+                result = self.client.get(self._get_counter_key())
+        except KeyError:
+            return self.reconcile_count()
+        return result.content_as[int]
+
+    def items(self):
+        for names in self._iter_pages():
+            entries = self.get_many(names)
+            for name in names:
+                if name in entries:
+                    yield name, entries[name]
+
+    iteritems = items
+
+
+class CouchbaseBackend(Backend):
+
+    def __init__(self, db_host='localhost', db_password='', db_bucket='default', users_table_name='User',
+            roles_table_name='Role', pending_reg_table_name='Register',
+            cache_size=0, users_cache_ttl=30, roles_cache_ttl=3600,
+            page_size=100, email_index_table_name='Email',
+            company_index_table_name='UserByCompany',
+            role_index_table_name='UserByRole', meta_table_name='Meta'):
+        """Data storage class. Handles JSON Docs in Couchbase.
+        The cluster connection is opened on first use, or by
+        :meth:`connect`, and is shared by every backend using the same host
+        and bucket in the current process.
+
+        :param db_host: hostname of couchbase server to use
+        :type db_host: str.
+        :param db_password: password used to log into couchbase server
+        :type db_password: str.
+        :param db_bucket: couchbase bucket that contains the data
+        :type db_bucket: str.
+        :param users_table_name: prefix for user keys
+        :type users_table_name: str.
+        :param roles_table_name: prefix for role keys
+        :type roles_table_name: str.
+        :param pending_reg_table_name: prefix for pending registration keys
+        :type pending_reg_table_name: str.
+        :param cache_size: per-table size of the process-local users and roles
+            cache, 0 to disable caching
+        :type cache_size: int.
+        :param users_cache_ttl: users cache time-to-live (seconds)
+        :type users_cache_ttl: float.
+        :param roles_cache_ttl: roles cache time-to-live (seconds)
+        :type roles_cache_ttl: float.
+        :param page_size: number of entries fetched per round trip when
+            iterating over a table
+        :type page_size: int.
+        :param email_index_table_name: prefix for email address index keys
+        :type email_index_table_name: str.
+        :param company_index_table_name: prefix for company membership keys
+        :type company_index_table_name: str.
+        :param role_index_table_name: prefix for role membership keys
+        :type role_index_table_name: str.
+        :param meta_table_name: prefix for metadata keys, e.g. the roles
+            version
+        :type meta_table_name: str.
+        """
+        bucket = SharedBucket(db_host, db_password, db_bucket)
+        self.bucket = bucket
+        self.users = CouchbaseTable(bucket, users_table_name, page_size)
+        self.roles = CouchbaseTable(bucket, roles_table_name, page_size)
+        self.pending_registrations = CouchbaseTable(bucket,
+            pending_reg_table_name, page_size, expiring=True)
+        self.emails = CouchbaseTable(bucket, email_index_table_name, page_size)
+        self.company_members = CouchbaseTable(bucket, company_index_table_name,
+            page_size)
+        self.role_members = CouchbaseTable(bucket, role_index_table_name,
+            page_size)
+        self.meta = CouchbaseTable(bucket, meta_table_name, page_size)
+        if cache_size:
+            self.users = CachedTable(self.users, cache_size, users_cache_ttl)
+            self.roles = CachedTable(self.roles, cache_size, roles_cache_ttl)
+
+    def connect(self):
+        """Open the cluster connection now, e.g. when a worker starts,
+        instead of on the first request"""
+        self.bucket.connect()
@@ -0,0 +1,28 @@
+# Cork - Authentication module for the Bottle web framework
+# Copyright (C) 2012 Federico Ceratto
+#
+# This package is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This package is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Exception base classes, importable by every module without import cycles.
+# They are also exposed by cork.cork and by the cork package.
+
+
+class AAAException(Exception):
+    """Generic Authentication/Authorization Exception"""
+    pass
+
+
+class AuthException(AAAException):
+    """Authentication Exception: incorrect username/password pair"""
+    pass
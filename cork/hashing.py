@@ -0,0 +1,343 @@
+# Cork - Authentication module for the Bottle web framework
+# Copyright (C) 2012 Federico Ceratto
+#
+# This package is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This package is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Password hashing schemes
+#
+# Hashes are stored as "$<scheme>$<parameters>$<salt>$<hash>", salt and hash
+# being base64 encoded: the scheme and its cost are read back from the
+# stored hash, so the hashing policy can change at any time. Hashes created
+# by older releases (base64 encoded 'p' + salt + PBKDF2-SHA1 with 10
+# iterations) are still verified.
+
+from base64 import b64decode, b64encode
+from logging import getLogger
+import hashlib
+import hmac
+import os
+import threading
+
+from .exceptions import AAAException
+
+log = getLogger(__name__)
+
+# scheme name -> Hasher subclass
+hashers = {}
+
+
+def register_hasher(cls):
+    """Register a Hasher subclass under its scheme name. Usable as a class
+    decorator."""
+    hashers[cls.name] = cls
+    return cls
+
+
+def get_hasher(hasher=None):
+    """Hashing policy
+
+    :param hasher: Hasher instance, registered scheme name or None for the
+        default policy
+    :returns: Hasher instance
+    """
+    if hasher is None:
+        return PBKDF2Hasher()
+    if isinstance(hasher, Hasher):
+        return hasher
+    try:
+        return hashers[hasher]()
+    except KeyError:
+        raise ValueError("Unknown password hashing scheme: %s" % hasher)
+
+
+def identify(encoded):
+    """Scheme name of a stored hash"""
+    if encoded.startswith('$'):
+        return encoded.split('$', 2)[1]
+    return LegacyHasher.name
+
+
+def verify_password(cleartext, encoded):
+    """Verify a cleartext against a stored hash, whatever its scheme
+
+    :type cleartext: bytes
+    :type encoded: str.
+    :returns: bool
+    """
+    cls = hashers.get(identify(encoded))
+    if cls is None:
+        return False
+    return cls.verify(cleartext, encoded)
+
+
+class HashingBusyException(AAAException):
+    """No hashing slot freed up within the queue timeout"""
+    pass
+
+
+class HashingPool(object):
+
+    def __init__(self, executor=None, concurrency=None, queue_timeout=10):
+        """Run password hashing, optionally in an executor, with a limit on
+        the number of hashes computed at the same time.
+        Each login computes one hash: with the default policy, PBKDF2 with
+        90000 iterations, that is about 40 ms of CPU time on a current core,
+        i.e. roughly 25 logins per second and per core. Size
+        `concurrency` to the number of cores dedicated to hashing: hashes
+        over that number only queue up.
+
+        :param executor: concurrent.futures executor, e.g. a
+            ProcessPoolExecutor or a ThreadPoolExecutor (the hashlib based
+            schemes release the GIL). None to hash in the calling thread.
+        :param concurrency: maximum number of hashes being computed or
+            waiting in the executor, None for no limit
+        :type concurrency: int.
+        :param queue_timeout: time spent waiting for a free slot before
+            giving up (seconds)
+        :type queue_timeout: float.
+        """
+        self.executor = executor
+        self.queue_timeout = queue_timeout
+        self._slots = None
+        if concurrency is not None:
+            self._slots = threading.BoundedSemaphore(concurrency)
+
+    def run(self, func, *args):
+        """Call func(*args) when a slot is available
+
+        :raises: HashingBusyException if no slot frees up in time
+        """
+        if self._slots is None:
+            return self._call(func, *args)
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise HashingBusyException("Too many concurrent password hashes")
+        try:
+            return self._call(func, *args)
+        finally:
+            self._slots.release()
+
+    def _call(self, func, *args):
+        if self.executor is None:
+            return func(*args)
+        return self.executor.submit(func, *args).result()
+
+
+def _b64(data):
+    return b64encode(data).decode('ascii')
+
+
+def _parse_params(params):
+    return dict((k, int(v)) for k, v in
+                (p.split('=', 1) for p in params.split(',')))
+
+
+class Hasher(object):
+    """Base class for password hashing schemes. An instance holds the
+    parameters used for new hashes; verification reads the parameters from
+    the stored hash.
+    """
+
+    name = None
+    salt_size = 16
+
+    def hash(self, cleartext, salt=None):
+        """Hash a cleartext with this instance parameters
+
+        :type cleartext: bytes
+        :param salt: random if unset
+        :type salt: bytes
+        :returns: str.
+        """
+        if salt is None:
+            salt = os.urandom(self.salt_size)
+        params = self.params()
+        digest = self._derive(cleartext, salt, params)
+        return "$%s$%s$%s$%s" % (self.name, ','.join('%s=%d' % kv
+            for kv in sorted(params.items())), _b64(salt), _b64(digest))
+
+    @classmethod
+    def verify(cls, cleartext, encoded):
+        """Verify a cleartext against a hash of this scheme
+
+        :returns: bool
+        :raises: AAAException if the hash parameters are invalid
+        """
+        try:
+            name, params, salt, digest = encoded.split('$')[1:]
+            params = _parse_params(params)
+            salt = b64decode(salt)
+            digest = b64decode(digest)
+        except (ValueError, TypeError):
+            return False
+        try:
+            derived = cls._derive(cleartext, salt, params)
+        except (KeyError, ValueError, OverflowError) as e:
+            raise AAAException("Invalid %s hash parameters: %s"
+                               % (cls.name, e))
+        return hmac.compare_digest(derived, digest)
+
+    def needs_rehash(self, encoded):
+        """Tell if a stored hash was created with a different scheme or
+        different parameters than this instance ones
+
+        :returns: bool
+        """
+        parts = encoded.split('$')
+        if len(parts) != 5 or parts[1] != self.name:
+            return True
+        try:
+            return _parse_params(parts[2]) != self.params()
+        except ValueError:
+            return True
+
+    def params(self):
+        """Cost parameters of the new hashes
+
+        :returns: {name: int} dict
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def _derive(cleartext, salt, params):
+        raise NotImplementedError
+
+
+@register_hasher
+class PBKDF2Hasher(Hasher):
+
+    name = 'pbkdf2-sha256'
+
+    def __init__(self, iterations=90000):
+        """PBKDF2-HMAC-SHA256, from the standard library
+
+        :param iterations: number of iterations
+        :type iterations: int.
+        :raises: AAAException if iterations is not positive
+        """
+        if iterations < 1:
+            raise AAAException("PBKDF2 requires at least one iteration")
+        self.iterations = iterations
+
+    def params(self):
+        return {'i': self.iterations}
+
+    @staticmethod
+    def _derive(cleartext, salt, params):
+        return hashlib.pbkdf2_hmac('sha256', cleartext, salt, params['i'])
+
+
+@register_hasher
+class ScryptHasher(Hasher):
+
+    name = 'scrypt'
+
+    def __init__(self, n=2 ** 15, r=8, p=1):
+        """scrypt, from the standard library
+
+        :param n: CPU/memory cost, a power of 2
+        :type n: int.
+        :param r: block size
+        :type r: int.
+        :param p: parallelization
+        :type p: int.
+        """
+        self.n = n
+        self.r = r
+        self.p = p
+
+    def params(self):
+        return {'n': self.n, 'r': self.r, 'p': self.p}
+
+    @staticmethod
+    def _derive(cleartext, salt, params):
+        n, r, p = params['n'], params['r'], params['p']
+        # scrypt needs 128 * n * r bytes, leave some headroom
+        return hashlib.scrypt(cleartext, salt=salt, n=n, r=r, p=p, dklen=32,
+                              maxmem=256 * n * r + 1024 * 1024)
+
+
+@register_hasher
+class Argon2Hasher(Hasher):
+
+    name = 'argon2id'
+
+    def __init__(self, time_cost=3, memory_cost=65536, parallelism=4):
+        """Argon2id, requires the argon2-cffi package.
+        Hashes use the argon2 standard encoding.
+
+        :param time_cost: number of iterations
+        :type time_cost: int.
+        :param memory_cost: memory usage (KiB)
+        :type memory_cost: int.
+        :param parallelism: number of lanes
+        :type parallelism: int.
+        """
+        self._hasher = self._password_hasher(time_cost=time_cost,
+            memory_cost=memory_cost, parallelism=parallelism)
+
+    @staticmethod
+    def _password_hasher(**params):
+        try:
+            from argon2 import PasswordHasher
+        except ImportError:
+            raise RuntimeError("argon2 hashing requires argon2-cffi")
+        return PasswordHasher(**params)
+
+    def hash(self, cleartext, salt=None):
+        return self._hasher.hash(cleartext, salt=salt)
+
+    @classmethod
+    def verify(cls, cleartext, encoded):
+        try:
+            from argon2.exceptions import InvalidHash, VerificationError
+        except ImportError:
+            log.warning("Unable to verify an argon2 hash: argon2-cffi is "
+                        "not installed")
+            return False
+        try:
+            return cls._password_hasher().verify(encoded, cleartext)
+        except (InvalidHash, VerificationError):
+            return False
+
+    def needs_rehash(self, encoded):
+        if identify(encoded) != self.name:
+            return True
+        return self._hasher.check_needs_rehash(encoded)
+
+
+@register_hasher
+class LegacyHasher(Hasher):
+    """Hashes created by older releases: PBKDF2-HMAC-SHA1 with 10 iterations.
+    Verification only: they are always rehashed.
+    """
+
+    name = 'legacy'
+
+    def hash(self, cleartext, salt=None):
+        raise NotImplementedError("Legacy hashes are not created anymore")
+
+    @classmethod
+    def verify(cls, cleartext, encoded):
+        try:
+            decoded = b64decode(encoded)
+        except (ValueError, TypeError):
+            return False
+        if decoded[:1] != b'p':  # 'p' for PBKDF2
+            return False
+        salt, digest = decoded[1:33], decoded[33:]
+        return hmac.compare_digest(
+            hashlib.pbkdf2_hmac('sha1', cleartext, salt, 10, 32), digest)
+
+    def needs_rehash(self, encoded):
+        return True
@@ -0,0 +1,218 @@
+# Cork - Authentication module for the Bottle web framework
+# Copyright (C) 2012 Federico Ceratto
+#
+# This package is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This package is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# In-memory storage backend, useful for testing, benchmarking and local
+# development
+
+from bisect import bisect_left, bisect_right, insort
+from copy import deepcopy
+from heapq import heappop, heappush
+from threading import RLock
+from time import time
+
+from .base_backend import Backend, Table, apply_mutations, matches
+
+
+class MemoryTable(Table):
+
+    def __init__(self, data=None, page_size=100):
+        """Thread-safe in-memory table. Entry names are kept sorted to
+        serve range queries. Entry expiry is emulated with a heap of
+        deadlines: expired entries are dropped by the next table access.
+
+        :param data: initial entries (optional)
+        :type data: dict
+        :param page_size: number of entries handled at a time when iterating
+            over the table
+        :type page_size: int.
+        """
+        self._lock = RLock()
+        self._data = {}
+        self._names = []
+        # name -> deadline, and (deadline, name) heap
+        self._expiry = {}
+        self._deadlines = []
+        self.page_size = page_size
+        for name, entry in (data or {}).items():
+            self[name] = entry
+
+    def _expire(self):
+        """Drop the expired entries. Called with the lock held.
+
+        :returns: number of dropped entries
+        """
+        deadlines = self._deadlines
+        if not deadlines:
+            return 0
+        now = time()
+        count = 0
+        while deadlines and deadlines[0][0] <= now:
+            deadline, name = heappop(deadlines)
+            # skip stale deadlines of rewritten or deleted entries
+            if self._expiry.get(name) == deadline:
+                self._drop(name)
+                count += 1
+        return count
+
+    def _drop(self, name):
+        del self._data[name]
+        del self._names[bisect_left(self._names, name)]
+        self._expiry.pop(name, None)
+
+    def purge_expired(self):
+        with self._lock:
+            return self._expire()
+
+    def __contains__(self, item):
+        with self._lock:
+            self._expire()
+            return item in self._data
+
+    def __getitem__(self, item):
+        with self._lock:
+            self._expire()
+            return deepcopy(self._data[item])
+
+    def get(self, item, default=None):
+        with self._lock:
+            self._expire()
+            if item not in self._data:
+                return default
+            return deepcopy(self._data[item])
+
+    def get_many(self, items):
+        with self._lock:
+            self._expire()
+            return dict((i, deepcopy(self._data[i]))
+                        for i in items if i in self._data)
+
+    def __setitem__(self, key, value):
+        value = deepcopy(value)
+        with self._lock:
+            self._expire()
+            if key not in self._data:
+                insort(self._names, key)
+            self._data[key] = value
+            self._expiry.pop(key, None)
+
+    def insert(self, key, value, ttl=None):
+        value = deepcopy(value)
+        with self._lock:
+            self._expire()
+            if key in self._data:
+                return False
+            insort(self._names, key)
+            self._data[key] = value
+            if ttl is not None:
+                deadline = time() + ttl
+                self._expiry[key] = deadline
+                heappush(self._deadlines, (deadline, key))
+        return True
+
+    def __delitem__(self, item):
+        with self._lock:
+            self._expire()
+            if item not in self._data:
+                return
+            self._drop(item)
+
+    def pop(self, item):
+        with self._lock:
+            self._expire()
+            value = self._data[item]
+            del self[item]
+            return value
+
+    def mutate(self, item, upsert=None, remove=(), expect=None,
+            increment=None):
+        upsert = deepcopy(upsert)
+        with self._lock:
+            self._expire()
+            entry = self._data[item]
+            if not matches(entry, expect):
+                return False
+            apply_mutations(entry, upsert, remove, increment)
+        return True
+
+    def range(self, start_after=None, limit=None, skip=0, descending=False,
+            prefix=None):
+        with self._lock:
+            self._expire()
+            names = self._names
+            lo, hi = 0, len(names)
+            if prefix is not None:
+                lo = bisect_left(names, prefix)
+                hi = bisect_left(names, prefix + u'\uffff')
+            if start_after is not None:
+                if descending:
+                    hi = min(hi, bisect_left(names, start_after))
+                else:
+                    lo = max(lo, bisect_right(names, start_after))
+            selected = names[lo:hi]
+
+        if descending:
+            selected.reverse()
+        selected = selected[skip:]
+        if limit is not None:
+            selected = selected[:limit]
+        return selected
+
+    def __iter__(self):
+        with self._lock:
+            self._expire()
+            return iter(list(self._names))
+
+    def __len__(self):
+        with self._lock:
+            self._expire()
+            return len(self._data)
+
+    def items(self):
+        for name in self:
+            entry = self.get(name)
+            if entry is not None:
+                yield name, entry
+
+    iteritems = items
+
+
+class MemoryBackend(Backend):
+
+    def __init__(self, users=None, roles=None, pending_registrations=None,
+            page_size=100):
+        """Data storage class. Keeps every table in memory, in the current
+        process. Initial users are not added to the email, company and role
+        indexes: run :meth:`Cork.rebuild_indexes` to index them.
+
+        :param users: initial users (optional)
+        :type users: dict
+        :param roles: initial roles (optional)
+        :type roles: dict
+        :param pending_registrations: initial pending registrations (optional)
+        :type pending_registrations: dict
+        :param page_size: number of entries handled at a time when iterating
+            over a table
+        :type page_size: int.
+        """
+        self.users = MemoryTable(users, page_size)
+        self.roles = MemoryTable(roles, page_size)
+        self.pending_registrations = MemoryTable(pending_registrations,
+            page_size)
+        self.emails = MemoryTable(page_size=page_size)
+        self.company_members = MemoryTable(page_size=page_size)
+        self.role_members = MemoryTable(page_size=page_size)
+        self.meta = MemoryTable(page_size=page_size)
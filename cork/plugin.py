@@ -0,0 +1,93 @@
+# Cork - Authentication module for the Bottle web framework
+# Copyright (C) 2012 Federico Ceratto
+#
+# This package is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This package is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Bottle plugin protecting routes
+#
+# The requirement of each route is validated and compiled when Bottle
+# applies the plugin, on the first request to the route: role levels are
+# resolved then, and a request only runs the comparisons. Bottle recompiles
+# the routes on app.reset(), e.g. after changing role levels.
+
+from functools import wraps
+
+import bottle
+
+
+class CorkPlugin(object):
+    """Protect routes configured with an `auth` setting::
+
+        app.install(CorkPlugin(aaa))
+
+        @app.route('/admin', auth={'role': 'admin'})
+        def admin():
+            ...
+
+        @app.route('/profile', auth=True)  # any authenticated user
+        def profile():
+            ...
+
+    The `auth` dict takes the arguments of :meth:`cork.Cork.require`:
+    username, company, role, fixed_role and fail_redirect. Without
+    fail_redirect, access is denied with HTTP 401 (unauthenticated) or 403
+    (unauthorized) errors.
+    """
+
+    name = 'cork'
+    api = 2
+
+    def __init__(self, cork_obj, keyword='auth'):
+        """
+        :param cork_obj: instance of :class:`cork.Cork`
+        :param keyword: name of the route setting
+        :type keyword: str.
+        """
+        self.cork = cork_obj
+        self.keyword = keyword
+
+    def setup(self, app):
+        for other in app.plugins:
+            if isinstance(other, CorkPlugin) and other.keyword == self.keyword:
+                raise bottle.PluginError("Found another Cork plugin using "
+                                         "the %r setting" % self.keyword)
+
+    def apply(self, callback, route):
+        conf = self._route_config(route)
+        if conf is None:
+            return callback
+        check = self.cork._requirement(http_errors=True, **conf)
+
+        @wraps(callback)
+        def wrapper(*args, **kwargs):
+            check()
+            return callback(*args, **kwargs)
+        return wrapper
+
+    def _route_config(self, route):
+        """Route requirement
+
+        :returns: dict of :meth:`cork.Cork.require` arguments, or None for
+            unprotected routes
+        """
+        # Bottle 0.13 flattens dict settings into "auth.role" keys
+        prefix = self.keyword + '.'
+        conf = dict((k[len(prefix):], v) for k, v in route.config.items()
+                    if k.startswith(prefix))
+        value = route.config.get(self.keyword)
+        if isinstance(value, dict):
+            conf.update(value)
+        elif not value and not conf:
+            return None
+        return conf
@@ -0,0 +1,89 @@
+# Cork - Authentication module for the Bottle web framework
+# Copyright (C) 2012 Federico Ceratto
+#
+# This package is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This package is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Role hierarchy snapshot
+#
+# Roles are few, rarely changed and read by nearly every request: each
+# process keeps an immutable snapshot of them. Role changes store a new
+# random version in the meta table; processes compare it with the version
+# of their snapshot, at most once per refresh interval, and reload the
+# roles when it differs.
+
+from bisect import bisect_left
+from types import MappingProxyType
+import os
+
+# meta table entry holding the roles version
+ROLES_VERSION_KEY = 'roles_version'
+
+
+def new_version():
+    """Random version identifier
+
+    :returns: str.
+    """
+    return os.urandom(8).hex()
+
+
+class RoleTable(object):
+    """Immutable snapshot of the roles: a name -> level mapping and the
+    roles sorted by level"""
+
+    __slots__ = ('version', 'levels', '_ranked_levels', '_ranked_names')
+
+    def __init__(self, levels, version=None):
+        """
+        :param levels: role levels
+        :type levels: {role: level} dict
+        :param version: roles version the snapshot was loaded at
+        :type version: str.
+        """
+        self.version = version
+        self.levels = MappingProxyType(dict(levels))
+        ranked = sorted((level, name) for name, level in levels.items())
+        self._ranked_levels = tuple(level for level, name in ranked)
+        self._ranked_names = tuple(name for level, name in ranked)
+
+    @classmethod
+    def load(cls, table, version=None):
+        """Snapshot the roles stored in a table
+
+        :type table: cork.base_backend.Table
+        :returns: RoleTable
+        """
+        return cls(dict((name, data['level']) for name, data in table.items()),
+                   version)
+
+    def level(self, role, default=None):
+        """Level of a role, or `default` if the role does not exist"""
+        return self.levels.get(role, default)
+
+    def roles_at_or_above(self, level):
+        """Roles with level >= `level`
+
+        :returns: tuple of role names, by increasing level
+        """
+        return self._ranked_names[bisect_left(self._ranked_levels, level):]
+
+    def items(self):
+        """(role, level) tuples, sorted by role"""
+        return sorted(self.levels.items())
+
+    def __contains__(self, role):
+        return role in self.levels
+
+    def __len__(self):
+        return len(self.levels)
@@ -0,0 +1,327 @@
+# Cork - Authentication module for the Bottle web framework
+# Copyright (C) 2012 Federico Ceratto
+#
+# This package is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This package is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# SQLite storage backend, for single-node deployments
+
+from contextlib import contextmanager
+from threading import local
+from time import time
+import json
+import sqlite3
+
+from .base_backend import (Backend, BackendIOException, Table,
+    apply_mutations, matches)
+
+
+@contextmanager
+def _translate_errors(item=None):
+    """Turn SQLite errors into BackendIOException"""
+    try:
+        yield
+    except sqlite3.Error as e:
+        raise BackendIOException("SQLite error on %r: %s" % (item, e))
+
+# current unix time, evaluated by SQLite
+_SQL_NOW = "((julianday('now') - 2440587.5) * 86400.0)"
+
+
+class SqliteTable(Table):
+
+    def __init__(self, backend, table_name, page_size=100, expiring=False):
+        """Table of JSON entries stored in SQLite.
+        Expiring tables store the entry deadlines in an indexed `expires`
+        column: expired entries are filtered out by every query, and deleted
+        by :meth:`purge_expired` or by a later insert of the same name.
+
+        :param backend: the owning backend, providing connections
+        :type backend: SqliteBackend
+        :param table_name: SQL table name
+        :type table_name: str.
+        :param page_size: number of entries fetched per query when iterating
+            over the table
+        :type page_size: int.
+        :param expiring: support entry expiry
+        :type expiring: bool.
+        """
+        self._backend = backend
+        self.table_name = table_name
+        self.page_size = page_size
+        self.expiring = expiring
+
+        # the SQL text is built once: the sqlite3 module caches the
+        # prepared statements by text, per connection
+        t = table_name
+        fields = ('name', 'data')
+        if expiring:
+            fields += ('expires',)
+            self._alive = "(expires IS NULL OR expires > %s)" % _SQL_NOW
+        else:
+            self._alive = "1"
+        self._sql_insert = "INSERT OR REPLACE INTO %s (%s) VALUES (%s)" % (
+            t, ', '.join(fields), ', '.join('?' * len(fields)))
+        self._sql_create = "INSERT OR IGNORE INTO %s (%s) VALUES (%s)" % (
+            t, ', '.join(fields), ', '.join('?' * len(fields)))
+        self._sql_update = "UPDATE %s SET data = ? WHERE name = ?" % t
+        self._sql_get = "SELECT data FROM %s WHERE name = ? AND %s" % (
+            t, self._alive)
+        self._sql_exists = "SELECT 1 FROM %s WHERE name = ? AND %s" % (
+            t, self._alive)
+        self._sql_delete = "DELETE FROM %s WHERE name = ?" % t
+        self._sql_count = "SELECT COUNT(*) FROM %s WHERE %s" % (
+            t, self._alive)
+        self._sql_purge = "DELETE FROM %s WHERE expires <= %s" % (t, _SQL_NOW)
+        self._sql_purge_one = "DELETE FROM %s WHERE name = ? AND " \
+            "expires <= %s" % (t, _SQL_NOW)
+
+    def create(self):
+        """Create the SQL table and its expiry index, if needed"""
+        cols = ', expires REAL' if self.expiring else ''
+        conn = self._backend.connection
+        conn.execute("CREATE TABLE IF NOT EXISTS %s "
+                     "(name TEXT PRIMARY KEY, data TEXT NOT NULL%s)"
+                     % (self.table_name, cols))
+        if self.expiring:
+            # tables created before expiry support
+            existing = [row[1] for row in
+                conn.execute("PRAGMA table_info(%s)" % self.table_name)]
+            if 'expires' not in existing:
+                conn.execute("ALTER TABLE %s ADD COLUMN expires REAL"
+                             % self.table_name)
+            conn.execute("CREATE INDEX IF NOT EXISTS %s_expires ON %s "
+                         "(expires)" % (self.table_name, self.table_name))
+
+    def _row(self, key, value, expires=None):
+        row = (key, json.dumps(value))
+        if self.expiring:
+            row += (expires,)
+        return row
+
+    def __contains__(self, item):
+        cur = self._backend.connection.execute(self._sql_exists, (item,))
+        return cur.fetchone() is not None
+
+    def __getitem__(self, item):
+        cur = self._backend.connection.execute(self._sql_get, (item,))
+        row = cur.fetchone()
+        if row is None:
+            raise KeyError(item)
+        return json.loads(row[0])
+
+    def get(self, item, default=None):
+        try:
+            return self[item]
+        except KeyError:
+            return default
+
+    def get_many(self, items):
+        items = list(items)
+        conn = self._backend.connection
+        found = {}
+        # stay below SQLITE_MAX_VARIABLE_NUMBER
+        for i in range(0, len(items), 500):
+            chunk = items[i:i + 500]
+            cur = conn.execute("SELECT name, data FROM %s WHERE name IN (%s) "
+                "AND %s" % (self.table_name, ', '.join('?' * len(chunk)),
+                            self._alive), chunk)
+            for name, data in cur:
+                found[name] = json.loads(data)
+        return found
+
+    def __setitem__(self, key, value):
+        with _translate_errors(key):
+            self._backend.connection.execute(self._sql_insert,
+                self._row(key, value))
+
+    def insert(self, key, value, ttl=None):
+        if ttl is not None and not self.expiring:
+            raise ValueError("The %s table does not support expiry"
+                             % self.table_name)
+        expires = None if ttl is None else time() + ttl
+        conn = self._backend.connection
+        with _translate_errors(key):
+            if not self.expiring:
+                cur = conn.execute(self._sql_create, self._row(key, value))
+                return cur.rowcount == 1
+            with self._backend.transaction():
+                # an expired entry does not count as existing
+                conn.execute(self._sql_purge_one, (key,))
+                cur = conn.execute(self._sql_create,
+                                   self._row(key, value, expires))
+        return cur.rowcount == 1
+
+    def purge_expired(self):
+        if not self.expiring:
+            return 0
+        with _translate_errors():
+            cur = self._backend.connection.execute(self._sql_purge)
+        return cur.rowcount
+
+    def __delitem__(self, item):
+        with _translate_errors(item):
+            self._backend.connection.execute(self._sql_delete, (item,))
+
+    def pop(self, item):
+        conn = self._backend.connection
+        with _translate_errors(item), self._backend.transaction():
+            row = conn.execute(self._sql_get, (item,)).fetchone()
+            if row is None:
+                raise KeyError(item)
+            conn.execute(self._sql_delete, (item,))
+        return json.loads(row[0])
+
+    def mutate(self, item, upsert=None, remove=(), expect=None,
+            increment=None):
+        # BEGIN IMMEDIATE takes the write lock before reading the entry:
+        # concurrent mutations are serialized
+        with _translate_errors(item), self._backend.transaction():
+            entry = self[item]
+            if not matches(entry, expect):
+                return False
+            apply_mutations(entry, upsert, remove, increment)
+            # UPDATE keeps the entry expiry
+            self._backend.connection.execute(self._sql_update,
+                (json.dumps(entry), item))
+        return True
+
+    def range(self, start_after=None, limit=None, skip=0, descending=False,
+            prefix=None):
+        where = [self._alive]
+        args = []
+        if prefix is not None:
+            where.append("name >= ? AND name < ?")
+            args.extend((prefix, prefix + u'\uffff'))
+        if start_after is not None:
+            where.append("name < ?" if descending else "name > ?")
+            args.append(start_after)
+        sql = "SELECT name FROM %s WHERE " % self.table_name
+        sql += " AND ".join(where)
+        sql += " ORDER BY name DESC" if descending else " ORDER BY name"
+        sql += " LIMIT ? OFFSET ?"
+        args.extend((-1 if limit is None else limit, skip))
+        cur = self._backend.connection.execute(sql, args)
+        return [row[0] for row in cur]
+
+    def _iter_pages(self):
+        """Yield lists of up to `page_size` (name, entry) pairs"""
+        first = "SELECT name, data FROM %s WHERE %s ORDER BY name LIMIT ?" \
+            % (self.table_name, self._alive)
+        following = "SELECT name, data FROM %s WHERE name > ? AND %s " \
+            "ORDER BY name LIMIT ?" % (self.table_name, self._alive)
+        conn = self._backend.connection
+        rows = conn.execute(first, (self.page_size,)).fetchall()
+        while True:
+            if rows:
+                yield rows
+            if len(rows) < self.page_size:
+                return
+            rows = conn.execute(following,
+                (rows[-1][0], self.page_size)).fetchall()
+
+    def __iter__(self):
+        for rows in self._iter_pages():
+            for name, data in rows:
+                yield name
+
+    def __len__(self):
+        return self._backend.connection.execute(self._sql_count).fetchone()[0]
+
+    def items(self):
+        for rows in self._iter_pages():
+            for name, data in rows:
+                yield name, json.loads(data)
+
+    iteritems = items
+
+
+class SqliteBackend(Backend):
+
+    def __init__(self, db_file, users_table_name='users',
+            roles_table_name='roles', pending_reg_table_name='register',
+            page_size=100, initialize=True):
+        """Data storage class. Handles JSON entries in a SQLite database,
+        in WAL mode. Users are looked up by email address, company and role
+        through the primary keys of the index tables.
+
+        :param db_file: SQLite database filename
+        :type db_file: str.
+        :param users_table_name: users table name
+        :type users_table_name: str.
+        :param roles_table_name: roles table name
+        :type roles_table_name: str.
+        :param pending_reg_table_name: pending registrations table name
+        :type pending_reg_table_name: str.
+        :param page_size: number of entries fetched per query when iterating
+            over a table
+        :type page_size: int.
+        :param initialize: create the tables and indexes if needed
+        :type initialize: bool.
+        """
+        self.db_file = db_file
+        self._local = local()
+        self.users = SqliteTable(self, users_table_name, page_size)
+        self.roles = SqliteTable(self, roles_table_name, page_size)
+        self.pending_registrations = SqliteTable(self, pending_reg_table_name,
+            page_size, expiring=True)
+        self.emails = SqliteTable(self, users_table_name + '_by_email',
+            page_size)
+        self.company_members = SqliteTable(self,
+            users_table_name + '_by_company', page_size)
+        self.role_members = SqliteTable(self, users_table_name + '_by_role',
+            page_size)
+        self.meta = SqliteTable(self, users_table_name + '_meta', page_size)
+        if initialize:
+            for name in self.table_names:
+                getattr(self, name).create()
+
+    @property
+    def connection(self):
+        """Per-thread connection, in autocommit mode"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def transaction(self):
+        """Context manager running a write transaction on the current
+        thread connection"""
+        return _Transaction(self.connection)
+
+    def close(self):
+        """Close the connection of the current thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class _Transaction(object):
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __enter__(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+        return self._conn
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self._conn.execute("COMMIT")
+        else:
+            self._conn.execute("ROLLBACK")
@@ -0,0 +1,222 @@
+# Cork - Authentication module for the Bottle web framework
+# Copyright (C) 2012 Federico Ceratto
+#
+# This package is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This package is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Signed tokens
+#
+# Tokens are "<version>.<payload>.<signature>", URL-safe base64 encoded
+# without padding. The payload is a JSON list starting with the expiry
+# time; the signature is an HMAC-SHA256 over the version, the token purpose
+# and the payload, so a token issued for one purpose is rejected for any
+# other. Checking a token costs a few microseconds and no storage access.
+#
+# Sealed tokens, "e<version>.<nonce and ciphertext>", carry the same
+# payload encrypted with AES-256-GCM, the purpose being authenticated
+# data. They require the cryptography package.
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from time import time
+import hashlib
+import hmac
+import os
+
+VERSION = '1'
+SEALED_VERSION = 'e1'
+
+
+class InvalidTokenException(Exception):
+    """Malformed, forged or mismatching token"""
+    pass
+
+
+class ExpiredTokenException(InvalidTokenException):
+    """Authentic token, past its expiry time"""
+    pass
+
+
+def _b64(data):
+    return urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _unb64(data):
+    return urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def sealing_available():
+    """Tell if sealed tokens are supported, i.e. cryptography is installed
+
+    :returns: bool
+    """
+    try:
+        import cryptography
+    except ImportError:
+        return False
+    return True
+
+
+def fingerprint(*values):
+    """Short digest of some strings, binding a token to the state they
+    describe: the token can be rejected as soon as the state changes
+
+    :returns: str.
+    """
+    h = hashlib.sha256('\0'.join(values).encode('utf-8'))
+    return _b64(h.digest()[:12])
+
+
+class TokenSigner(object):
+
+    def __init__(self, secret_keys=None):
+        """Sign and verify tokens
+
+        :param secret_keys: signing keys, newest first. Tokens are signed
+            with the first key and accepted if signed with any of them,
+            which allows rotating keys. If unset a random key is used:
+            tokens are then only valid within the current process.
+        :type secret_keys: list of str or bytes, or a single key
+        """
+        if secret_keys is None:
+            secret_keys = [os.urandom(32)]
+        elif isinstance(secret_keys, (str, bytes)):
+            secret_keys = [secret_keys]
+        self.keys = [k.encode('utf-8') if isinstance(k, str) else k
+                     for k in secret_keys]
+        if not self.keys:
+            raise ValueError("At least one secret key is required")
+
+    def sign(self, purpose, fields, ttl):
+        """Create a token
+
+        :param purpose: what the token is used for, e.g. 'reset'
+        :type purpose: str.
+        :param fields: JSON serializable values carried by the token
+        :type fields: list
+        :param ttl: token time-to-live (seconds)
+        :type ttl: int.
+        :returns: str.
+        """
+        payload = _b64(self._dump(fields, ttl))
+        signature = self._mac(self.keys[0], purpose, payload)
+        return "%s.%s.%s" % (VERSION, payload, _b64(signature))
+
+    def verify(self, purpose, token):
+        """Check a token signature and expiry
+
+        :param purpose: what the token is expected to be used for
+        :type purpose: str.
+        :param token: token
+        :type token: str.
+        :returns: the token fields
+        :raises: InvalidTokenException, ExpiredTokenException
+        """
+        try:
+            version, payload, signature = token.split('.')
+            signature = _unb64(signature)
+            if version != VERSION:
+                raise ValueError("Unsupported token version")
+            if not any(hmac.compare_digest(self._mac(k, purpose, payload),
+                                           signature) for k in self.keys):
+                raise ValueError("Bad signature")
+            payload = _unb64(payload)
+        except (AttributeError, TypeError, ValueError):
+            raise InvalidTokenException("Invalid token")
+        return self._load(payload)
+
+    def seal(self, purpose, fields, ttl):
+        """Create an encrypted token. Requires the cryptography package.
+
+        :param purpose: what the token is used for, e.g. 'register'
+        :type purpose: str.
+        :param fields: JSON serializable values carried by the token
+        :type fields: list
+        :param ttl: token time-to-live (seconds)
+        :type ttl: int.
+        :returns: str.
+        """
+        nonce = os.urandom(12)
+        ciphertext = self._aead(self.keys[0]).encrypt(nonce,
+            self._dump(fields, ttl), self._aad(purpose))
+        return "%s.%s" % (SEALED_VERSION, _b64(nonce + ciphertext))
+
+    def unseal(self, purpose, token):
+        """Decrypt an encrypted token and check its expiry
+
+        :param purpose: what the token is expected to be used for
+        :type purpose: str.
+        :param token: token
+        :type token: str.
+        :returns: the token fields
+        :raises: InvalidTokenException, ExpiredTokenException
+        """
+        from cryptography.exceptions import InvalidTag
+        try:
+            version, data = token.split('.')
+            data = _unb64(data)
+            if version != SEALED_VERSION:
+                raise ValueError("Unsupported token version")
+            aad = self._aad(purpose)
+        except (AttributeError, TypeError, ValueError):
+            raise InvalidTokenException("Invalid token")
+        for key in self.keys:
+            try:
+                payload = self._aead(key).decrypt(data[:12], data[12:], aad)
+                break
+            except (InvalidTag, ValueError):
+                continue
+        else:
+            raise InvalidTokenException("Invalid token")
+        return self._load(payload)
+
+    @staticmethod
+    def _dump(fields, ttl):
+        import json
+        payload = json.dumps([int(time() + ttl)] + list(fields),
+                             separators=(',', ':'))
+        return payload.encode('utf-8')
+
+    @staticmethod
+    def _load(payload):
+        """Decode an authentic payload and check its expiry
+
+        :returns: the token fields
+        """
+        import json
+        try:
+            fields = json.loads(payload.decode('utf-8'))
+            expires = fields.pop(0)
+        except (AttributeError, TypeError, ValueError, LookupError):
+            raise InvalidTokenException("Invalid token")
+        if time() >= expires:
+            raise ExpiredTokenException("Expired token")
+        return fields
+
+    @staticmethod
+    def _aad(purpose):
+        return ("%s.%s" % (SEALED_VERSION, purpose)).encode('ascii')
+
+    @staticmethod
+    def _aead(key):
+        """AES-256-GCM cipher, the key being derived from a secret key"""
+        try:
+            from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        except ImportError:
+            raise RuntimeError("Sealed tokens require the cryptography package")
+        return AESGCM(hmac.new(key, b'cork.tokens.seal',
+                               hashlib.sha256).digest())
+
+    @staticmethod
+    def _mac(key, purpose, payload):
+        msg = "%s.%s.%s" % (VERSION, purpose, payload)
+        return hmac.new(key, msg.encode('ascii'), hashlib.sha256).digest()
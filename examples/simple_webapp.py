@@ -8,15 +8,28 @@
 
 import bottle
 from beaker.middleware import SessionMiddleware
-from cork import Cork
+from cork import Cork, MemoryBackend
+import json
 import logging
 
 logging.basicConfig(format='localhost - - [%(asctime)s] %(message)s', level=logging.DEBUG)
 log = logging.getLogger(__name__)
 bottle.debug(True)
 
+def load_example_conf(directory='example_conf'):
+    """Load users.json and roles.json into an in-memory backend"""
+    with open('%s/users.json' % directory) as f:
+        users = json.load(f)
+    with open('%s/roles.json' % directory) as f:
+        roles = json.load(f)
+    return MemoryBackend(users=users, roles=roles)
+
 # Use users.json and roles.json in the local example_conf directory
-aaa = Cork('example_conf', email_sender='federico.ceratto@gmail.com', smtp_url='smtp://smtp.magnet.ie')
+# password reset tokens are signed with secret_keys, shared by every worker
+aaa = Cork(email_sender='federico.ceratto@gmail.com', smtp_url='smtp://smtp.magnet.ie',
+    backend=load_example_conf(),
+    secret_keys=['please use a random key and keep it secret!'])
+aaa.rebuild_indexes()
 
 import datetime
 app = bottle.app()
@@ -98,7 +111,7 @@ def restricted_download():
 def show_current_user_role():
     """Show current user role"""
     session = bottle.request.environ.get('beaker.session')
-    print "Session from simple_webapp", repr(session)
+    print("Session from simple_webapp", repr(session))
     
     aaa.require(fail_redirect='/login')
     return aaa.current_user.role
@@ -119,35 +132,36 @@ def admin():
 @bottle.post('/create_user')
 def create_user():
     try:
-        aaa.create_user(postd().username, postd().role, postd().password)
+        aaa.create_user(postd().username, postd().role, postd().password,
+            postd().company or 'ACME')
         return dict(ok=True, msg='')
-    except Exception, e:
-        return dict(ok=False, msg=e.message)
+    except Exception as e:
+        return dict(ok=False, msg=str(e))
 
 @bottle.post('/delete_user')
 def delete_user():
     try:
         aaa.delete_user(post_get('username'))
         return dict(ok=True, msg='')
-    except Exception, e:
-        print repr(e)
-        return dict(ok=False, msg=e.message)
+    except Exception as e:
+        print(repr(e))
+        return dict(ok=False, msg=str(e))
 
 @bottle.post('/create_role')
 def create_role():
     try:
         aaa.create_role(post_get('role'), post_get('level'))
         return dict(ok=True, msg='')
-    except Exception, e:
-        return dict(ok=False, msg=e.message)
+    except Exception as e:
+        return dict(ok=False, msg=str(e))
 
 @bottle.post('/delete_role')
 def delete_role():
     try:
         aaa.delete_role(post_get('role'))
         return dict(ok=True, msg='')
-    except Exception, e:
-        return dict(ok=False, msg=e.message)
+    except Exception as e:
+        return dict(ok=False, msg=str(e))
 
 # Static pages
 
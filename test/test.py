@@ -1,13 +1,18 @@
-from base64 import b64encode, b64decode
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from nose import SkipTest
 from nose.tools import assert_raises, raises, with_setup
 from time import time
+import bottle
+import copy
+import json
 import mock
 import os, sys
 import shutil
 
 from cork import Cork, AAAException, AuthException
-from cork import Mailer
+from cork import hashing, tokens
+from cork import Mailer, MemoryBackend
+from cork.base_backend import CachedTable
 import testutils
 
 testdir = None # Test directory
@@ -44,28 +49,32 @@ class MockedUnauthenticatedCork(Cork):
         global cookie_name
         cookie_name = username
 
-def setup_empty_dir():
-    """Setup test directory without JSON files"""
-    global testdir
-    tstamp = "%f" % time()
-    testdir = "%s/fl_%s" % (tmproot, tstamp)
-    os.mkdir(testdir)
-    os.mkdir(testdir + '/view')
-    print("setup done in %s" % testdir)
+def new_backend():
+    """Create a MemoryBackend with an 'admin' user and three roles"""
+    return MemoryBackend(
+        users={'admin': {
+            'role': 'admin',
+            'hash': '69f75f38ac3bfd6ac813794f3d8c47acc867adb10b806e8979316ddbf6113999b6052efe4ba95c0fa9f6a568bddf60e8e5572d9254dbf3d533085e9153265623',
+            'email_addr': None,
+            'company': 'ACME',
+            'perm': {},
+            'validated': True,
+            'creation_date': 1333981347,
+        }},
+        roles={
+            'special': {'level': 200},
+            'admin': {'level': 100},
+            'user': {'level': 50},
+        },
+    )
 
 def setup_dir():
-    """Setup test directory with valid JSON files"""
+    """Setup test directory with the email templates"""
     global testdir
     tstamp = "%f" % time()
     testdir = "%s/fl_%s" % (tmproot, tstamp)
     os.mkdir(testdir)
     os.mkdir(testdir + '/views')
-    with open("%s/users.json" % testdir, 'w') as f:
-        f.write("""{"admin": {"email_addr": null, "desc": null, "role": "admin", "hash": "69f75f38ac3bfd6ac813794f3d8c47acc867adb10b806e8979316ddbf6113999b6052efe4ba95c0fa9f6a568bddf60e8e5572d9254dbf3d533085e9153265623", "creation_date": "2012-04-09 14:22:27.075596"}}""")
-    with open("%s/roles.json" % testdir, 'w') as f:
-        f.write("""{"special": 200, "admin": 100, "user": 50}""")
-    with open("%s/register.json" % testdir, 'w') as f:
-        f.write("""{}""")
     with open("%s/views/registration_email.tpl" % testdir, 'w') as f:
         f.write("""Username:{{username}} Email:{{email_addr}} Code:{{registration_code}}""")
     with open("%s/views/password_reset_email.tpl" % testdir, 'w') as f:
@@ -77,7 +86,9 @@ def setup_mockedadmin():
     global aaa
     global cookie_name
     setup_dir()
-    aaa = MockedAdminCork(testdir, smtp_server='localhost', email_sender='test@localhost')
+    aaa = MockedAdminCork(smtp_server='localhost', email_sender='test@localhost',
+        backend=new_backend(), secret_keys=['key'])
+    aaa.rebuild_indexes()
     cookie_name = None
 
 def setup_mocked_unauthenticated():
@@ -85,7 +96,7 @@ def setup_mocked_unauthenticated():
     global aaa
     global cookie_name
     setup_dir()
-    aaa = MockedUnauthenticatedCork(testdir)
+    aaa = MockedUnauthenticatedCork(backend=new_backend())
     cookie_name = None
 
 def teardown_dir():
@@ -98,68 +109,24 @@ def teardown_dir():
 
 @with_setup(setup_dir, teardown_dir)
 def test_init():
-    aaa = Cork(testdir)
-
-@with_setup(setup_dir, teardown_dir)
-def test_initialize_storage():
-    aaa = Cork(testdir, initialize=True)
-    with open("%s/users.json" % testdir) as f:
-        assert f.readlines() == ['{}']
-    with open("%s/roles.json" % testdir) as f:
-        assert f.readlines() == ['{}']
-    with open("%s/register.json" % testdir) as f:
-        assert f.readlines() == ['{}']
-    with open("%s/views/registration_email.tpl" % testdir) as f:
-        assert f.readlines() == [
-            'Username:{{username}} Email:{{email_addr}} Code:{{registration_code}}']
-    with open("%s/views/password_reset_email.tpl" % testdir) as f:
-        assert f.readlines() == [
-            'Username:{{username}} Email:{{email_addr}} Code:{{reset_code}}']
-
-@raises(AAAException)
-@with_setup(setup_dir, teardown_dir)
-def test_unable_to_save():
-    bogus_dir = '/___inexisting_directory___'
-    aaa = Cork(bogus_dir, initialize=True)
+    aaa = Cork(backend=MemoryBackend())
 
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_mockedadmin():
     assert len(aaa._store.users) == 1, repr(aaa._store.users)
     assert 'admin' in aaa._store.users, repr(aaa._store.users)
 
-@with_setup(setup_mockedadmin, teardown_dir)
-def test_loadjson_missing_file():
-    assert_raises(AAAException, aaa._store._loadjson, 'nonexistent_file', {})
-
-@raises(AAAException)
-@with_setup(setup_mockedadmin, teardown_dir)
-def test_loadjson_broken_file():
-    with open(testdir + '/broken_file.json', 'w') as f:
-        f.write('-----')
-    aaa._store._loadjson('broken_file', {})
-
-@with_setup(setup_mockedadmin, teardown_dir)
-def test_loadjson_unchanged():
-    # By running _refresh with unchanged files the files should not be reloaded
-    mtimes = aaa._store._mtimes
-    aaa._store._refresh()
-    # The test simply ensures that no mtimes have been updated
-    assert mtimes == aaa._store._mtimes
-
 
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_password_hashing():
     shash = aaa._hash('user_foo', 'bogus_pwd')
-    assert len(shash) == 88, "hash length should be 88 and is %d" % len(shash)
-    assert shash.endswith('='), "hash should end with '='"
+    assert shash.startswith('$pbkdf2-sha256$i=90000$'), shash
     assert aaa._verify_password('user_foo', 'bogus_pwd', shash) == True, \
         "Hashing verification should succeed"
 
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_incorrect_password_hashing():
     shash = aaa._hash('user_foo', 'bogus_pwd')
-    assert len(shash) == 88, "hash length should be 88 and is %d" % len(shash)
-    assert shash.endswith('='), "hash should end with '='"
     assert aaa._verify_password('user_foo', '####', shash) == False, \
         "Hashing verification should fail"
     assert aaa._verify_password('###', 'bogus_pwd', shash) == False, \
@@ -167,14 +134,50 @@ def test_incorrect_password_hashing():
 
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_password_hashing_collision():
-    salt = 'S' * 32
+    salt = b'S' * 32
     hash1 = aaa._hash('user_foo', 'bogus_pwd', salt=salt)
     hash2 = aaa._hash('user_foobogus', '_pwd', salt=salt)
     assert hash1 != hash2, "Hash collision"
 
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_legacy_hash_upgraded_on_login():
+    # hash created by older releases, for password 'pwd'
+    legacy = 'cAEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEB6Yxpbr2ocbbhj3FMFR5JCXEZ80ypQjI1heOIeFSg800='
+    aaa._store.users['admin'] = dict(aaa._store.users['admin'], hash=legacy)
+    assert aaa._verify_password('admin', 'pwd', legacy)
+    assert not aaa.login('admin', 'wrong')
+    assert aaa._store.users['admin']['hash'] == legacy
+    assert aaa.login('admin', 'pwd')
+    upgraded = aaa._store.users['admin']['hash']
+    assert upgraded.startswith('$pbkdf2-sha256$'), upgraded
+    assert aaa.login('admin', 'pwd')
+    assert aaa._store.users['admin']['hash'] == upgraded
+
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_hashing_policy_change():
+    aaa.password_hasher = hashing.PBKDF2Hasher(iterations=1000)
+    aaa._store.users['admin'] = dict(aaa._store.users['admin'],
+        hash=aaa._hash('admin', 'pwd'))
+    aaa.password_hasher = hashing.get_hasher('scrypt')
+    assert aaa.login('admin', 'pwd')
+    shash = aaa._store.users['admin']['hash']
+    assert shash.startswith('$scrypt$n=32768,p=1,r=8$'), shash
+    assert aaa._verify_password('admin', 'pwd', shash)
+    assert not aaa._verify_password('admin', 'pwd', '$unknown$x$y$z')
+
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_hashing_in_process_pool():
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(1) as executor:
+        aaa._hashing = hashing.HashingPool(executor, concurrency=1)
+        aaa.password_hasher = hashing.PBKDF2Hasher(iterations=1000)
+        aaa.create_user('phil', 'user', 'hunter2', 'ACME')
+        assert aaa.login('phil', 'hunter2')
+        assert not aaa.login('phil', 'hunter3')
+
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_unauth_create_role():
-    aaa._store.roles['admin'] = 10 # lower admin level
+    aaa._store.roles['admin'] = {'level': 10} # lower admin level
     assert_raises(AuthException, aaa.create_role, 'user', 33)
 
 @with_setup(setup_mockedadmin, teardown_dir)
@@ -191,15 +194,12 @@ def test_create_role():
     assert len(aaa._store.roles) == 3, repr(aaa._store.roles)
     aaa.create_role('user33', 33)
     assert len(aaa._store.roles) == 4, repr(aaa._store.roles)
-    fname = "%s/%s.json" % (aaa._store._directory, aaa._store._roles_fname)
-    with open(fname) as f:
-        data = f.read()
-        assert 'user33' in data, repr(data)
+    assert aaa._store.roles['user33'] == {'level': 33}
 
 
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_unauth_delete_role():
-    aaa._store.roles['admin'] = 10 # lower admin level
+    aaa._store.roles['admin'] = {'level': 10} # lower admin level
     assert_raises(AuthException, aaa.delete_role, 'user')
 
 @with_setup(setup_mockedadmin, teardown_dir)
@@ -211,15 +211,40 @@ def test_create_delete_role():
     assert len(aaa._store.roles) == 3, repr(aaa._store.roles)
     aaa.create_role('user33', 33)
     assert len(aaa._store.roles) == 4, repr(aaa._store.roles)
-    fname = "%s/%s.json" % (aaa._store._directory, aaa._store._roles_fname)
-    with open(fname) as f:
-        data = f.read()
-        assert 'user33' in data, repr(data)
-    assert aaa._store.roles['user33'] == 33
+    assert aaa._store.roles['user33'] == {'level': 33}
+    assert aaa._store.roles['user33']['level'] == 33
     aaa.delete_role('user33')
     assert len(aaa._store.roles) == 3, repr(aaa._store.roles)
 
 
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_roles_snapshot_refresh():
+    other = Cork(backend=aaa._store)
+    assert other._get_role('special') == {'level': 200}
+    # created by another process
+    aaa.create_role('user33', 33)
+    assert other._get_role('user33') is None
+    other._role_table_checked -= other.roles_refresh_interval
+    assert other._get_role('user33') == {'level': 33}
+    aaa.delete_role('user33')
+    assert aaa._get_role('user33') is None
+
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_roles_snapshot_rate_limited():
+    aaa.create_role('user33', 33)
+    assert aaa._get_role('user33') == {'level': 33}
+    with mock.patch.object(aaa._store.meta, 'get') as meta_get, \
+            mock.patch.object(aaa._store.roles, 'items') as items:
+        for i in range(10):
+            aaa._get_role('user33')
+            list(aaa.list_roles())
+        assert not meta_get.called and not items.called
+    # unchanged version: checked, but the roles are not reloaded
+    aaa._role_table_checked -= aaa.roles_refresh_interval
+    with mock.patch.object(aaa._store.roles, 'items') as items:
+        assert aaa._get_role('user33') == {'level': 33}
+        assert not items.called
+
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_list_roles():
     roles = list(aaa.list_roles())
@@ -228,32 +253,31 @@ def test_list_roles():
 
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_unauth_create_user():
-    aaa._store.roles['admin'] = 10 # lower admin level
-    assert_raises(AuthException, aaa.create_user, 'phil', 'user', 'hunter123')
+    aaa._store.roles['admin'] = {'level': 10} # lower admin level
+    assert_raises(AuthException, aaa.create_user, 'phil', 'user', 'hunter123',
+        'ACME')
 
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_create_existing_user():
-    assert_raises(AAAException, aaa.create_user, 'admin', 'admin', 'bogus')
+    assert_raises(AAAException, aaa.create_user, 'admin', 'admin', 'bogus',
+        'ACME')
 
 @raises(AAAException)
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_create_user_with_wrong_role():
-    aaa.create_user('admin2', 'nonexistent_role', 'bogus')
+    aaa.create_user('admin2', 'nonexistent_role', 'bogus', 'ACME')
 
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_create_user():
     assert len(aaa._store.users) == 1, repr(aaa._store.users)
-    aaa.create_user('phil','user','user')
+    aaa.create_user('phil', 'user', 'user', 'ACME')
     assert len(aaa._store.users) == 2, repr(aaa._store.users)
-    fname = "%s/%s.json" % (aaa._store._directory, aaa._store._users_fname)
-    with open(fname) as f:
-        data = f.read()
-        assert 'phil' in data, repr(data)
+    assert aaa._store.users['phil']['company'] == 'ACME'
 
 
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_unauth_delete_user():
-    aaa._store.roles['admin'] = 10 # lower admin level
+    aaa._store.roles['admin'] = {'level': 10} # lower admin level
     assert_raises(AuthException, aaa.delete_user, 'phil')
 
 @with_setup(setup_mockedadmin, teardown_dir)
@@ -265,10 +289,7 @@ def test_delete_user():
     assert len(aaa._store.users) == 1, repr(aaa._store.users)
     aaa.delete_user('admin')
     assert len(aaa._store.users) == 0, repr(aaa._store.users)
-    fname = "%s/%s.json" % (aaa._store._directory, aaa._store._users_fname)
-    with open(fname) as f:
-        data = f.read()
-        assert 'admin' not in data, "'admin' must not be in %s" % repr(data)
+    assert 'admin' not in aaa._store.users
 
 
 @with_setup(setup_mockedadmin, teardown_dir)
@@ -277,6 +298,21 @@ def test_list_users():
     assert len(users) == 1, "Incorrect. Users are: %s" % repr(aaa._store.users)
 
 
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_list_users_paginated():
+    for un in ('phil', 'bob', 'carl'):
+        aaa.create_user(un, 'user', 'hunter123', 'ACME')
+    names = [u[0] for u in aaa.list_users(page_size=2)]
+    assert names == ['admin', 'bob', 'carl', 'phil'], names
+    names = [u[0] for u in aaa.list_users(offset=1, limit=2, page_size=1)]
+    assert names == ['bob', 'carl'], names
+    names = [u[0] for u in aaa.list_users(cursor='bob', page_size=2)]
+    assert names == ['carl', 'phil'], names
+    names = [u[0] for u in aaa.list_users(order='desc', limit=3)]
+    assert names == ['phil', 'carl', 'bob'], names
+    assert_raises(AAAException, aaa.list_users, order='random')
+
+
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_failing_login():
     login = aaa.login('phil', 'hunter123')
@@ -293,7 +329,7 @@ def test_login_nonexistent_user_empty_password():
 
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_login_existing_user_empty_password():
-    aaa.create_user('phil', 'user', 'hunter123')
+    aaa.create_user('phil', 'user', 'hunter123', 'ACME')
     assert 'phil' in aaa._store.users
     assert aaa._store.users['phil']['role'] == 'user'
     login = aaa.login('phil', '')
@@ -303,7 +339,7 @@ def test_login_existing_user_empty_password():
 
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_create_and_validate_user():
-    aaa.create_user('phil', 'user', 'hunter123')
+    aaa.create_user('phil', 'user', 'hunter123', 'ACME')
     assert 'phil' in aaa._store.users
     assert aaa._store.users['phil']['role'] == 'user'
     login = aaa.login('phil', 'hunter123')
@@ -314,7 +350,7 @@ def test_create_and_validate_user():
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_require_failing_username():
     # The user exists, but I'm 'admin'
-    aaa.create_user('phil', 'user', 'hunter123')
+    aaa.create_user('phil', 'user', 'hunter123', 'ACME')
     assert_raises(AuthException, aaa.require, username='phil')
 
 @with_setup(setup_mockedadmin, teardown_dir)
@@ -369,7 +405,25 @@ def test_update_pwd():
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_update_email():
     aaa.current_user.update(email_addr='foo')
-    assert aaa._store.users['admin']['email'] == 'foo'
+    assert aaa._store.users['admin']['email_addr'] == 'foo'
+
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_update_permissions():
+    aaa.current_user.update(permissions={'edit': True, 'view': True})
+    aaa.current_user.update(permissions={'edit': False})
+    assert aaa._store.users['admin']['perm'] == {'edit': False, 'view': True}
+    aaa.current_user.remove_permissions(['edit', 'nonexistent'])
+    assert aaa._store.users['admin']['perm'] == {'view': True}
+
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_update_keeps_other_fields():
+    user = aaa.user('admin')
+    aaa._store.users.mutate('admin', upsert={('email_addr',): 'new@a.a'})
+    user.update(company='Widgets')
+    data = aaa._store.users['admin']
+    assert data['company'] == 'Widgets'
+    assert data['email_addr'] == 'new@a.a'
+    assert user.level == 100
 
 @raises(AAAException)
 @with_setup(setup_mocked_unauthenticated, teardown_dir)
@@ -384,33 +438,77 @@ def test_get_current_user_nonexistent():
     c = aaa.current_user
 
 
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_current_user_memoized_per_request():
+    bottle.request.bind({'REQUEST_METHOD': 'GET'})
+    cu = aaa.current_user
+    assert aaa.current_user is cu
+    assert aaa.user('admin') is cu
+    aaa.require(role='user')
+    # a new request gets a new User instance
+    bottle.request.bind({'REQUEST_METHOD': 'GET'})
+    assert aaa.current_user is not cu
+    bottle.request.bind({})
+
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_current_user_not_memoized_outside_request():
+    assert aaa.current_user is not aaa.current_user
+
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_deleted_user_not_memoized():
+    bottle.request.bind({'REQUEST_METHOD': 'GET'})
+    aaa.create_user('phil', 'user', 'hunter123', 'ACME')
+    aaa.user('phil')
+    aaa.delete_user('phil')
+    assert aaa.user('phil') is None
+    bottle.request.bind({})
+
+
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_get_nonexistent_user():
     assert aaa.user('nonexistent_user') is None
 
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_users_bulk():
+    aaa.create_user('phil', 'user', 'hunter123', 'ACME')
+    users = aaa.users_bulk(['admin', 'phil', 'nonexistent_user'])
+    assert sorted(users) == ['admin', 'phil']
+    assert users['phil'].role == 'user'
+    assert users['phil'].level == 50
+    assert aaa.users_bulk([]) == {}
+
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_users_bulk_missing_role():
+    aaa.create_user('phil', 'user', 'hunter123', 'ACME')
+    aaa._store.users.mutate('phil', upsert={('role',): 'gone'})
+    assert sorted(aaa.users_bulk(['admin', 'phil'])) == ['admin']
+
+
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_register_no_user():
-    assert_raises(AssertionError, aaa.register, None, 'pwd', 'a@a.a')
+    assert_raises(AssertionError, aaa.register, None, 'pwd', 'a@a.a', 'ACME')
 
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_register_no_pwd():
-    assert_raises(AssertionError, aaa.register, 'foo', None, 'a@a.a')
+    assert_raises(AssertionError, aaa.register, 'foo', None, 'a@a.a', 'ACME')
 
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_register_no_email():
-    assert_raises(AssertionError, aaa.register, 'foo', 'pwd', None)
+    assert_raises(AssertionError, aaa.register, 'foo', 'pwd', None, 'ACME')
 
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_register_already_existing():
-    assert_raises(AAAException, aaa.register, 'admin', 'pwd', 'a@a.a')
+    assert_raises(AAAException, aaa.register, 'admin', 'pwd', 'a@a.a', 'ACME')
 
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_register_no_role():
-    assert_raises(AAAException, aaa.register, 'foo', 'pwd', 'a@a.a', role='clown')
+    assert_raises(AAAException, aaa.register, 'foo', 'pwd', 'a@a.a', 'ACME',
+        role='clown')
 
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_register_role_too_high():
-    assert_raises(AAAException, aaa.register, 'foo', 'pwd', 'a@a.a', role='admin')
+    assert_raises(AAAException, aaa.register, 'foo', 'pwd', 'a@a.a', 'ACME',
+        role='admin')
 
 # Patch the mailer _send() method to prevent network interactions
 @with_setup(setup_mockedadmin, teardown_dir)
@@ -418,7 +516,7 @@ def test_register_role_too_high():
 def test_register(mocked):
     old_dir = os.getcwd()
     os.chdir(testdir)
-    aaa.register('foo', 'pwd', 'a@a.a')
+    aaa.register('foo', 'pwd', 'a@a.a', 'ACME')
     os.chdir(old_dir)
     assert len(aaa._store.pending_registrations) == 1, repr(aaa._store.pending_registrations)
 
@@ -537,11 +635,11 @@ def test_validate_registration(mocked):
     # create registration
     old_dir = os.getcwd()
     os.chdir(testdir)
-    aaa.register('user_foo', 'pwd', 'a@a.a')
+    aaa.register('user_foo', 'pwd', 'a@a.a', 'ACME')
     os.chdir(old_dir)
     assert len(aaa._store.pending_registrations) == 1, repr(aaa._store.pending_registrations)
     # get the registration code, and run validate_registration
-    code = aaa._store.pending_registrations.keys()[0]
+    code = list(aaa._store.pending_registrations.keys())[0]
     user_data = aaa._store.pending_registrations[code]
     aaa.validate_registration(code)
     assert user_data['username'] in aaa._store.users, "Account should have been added"
@@ -551,6 +649,42 @@ def test_validate_registration(mocked):
     # The registration should have been removed
     assert len(aaa._store.pending_registrations) == 0, repr(aaa._store.pending_registrations)
 
+def setup_stateless_registration():
+    """Setup a MockedAdminCork instance carrying pending registrations in
+    the registration codes"""
+    global aaa
+    if not tokens.sealing_available():
+        raise SkipTest
+    aaa = MockedAdminCork(backend=new_backend(), secret_keys=['key'],
+                          stateless_registration=True)
+    aaa.rebuild_indexes()
+
+@raises(AAAException)
+def test_stateless_registration_requires_secret_keys():
+    Cork(backend=new_backend(), stateless_registration=True)
+
+@with_setup(setup_stateless_registration, teardown_dir)
+def test_stateless_registration():
+    code = aaa.register('user_foo', 'pwd', 'a@a.a', 'ACME')
+    assert len(aaa._store.pending_registrations) == 0
+    assert 'a@a.a' not in code and 'user_foo' not in code
+    assert_raises(AuthException, aaa.validate_registration,
+                  testutils.tamper(code))
+    assert aaa.validate_registration(code) == 'user_foo'
+    assert aaa.login('user_foo', 'pwd')
+    # only the replay guard is stored
+    assert len(aaa._store.pending_registrations) == 1
+    aaa._store.users.pop('user_foo')
+    assert_raises(AuthException, aaa.validate_registration, code)
+    assert 'user_foo' not in aaa._store.users
+
+@with_setup(setup_stateless_registration, teardown_dir)
+def test_stateless_registration_expired():
+    aaa.registration_timeout = 0
+    code = aaa.register('user_foo', 'pwd', 'a@a.a', 'ACME')
+    assert_raises(AuthException, aaa.validate_registration, code)
+    assert 'user_foo' not in aaa._store.users
+
 
 # Patch the mailer _send() method to prevent network interactions
 @with_setup(setup_mockedadmin, teardown_dir)
@@ -558,7 +692,7 @@ def test_validate_registration(mocked):
 def test_purge_expired_registration(mocked):
     old_dir = os.getcwd()
     os.chdir(testdir)
-    aaa.register('foo', 'pwd', 'a@a.a')
+    aaa.register('foo', 'pwd', 'a@a.a', 'ACME')
     os.chdir(old_dir)
     assert len(aaa._store.pending_registrations) == 1, "The registration should" \
         " be present"
@@ -569,6 +703,16 @@ def test_purge_expired_registration(mocked):
     assert len(aaa._store.pending_registrations) == 0, "The registration should " \
         "have been removed"
 
+# Patch the mailer _send() method to prevent network interactions
+@with_setup(setup_mockedadmin, teardown_dir)
+@mock.patch.object(Mailer, '_send')
+def test_registration_expiry(mocked):
+    aaa.registration_timeout = -1
+    code = aaa.register('foo', 'pwd', 'a@a.a', 'ACME')
+    assert len(aaa._store.pending_registrations) == 0
+    assert_raises(AuthException, aaa.validate_registration, code)
+    assert aaa._purge_expired_registrations() == 0
+
 # Patch the mailer _send() method to prevent network interactions
 @with_setup(setup_mockedadmin, teardown_dir)
 @mock.patch.object(Mailer, '_send')
@@ -579,15 +723,15 @@ def test_prevent_double_registration(mocked):
     # create first registration
     old_dir = os.getcwd()
     os.chdir(testdir)
-    aaa.register('user_foo', 'first_pwd', 'a@a.a')
+    aaa.register('user_foo', 'first_pwd', 'a@a.a', 'ACME')
     assert len(aaa._store.pending_registrations) == 1, repr(aaa._store.pending_registrations)
-    first_registration_code = aaa._store.pending_registrations.keys()[0]
+    first_registration_code = list(aaa._store.pending_registrations.keys())[0]
 
     # create second registration
-    aaa.register('user_foo', 'second_pwd', 'b@b.b')
+    aaa.register('user_foo', 'second_pwd', 'b@b.b', 'ACME')
     os.chdir(old_dir)
     assert len(aaa._store.pending_registrations) == 2, repr(aaa._store.pending_registrations)
-    registration_codes = aaa._store.pending_registrations.keys()
+    registration_codes = list(aaa._store.pending_registrations.keys())
     if first_registration_code == registration_codes[0]:
         second_registration_code = registration_codes[1]
     else:
@@ -604,7 +748,7 @@ def test_prevent_double_registration(mocked):
     # After the first registration only one pending registration should be left
     # The registration having 'a@a.a' email address should be gone
     assert len(aaa._store.pending_registrations) == 1, repr(aaa._store.pending_registrations)
-    pr_code, pr_data = aaa._store.pending_registrations.items()[0]
+    pr_code, pr_data = list(aaa._store.pending_registrations.items())[0]
     assert pr_data['email_addr'] == 'b@b.b', "Incorrect registration in the datastore"
 
     # Logging in using the first login should succeed
@@ -654,19 +798,67 @@ def test_send_password_reset_email_incorrect_pair(mocked):
 @with_setup(setup_mockedadmin, teardown_dir)
 @mock.patch.object(Mailer, '_send')
 def test_send_password_reset_email_by_email_addr(mocked):
-    aaa._store.users['admin']['email_addr'] = 'admin@localhost.local'
+    aaa.current_user.update(email_addr='admin@localhost.local')
     old_dir = os.getcwd()
     os.chdir(testdir)
     aaa.send_password_reset_email(email_addr='admin@localhost.local')
+    aaa.mailer.join()
     os.chdir(old_dir)
-    #TODO: add UT
+    assert mocked.called
+    assert mocked.call_args[0][0] == 'admin@localhost.local'
+
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_email_index():
+    aaa.create_user('phil', 'user', 'hunter123', 'ACME', email_addr='p@a.a')
+    assert aaa._lookup_email('p@a.a') == 'phil'
+    aaa.user('phil').update(email_addr='phil@a.a')
+    assert aaa._lookup_email('p@a.a') is None
+    assert aaa._lookup_email('phil@a.a') == 'phil'
+    aaa.delete_user('phil')
+    assert aaa._lookup_email('phil@a.a') is None
+
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_rebuild_indexes():
+    aaa._store.users['phil'] = {'role': 'user', 'email_addr': 'p@a.a',
+        'company': 'Widgets', 'validated': True, 'perm': {}}
+    assert aaa._lookup_email('p@a.a') is None
+    assert list(aaa.users_by_company('Widgets')) == []
+    aaa.rebuild_indexes()
+    assert aaa._lookup_email('p@a.a') == 'phil'
+    assert [u[0] for u in aaa.users_by_company('Widgets')] == ['phil']
+
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_users_by_company_and_role():
+    aaa.create_user('phil', 'user', 'hunter123', 'Widgets')
+    aaa.create_user('bob', 'user', 'hunter123', 'Widgets')
+    aaa.create_user('carl', 'admin', 'hunter123', 'ACME:East')
+    names = [u[0] for u in aaa.users_by_company('Widgets', page_size=1)]
+    assert names == ['bob', 'phil'], names
+    names = [u[0] for u in aaa.users_by_company('Widgets', cursor='bob')]
+    assert names == ['phil'], names
+    names = [u[0] for u in aaa.users_by_role('user', limit=1)]
+    assert names == ['bob'], names
+    aaa.user('bob').update(role='admin', company='ACME:East')
+    names = [u[0] for u in aaa.users_by_company('ACME:East')]
+    assert names == ['bob', 'carl'], names
+    names = [u[0] for u in aaa.users_by_role('user')]
+    assert names == ['phil'], names
+    aaa.delete_user('phil')
+    assert list(aaa.users_by_role('user')) == []
+
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_delete_role_in_use():
+    aaa.create_user('phil', 'user', 'hunter123', 'ACME')
+    assert_raises(AAAException, aaa.delete_role, 'user')
+    aaa.delete_user('phil')
+    aaa.delete_role('user')
 
 @with_setup(setup_mockedadmin, teardown_dir)
 @mock.patch.object(Mailer, '_send')
 def test_send_password_reset_email_by_username(mocked):
     old_dir = os.getcwd()
     os.chdir(testdir)
-    aaa._store.users['admin']['email_addr'] = 'admin@localhost.local'
+    aaa.current_user.update(email_addr='admin@localhost.local')
     assert not mocked.called
     aaa.send_password_reset_email(username='admin')
     aaa.mailer.join()
@@ -692,39 +884,98 @@ def test_perform_password_reset_nonexistent_user():
     token = aaa._reset_code('admin_bogus', 'admin@localhost.local')
     aaa.reset_password(token, 'newpassword')
 
-# The following test should fail
-# an user can change the password reset timestamp by b64-decoding the token,
-# editing the field and b64-encoding it
+def mangle_reset_code(token, index, func):
+    """Change a field of a reset token, keeping its signature"""
+    version, payload, signature = token.split('.')
+    fields = json.loads(urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    fields[index] = func(fields[index])
+    payload = urlsafe_b64encode(json.dumps(fields).encode('utf-8'))
+    return '.'.join((version, payload.decode('ascii'), signature))
+
 @raises(AuthException)
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_perform_password_reset_mangled_timestamp():
-    raise SkipTest
     token = aaa._reset_code('admin', 'admin@localhost.local')
-    username, email_addr, tstamp, h = b64decode(token).split(':', 3)
-    tstamp = str(int(tstamp) + 100)
-    mangled_token = ':'.join((username, email_addr, tstamp, h))
-    mangled_token = b64encode(mangled_token)
+    mangled_token = mangle_reset_code(token, 0, lambda t: t + 100)
     aaa.reset_password(mangled_token, 'newpassword')
 
 @raises(AuthException)
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_perform_password_reset_mangled_username():
+    aaa._store.users['admin2'] = aaa._store.users['admin']
     token = aaa._reset_code('admin', 'admin@localhost.local')
-    username, email_addr, tstamp, h = b64decode(token).split(':', 3)
-    username += "mangled_username"
-    mangled_token = ':'.join((username, email_addr, tstamp, h))
-    mangled_token = b64encode(mangled_token)
+    mangled_token = mangle_reset_code(token, 1, lambda u: u + '2')
     aaa.reset_password(mangled_token, 'newpassword')
 
 @raises(AuthException)
 @with_setup(setup_mockedadmin, teardown_dir)
-def test_perform_password_reset_mangled_email():
+def test_perform_password_reset_mangled_signature():
     token = aaa._reset_code('admin', 'admin@localhost.local')
-    username, email_addr, tstamp, h = b64decode(token).split(':', 3)
-    email_addr += "mangled_email"
-    mangled_token = ':'.join((username, email_addr, tstamp, h))
-    mangled_token = b64encode(mangled_token)
-    aaa.reset_password(mangled_token, 'newpassword')
+    aaa.reset_password(testutils.tamper(token), 'newpassword')
+
+@raises(AuthException)
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_perform_password_reset_other_key():
+    token = Cork(backend=aaa._store, secret_keys=['other'])._reset_code(
+        'admin', 'admin@localhost.local')
+    aaa.reset_password(token, 'newpassword')
+
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_password_reset_requires_secret_keys():
+    other = Cork(backend=aaa._store)
+    assert_raises(AAAException, other.send_password_reset_email,
+                  username='admin', email_addr='admin@localhost.local')
+    token = aaa._reset_code('admin', 'admin@localhost.local')
+    assert_raises(AAAException, other.reset_password, token, 'newpassword')
+
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_perform_password_reset_key_rotation():
+    old = Cork(backend=aaa._store, secret_keys=['old'])
+    token = old._reset_code('admin', 'admin@localhost.local')
+    new = Cork(backend=aaa._store, secret_keys=['new', 'old'])
+    new.reset_password(token, 'newpassword')
+    assert new.verify_password('admin', 'newpassword')
+    token = new._reset_code('admin', 'admin@localhost.local')
+    assert_raises(AuthException, old.reset_password, token, 'pwd')
+
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_perform_password_reset_single_use():
+    token = aaa._reset_code('admin', 'admin@localhost.local')
+    aaa.reset_password(token, 'newpassword')
+    assert_raises(AuthException, aaa.reset_password, token, 'otherpassword')
+    assert aaa.verify_password('admin', 'newpassword')
+
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_perform_password_reset_email_changed():
+    token = aaa._reset_code('admin', 'admin@localhost.local')
+    aaa.user('admin').update(email_addr='new@localhost.local')
+    assert_raises(AuthException, aaa.reset_password, token, 'newpassword')
+
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_perform_password_reset_stale_cache():
+    store = copy.copy(aaa._store)
+    store.users = CachedTable(aaa._store.users)
+    cached = Cork(backend=store, secret_keys=['key'])
+    token = aaa._reset_code('admin', 'admin@localhost.local')
+    store.users.get('admin')  # cached
+    aaa.user('admin').update(email_addr='new@localhost.local')
+    assert_raises(AuthException, cached.reset_password, token, 'newpassword')
+    assert not aaa.verify_password('admin', 'newpassword')
+
+@with_setup(setup_mockedadmin, teardown_dir)
+def test_perform_password_reset_concurrent_use():
+    token = aaa._reset_code('admin', 'admin@localhost.local')
+    hash_password = aaa._hash
+
+    def concurrent_hash(username, pwd):
+        # the same token is used while this reset hashes its password
+        aaa._hash = hash_password
+        aaa.reset_password(token, 'otherpassword')
+        return hash_password(username, pwd)
+
+    aaa._hash = concurrent_hash
+    assert_raises(AuthException, aaa.reset_password, token, 'newpassword')
+    assert aaa.verify_password('admin', 'otherpassword')
 
 @with_setup(setup_mockedadmin, teardown_dir)
 def test_perform_password_reset():
@@ -736,3 +987,133 @@ def test_perform_password_reset():
 
 
 
+
+
+# Signed cookie sessions
+
+def new_request(cookie=None):
+    """Bind bottle's request and response to a new request"""
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/',
+               'HTTP_HOST': 'localhost', 'wsgi.url_scheme': 'http'}
+    if cookie is not None:
+        environ['HTTP_COOKIE'] = 'cork=%s' % cookie
+    bottle.request.bind(environ)
+    bottle.response.bind()
+
+def response_cookie():
+    """Value of the session cookie set by the current response"""
+    morsel = bottle.response._cookies.get('cork') \
+        if bottle.response._cookies else None
+    return morsel.value if morsel is not None else None
+
+def setup_cookie_session():
+    global aaa
+    aaa = Cork(backend=new_backend(), session_mode='cookie',
+               secret_keys=['key'],
+               password_hasher=hashing.PBKDF2Hasher(iterations=1000))
+    aaa._store.users['phil'] = {'role': 'user', 'company': 'ACME',
+        'hash': aaa._hash('phil', 'pwd'), 'email_addr': 'p@p.p',
+        'perm': {}, 'validated': True, 'creation_date': 0}
+    new_request()
+    assert aaa.login('phil', 'pwd')
+    return response_cookie()
+
+def teardown_cookie_session():
+    teardown_dir()
+    bottle.request.bind({})
+    bottle.response.bind()
+
+@raises(AAAException)
+def test_cookie_session_requires_secret_keys():
+    Cork(backend=new_backend(), session_mode='cookie')
+
+@with_setup(setup_dir, teardown_cookie_session)
+def test_cookie_session_no_storage_reads():
+    cookie = setup_cookie_session()
+    assert cookie and cookie.startswith('1.')
+    new_request(cookie)
+    with mock.patch.object(aaa._store.users, 'get') as get:
+        aaa.require(role='user')
+        aaa.require(role='user', fixed_role=True, company='ACME')
+        assert_raises(AuthException, aaa.require, role='admin')
+        assert_raises(AuthException, aaa.require, company='Other')
+        cu = aaa.current_user
+        assert (cu.username, cu.role, cu.level, cu.company) == \
+            ('phil', 'user', 50, 'ACME')
+        assert not get.called
+    assert cu.email_addr == 'p@p.p'
+    assert response_cookie() is None
+
+@with_setup(setup_dir, teardown_cookie_session)
+def test_cookie_session_forged():
+    cookie = setup_cookie_session()
+    for forged in ('', 'bogus', testutils.tamper(cookie),
+                   Cork(backend=aaa._store, session_mode='cookie',
+                        secret_keys=['other'])._signer
+                   .sign('session', ['phil', 'admin', 100, 'ACME', 0, 0,
+                                     int(time())], 60)):
+        new_request(forged)
+        assert_raises(AuthException, aaa.require)
+
+@with_setup(setup_dir, teardown_cookie_session)
+def test_cookie_session_revalidation():
+    cookie = setup_cookie_session()
+    aaa._store.users['phil'] = dict(aaa._store.users['phil'], role='admin')
+    new_request(cookie)
+    assert aaa.current_user.role == 'user'
+    aaa.session_revalidate = 0
+    new_request(cookie)
+    assert aaa.current_user.level == 100
+    cookie = response_cookie()
+    assert cookie
+    aaa.session_revalidate = 300
+    new_request(cookie)
+    aaa.require(role='admin', fixed_role=True)
+
+@with_setup(setup_dir, teardown_cookie_session)
+def test_cookie_session_password_change():
+    cookie = setup_cookie_session()
+    aaa.user('phil').update(pwd='newpwd')
+    aaa.session_revalidate = 0
+    new_request(cookie)
+    assert_raises(AuthException, aaa.require)
+
+@with_setup(setup_dir, teardown_cookie_session)
+def test_cookie_session_own_password_change():
+    cookie = setup_cookie_session()
+    aaa.session_revalidate = 0
+    new_request(cookie)
+    aaa.current_user.update(pwd='newpwd')
+    cookie = response_cookie()
+    new_request(cookie)
+    assert aaa.current_user.username == 'phil'
+
+@with_setup(setup_dir, teardown_cookie_session)
+def test_cookie_session_deleted_user():
+    cookie = setup_cookie_session()
+    del aaa._store.users['phil']
+    aaa.session_revalidate = 0
+    new_request(cookie)
+    assert_raises(AuthException, aaa.require)
+
+@with_setup(setup_dir, teardown_cookie_session)
+def test_cookie_session_login_deleted_role():
+    setup_cookie_session()
+    aaa._store.roles.pop('user')
+    aaa._roles_changed()
+    new_request()
+    assert_raises(AAAException, aaa.login, 'phil', 'pwd')
+    assert response_cookie() is None
+
+@with_setup(setup_dir, teardown_cookie_session)
+def test_cookie_session_logout():
+    cookie = setup_cookie_session()
+    new_request(cookie)
+    with assert_raises(bottle.HTTPResponse) as cm:
+        aaa.logout(success_redirect='/bye')
+    e = cm.exception
+    assert e.status_code == 302
+    assert ('Set-Cookie', 'cork=""; expires=Thu, 01 Jan 1970 00:00:00 '
+            'GMT; Max-Age=-1; Path=/') in e.headerlist, e.headerlist
+    new_request()
+    assert_raises(bottle.HTTPResponse, aaa.logout)
@@ -0,0 +1,216 @@
+#
+# Unit tests for AsyncCork
+#
+
+from nose import SkipTest
+from nose.tools import assert_raises, raises
+import asyncio
+
+from cork import (AAAException, AsyncCork, AuthException, Cork,
+    HashingBusyException, MemoryBackend, ThreadedAsyncBackend)
+from cork import tokens
+
+
+def new_cork(**kw):
+    b = MemoryBackend(
+        users={'admin': {'role': 'admin', 'hash': Cork(backend=MemoryBackend())._hash('admin', 'pwd'),
+            'email_addr': 'a@a.a', 'company': 'ACME', 'perm': {},
+            'validated': True, 'creation_date': 0}},
+        roles={'admin': {'level': 100}, 'user': {'level': 50}})
+    return AsyncCork(backend=b, **kw)
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_sync_backend_is_wrapped():
+    aaa = new_cork()
+    assert isinstance(aaa._store, ThreadedAsyncBackend)
+
+def test_login_and_require():
+    aaa = new_cork()
+
+    async def scenario():
+        session = {}
+        with aaa.request_context(session):
+            assert not await aaa.login('admin', 'wrong')
+            with assert_raises(AuthException):
+                await aaa.require()
+            assert await aaa.login('admin', 'pwd')
+            await aaa.require(role='user')
+            await aaa.require(role='admin', fixed_role=True)
+            cu = await aaa.current_user()
+            assert cu.username == 'admin' and cu.level == 100
+        assert session == {'username': 'admin'}
+
+        # a new request with the same session
+        with aaa.request_context(session):
+            assert (await aaa.current_user()).username == 'admin'
+            await aaa.logout()
+            assert session == {}
+    run(scenario())
+
+@raises(AuthException)
+def test_current_user_outside_request():
+    run(new_cork().current_user())
+
+def test_contexts_are_isolated():
+    aaa = new_cork()
+
+    async def request(session, login):
+        with aaa.request_context(session):
+            if login:
+                await aaa.login('admin', 'pwd')
+            await asyncio.sleep(0)
+            try:
+                return (await aaa.current_user()).username
+            except AuthException:
+                return None
+
+    async def scenario():
+        return await asyncio.gather(request({}, True), request({}, False))
+    assert run(scenario()) == ['admin', None]
+
+def test_user_management():
+    aaa = new_cork()
+
+    async def scenario():
+        with aaa.request_context({}):
+            await aaa.login('admin', 'pwd')
+            await aaa.create_role('editor', 60)
+            with assert_raises(AAAException):
+                await aaa.create_role('editor', 60)
+            await aaa.create_user('phil', 'editor', 'secret', 'Widgets',
+                                  email_addr='p@w.w')
+            assert await aaa.verify_password('phil', 'secret')
+            phil = await aaa.user('phil')
+            await phil.update(permissions={'edit': True})
+            assert (await aaa.user('phil')).permissions == {'edit': True}
+            assert [u[0] async for u in aaa.users_by_company('Widgets')] == \
+                ['phil']
+            assert [u[0] async for u in aaa.list_users(order='desc')] == \
+                ['phil', 'admin']
+            assert ('editor', 60) in [r async for r in aaa.list_roles()]
+            with assert_raises(AAAException):
+                await aaa.delete_role('editor')
+            await aaa.delete_user('phil')
+            assert await aaa.user('phil') is None
+            await aaa.delete_role('editor')
+    run(scenario())
+
+def test_registration_and_reset():
+    aaa = new_cork(secret_keys=['key'])
+
+    async def scenario():
+        code = await aaa.register('jane', 'pwd', 'j@j.j', 'ACME')
+        assert await aaa.validate_registration(code) == 'jane'
+        with assert_raises(AuthException):
+            await aaa.validate_registration(code)
+        reset_code = await aaa._reset_code('jane', 'j@j.j')
+        await aaa.reset_password(reset_code, 'newpwd')
+        assert await aaa.verify_password('jane', 'newpwd')
+        assert await aaa._lookup_email('j@j.j') == 'jane'
+    run(scenario())
+
+def test_concurrent_reset():
+    aaa = new_cork(secret_keys=['key'])
+    hash_password = aaa._hash
+
+    async def scenario():
+        reset_code = await aaa._reset_code('admin', 'a@a.a')
+
+        async def concurrent_hash(username, pwd):
+            # the same token is used while this reset hashes its password
+            aaa._hash = hash_password
+            await aaa.reset_password(reset_code, 'otherpwd')
+            return await hash_password(username, pwd)
+
+        aaa._hash = concurrent_hash
+        with assert_raises(AuthException):
+            await aaa.reset_password(reset_code, 'newpwd')
+        assert await aaa.verify_password('admin', 'otherpwd')
+    run(scenario())
+
+def test_hashing_queue_timeout():
+    aaa = new_cork(hash_concurrency=1, hash_queue_timeout=0.01)
+
+    async def scenario():
+        slots = aaa._hashing_slots()
+        await slots.acquire()  # pool saturated
+        with assert_raises(HashingBusyException):
+            await aaa.login('admin', 'pwd')
+        slots.release()
+        with aaa.request_context({}):
+            assert await aaa.login('admin', 'pwd')
+    run(scenario())
+
+def test_hashing_slots_follow_the_event_loop():
+    aaa = new_cork(hash_concurrency=1)
+
+    async def slots():
+        return aaa._hashing_slots()
+    first = run(slots())
+    second = run(slots())
+    assert first is not second
+    assert new_cork()._hashing_slots() is None
+
+def test_users_bulk_missing_role():
+    aaa = new_cork()
+
+    async def scenario():
+        await aaa._store.users.insert('phil', {'role': 'gone',
+            'hash': '', 'email_addr': None, 'company': 'ACME', 'perm': {},
+            'validated': True, 'creation_date': 0})
+        users = await aaa.users_bulk(['admin', 'phil', 'nobody'])
+        assert sorted(users) == ['admin']
+        assert users['admin'].level == 100
+    run(scenario())
+
+def test_update_bumps_generation():
+    aaa = new_cork()
+
+    async def scenario():
+        admin = await aaa.user('admin')
+        gen = admin.info.get('gen', 0)
+        await admin.update(pwd='newpwd')
+        assert (await aaa._store.users.get('admin'))['gen'] == gen + 1
+        await admin.update(email_addr='b@b.b')
+        assert (await aaa._store.users.get('admin'))['gen'] == gen + 1
+        # the generation is incremented in storage, not from a stale copy
+        stale = await aaa.user('admin')
+        await admin.update(pwd='otherpwd')
+        await stale.update(pwd='stalepwd')
+        assert (await aaa._store.users.get('admin'))['gen'] == gen + 3
+    run(scenario())
+
+def test_roles_snapshot():
+    aaa = new_cork()
+
+    async def scenario():
+        roles = await aaa._roles()
+        assert roles.levels == {'admin': 100, 'user': 50}
+        assert await aaa._roles() is roles
+        with aaa.request_context({}):
+            await aaa.login('admin', 'pwd')
+            await aaa.create_role('editor', 60)
+        assert (await aaa._get_role('editor')) == {'level': 60}
+        assert (await aaa._roles()) is not roles
+    run(scenario())
+
+def test_stateless_registration():
+    if not tokens.sealing_available():
+        raise SkipTest
+    aaa = new_cork(secret_keys=['key'], stateless_registration=True)
+
+    async def scenario():
+        code = await aaa.register('jane', 'pwd', 'j@j.j', 'ACME')
+        assert await aaa._store.pending_registrations.count() == 0
+        assert await aaa.validate_registration(code) == 'jane'
+        await aaa._store.users.delete('jane')
+        with assert_raises(AuthException):
+            await aaa.validate_registration(code)
+    run(scenario())
+
+@raises(AAAException)
+def test_stateless_registration_requires_secret_keys():
+    new_cork(stateless_registration=True)
@@ -0,0 +1,96 @@
+#
+# Table range tests, run against every storage backend.
+# Couchbase views are emulated: no Couchbase server is needed.
+#
+
+import mock
+import os
+import shutil
+import tempfile
+
+from cork import MemoryBackend, SqliteBackend
+from cork.couchbase_backend import CouchbaseTable
+
+NAMES = ('a', 'b:1', 'b:2', 'b:3', 'b:4', 'c')
+
+
+def view_query(ids):
+    """Emulate the entry view over some document ids"""
+    from couchbase.views import ViewOrdering
+
+    def query(design_doc, view, opts):
+        descending = opts.get('order') == ViewOrdering.DESCENDING
+        rows = sorted(ids, reverse=descending)
+        first = opts.get('startkey_docid')
+        last = opts.get('endkey_docid')
+        if descending:
+            rows = [r for r in rows if (first is None or r <= first) and
+                    (last is None or r >= last)]
+        else:
+            rows = [r for r in rows if (first is None or r >= first) and
+                    (last is None or r <= last)]
+        rows = rows[opts.get('skip', 0):]
+        if opts.get('limit') is not None:
+            rows = rows[:opts['limit']]
+        result = mock.Mock()
+        result.rows.return_value = [mock.Mock(id=r) for r in rows]
+        return result
+    return query
+
+def memory_table():
+    return MemoryBackend(roles=dict((n, {}) for n in NAMES)).roles, None
+
+def sqlite_table():
+    tmpdir = tempfile.mkdtemp()
+    b = SqliteBackend(os.path.join(tmpdir, 'cork.db'))
+    for name in NAMES:
+        b.roles[name] = {}
+
+    def teardown():
+        b.close()
+        shutil.rmtree(tmpdir)
+    return b.roles, teardown
+
+def couchbase_table():
+    bucket = mock.Mock()
+    bucket.view_query.side_effect = view_query(['Role:%s' % n
+                                                for n in NAMES])
+    return CouchbaseTable(bucket, 'Role'), None
+
+
+def check_cursor_and_skip(new_table):
+    t, teardown = new_table()
+    try:
+        assert t.range(start_after='a', skip=1, limit=2) == ['b:2', 'b:3']
+        assert t.range(start_after='b:1', skip=2) == ['b:4', 'c']
+        assert t.range(start_after='b:4', skip=1) == []
+        assert t.range(start_after='c', descending=True, skip=1,
+                       limit=2) == ['b:3', 'b:2']
+        assert t.range(prefix='b:', start_after='b:1', skip=1) == \
+            ['b:3', 'b:4']
+        assert t.range(prefix='b:', start_after='b:4', descending=True,
+                       skip=1, limit=1) == ['b:2']
+        # cursor entries deleted in the meantime
+        assert t.range(start_after='b', limit=2) == ['b:1', 'b:2']
+        assert t.range(start_after='b', skip=1, limit=2) == ['b:2', 'b:3']
+        assert t.range(start_after='b:35', descending=True, limit=2) == \
+            ['b:3', 'b:2']
+    finally:
+        if teardown is not None:
+            teardown()
+
+def test_cursor_and_skip():
+    for new_table in (memory_table, sqlite_table, couchbase_table):
+        yield check_cursor_and_skip, new_table
+
+def test_paging_over_deleted_cursors():
+    ids = ['Role:%d' % n for n in range(6)]
+    bucket = mock.Mock()
+    bucket.view_query.side_effect = view_query(ids)
+    t = CouchbaseTable(bucket, 'Role', page_size=2)
+    names = []
+    for page in t._iter_pages():
+        names.extend(page)
+        # the cursor of the next page disappears
+        ids.remove('Role:%s' % page[-1])
+    assert names == [str(n) for n in range(6)]
@@ -0,0 +1,87 @@
+#
+# Unit tests for the process-local table cache
+#
+
+from cork.base_backend import CachedTable
+
+
+def test_read_through():
+    table = {'admin': {'level': 100}}
+    cache = CachedTable(table, max_size=10, ttl=60)
+    assert cache['admin'] == {'level': 100}
+    assert cache['admin'] == {'level': 100}
+    assert 'admin' in cache
+    assert 'nobody' not in cache
+    stats = cache.stats()
+    assert stats['hits'] == 2
+    assert stats['misses'] == 2
+    assert stats['size'] == 1
+
+def test_cached_values_are_copies():
+    cache = CachedTable({'admin': {'level': 100}}, max_size=10, ttl=60)
+    cache['admin']['level'] = 1
+    assert cache['admin'] == {'level': 100}
+
+def test_write_invalidates():
+    table = {'admin': {'level': 100}}
+    cache = CachedTable(table, max_size=10, ttl=60)
+    cache['admin']
+    cache['admin'] = {'level': 90}
+    assert cache['admin'] == {'level': 90}
+    assert cache.pop('admin') == {'level': 90}
+    assert 'admin' not in cache
+    cache['user'] = {'level': 50}
+    cache['user']
+    del cache['user']
+    assert 'user' not in table
+    assert 'user' not in cache
+
+def test_expiry():
+    table = {'admin': {'level': 100}}
+    cache = CachedTable(table, max_size=10, ttl=0)
+    cache['admin']
+    table['admin'] = {'level': 90}
+    assert cache['admin'] == {'level': 90}
+    assert cache.stats()['hits'] == 0
+
+def test_lru_eviction():
+    table = dict((str(n), {'level': n}) for n in range(5))
+    cache = CachedTable(table, max_size=2, ttl=60)
+    cache['0']
+    cache['1']
+    cache['0']
+    cache['2']  # evicts '1'
+    stats = cache.stats()
+    assert stats['evictions'] == 1
+    assert stats['size'] == 2
+    cache['0']
+    assert cache.stats()['hits'] == 2
+    cache['1']
+    assert cache.stats()['misses'] == 4
+
+def test_get():
+    cache = CachedTable({'admin': {'level': 100}}, max_size=10, ttl=60)
+    assert cache.get('admin') == {'level': 100}
+    assert cache.get('nobody') is None
+    assert cache.get('nobody', 42) == 42
+    assert 'admin' in cache
+    assert cache.stats()['hits'] == 1
+
+class MultiGetTable(dict):
+    """dict exposing the table multi-get API"""
+    def get_many(self, items):
+        self.multi_gets = getattr(self, 'multi_gets', 0) + 1
+        return dict((i, self[i]) for i in items if i in self)
+
+def test_get_many():
+    table = MultiGetTable(a={'level': 1}, b={'level': 2})
+    cache = CachedTable(table, max_size=10, ttl=60)
+    cache['a']
+    assert cache.get_many(['a', 'b', 'c']) == {'a': {'level': 1},
+                                               'b': {'level': 2}}
+    assert table.multi_gets == 1
+    assert cache.get_many(['a', 'b']) == {'a': {'level': 1}, 'b': {'level': 2}}
+    assert table.multi_gets == 1
+    stats = cache.stats()
+    assert stats['hits'] == 3
+    assert stats['misses'] == 3
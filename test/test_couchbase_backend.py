@@ -0,0 +1,341 @@
+#
+# Unit tests for the Couchbase bucket registry and tables.
+# The connection itself is replaced: no Couchbase server is needed.
+#
+
+from nose.tools import raises
+import asyncio
+import mock
+
+from cork import (BackendIOException, ConcurrentUpdateException,
+    CouchbaseBackend)
+from cork import couchbase_backend
+from cork.acouchbase_backend import AsyncCouchbaseTable
+from cork.couchbase_backend import CouchbaseTable
+
+
+def fake_open_bucket(db_host, db_password, db_bucket):
+    return mock.Mock(name='cluster'), mock.Mock(name=db_bucket)
+
+def setup_registry():
+    couchbase_backend._reset_buckets()
+    return mock.patch.object(couchbase_backend, '_open_bucket',
+                             side_effect=fake_open_bucket)
+
+def mock_bucket(*pages):
+    """Bucket whose view queries return `pages` of document ids, in turn
+
+    :returns: (bucket, collection) tuple
+    """
+    bucket = mock.Mock(name='bucket')
+    client = mock.MagicMock(name='collection')
+    bucket.default_collection.return_value = client
+    bucket.view_query.return_value.rows.side_effect = [
+        [mock.Mock(id=i) for i in page] for page in pages]
+    return bucket, client
+
+def mock_result(entry, cas=1):
+    """Collection get result"""
+    result = mock.MagicMock(cas=cas)
+    result.content_as.__getitem__.return_value = entry
+    return result
+
+class AsyncRows(object):
+    """Async view query result"""
+
+    def __init__(self, ids):
+        self.ids = ids
+
+    async def __aiter__(self):
+        for i in self.ids:
+            yield mock.Mock(id=i)
+
+def mock_async_backend(*pages):
+    """Async backend whose view queries return `pages` of document ids
+
+    :returns: (backend, collection) tuple
+    """
+    client = mock.AsyncMock(name='collection')
+    client.binary = mock.Mock()
+    bucket = mock.Mock(name='bucket')
+    bucket.default_collection.return_value = client
+    bucket.view_query.side_effect = [AsyncRows(page) for page in pages]
+    backend = mock.Mock(name='backend')
+    backend.connect = mock.AsyncMock(return_value=bucket)
+    return backend, client
+
+
+def test_lazy_connection():
+    with setup_registry() as opener:
+        b = CouchbaseBackend('h1', 'pwd', 'b1')
+        assert opener.call_count == 0
+        b.connect()
+        assert opener.call_count == 1
+        b.users.client
+        assert opener.call_count == 1
+
+def test_shared_connection():
+    with setup_registry() as opener:
+        b1 = CouchbaseBackend('h1', 'pwd', 'b1')
+        b2 = CouchbaseBackend('h1', 'pwd', 'b1')
+        b3 = CouchbaseBackend('h1', 'pwd', 'b2')
+        assert b1.users.client is b2.roles.client
+        assert b1.users.client is not b3.users.client
+        assert opener.call_count == 2
+
+def test_reconnect_after_fork():
+    with setup_registry() as opener:
+        b = CouchbaseBackend('h1', 'pwd', 'b1')
+        parent = b.bucket.connect()
+        with mock.patch('os.getpid', return_value=-1):
+            child = b.bucket.connect()
+        assert child is not parent
+        assert opener.call_count == 2
+        couchbase_backend._reset_buckets()
+        assert b.bucket.connect() is not child
+
+def test_expiring_entries_are_not_counted():
+    bucket, client = mock_bucket(['Register:code'])
+    t = CouchbaseTable(bucket, 'Register', expiring=True)
+    assert t.insert('code', {'username': 'phil'}, ttl=60)
+    options = client.insert.call_args[0][2]
+    assert options['expiry'].total_seconds() == 60
+    # the server deletes expired entries without updating a counter
+    assert len(t) == 1
+    assert not client.binary.called
+    assert not client.upsert.called
+
+@raises(ValueError)
+def test_expiry_needs_expiring_table():
+    bucket, client = mock_bucket()
+    CouchbaseTable(bucket, 'User').insert('phil', {}, ttl=60)
+
+def test_async_expiring_entries_are_not_counted():
+    backend, client = mock_async_backend(['Register:code'])
+    t = AsyncCouchbaseTable(backend, 'Register', expiring=True)
+
+    async def scenario():
+        assert await t.insert('code', {'username': 'phil'}, ttl=60)
+        assert await t.count() == 1
+    asyncio.run(scenario())
+    assert not client.binary.called
+    assert not client.upsert.called
+
+def test_registrations_expire():
+    with setup_registry():
+        b = CouchbaseBackend('h1', 'pwd', 'b1')
+        assert b.pending_registrations.expiring
+        assert not b.users.expiring
+
+def test_mutate_single_request():
+    bucket, client = mock_bucket()
+    t = CouchbaseTable(bucket, 'User')
+    upsert = dict((('perm', 'p%d' % n), True) for n in range(16))
+    t.mutate('phil', upsert=upsert)
+    assert client.mutate_in.call_count == 1
+    key, specs = client.mutate_in.call_args[0]
+    assert key == 'User:phil' and len(specs) == 16
+    assert not client.replace.called
+
+def test_large_mutate_replaces_document():
+    from couchbase.exceptions import CasMismatchException
+    bucket, client = mock_bucket()
+    stale = mock.MagicMock(cas=1)
+    stale.content_as.__getitem__.return_value = {'perm': {'old': True}}
+    fresh = mock.MagicMock(cas=2)
+    fresh.content_as.__getitem__.return_value = {'perm': {'old': True},
+                                                 'role': 'user'}
+    client.get.side_effect = [stale, fresh]
+    client.replace.side_effect = [CasMismatchException(), None]
+    t = CouchbaseTable(bucket, 'User')
+    upsert = dict((('perm', 'p%d' % n), True) for n in range(17))
+    t.mutate('phil', upsert=upsert, remove=[('perm', 'old')])
+    assert not client.mutate_in.called
+    assert client.replace.call_count == 2
+    key, entry, options = client.replace.call_args[0]
+    assert key == 'User:phil'
+    assert entry['role'] == 'user'
+    assert sorted(entry['perm']) == sorted('p%d' % n for n in range(17))
+    assert options['cas'] == 2
+
+def test_mutate_expect_replaces_document():
+    bucket, client = mock_bucket()
+    result = mock.MagicMock(cas=1)
+    result.content_as.__getitem__.return_value = {'hash': 'old'}
+    client.get.return_value = result
+    t = CouchbaseTable(bucket, 'User')
+    assert not t.mutate('phil', upsert={('hash',): 'new'},
+                        expect={('hash',): 'other'})
+    assert not client.replace.called
+    assert t.mutate('phil', upsert={('hash',): 'new'},
+                    expect={('hash',): 'old'})
+    assert not client.mutate_in.called
+    key, entry, options = client.replace.call_args[0]
+    assert entry == {'hash': 'new'} and options['cas'] == 1
+
+def test_async_large_mutate_replaces_document():
+    backend, client = mock_async_backend()
+    result = mock.MagicMock(cas=1)
+    result.content_as.__getitem__.return_value = {'perm': {}}
+    client.get.return_value = result
+    t = AsyncCouchbaseTable(backend, 'User')
+    upsert = dict((('perm', 'p%d' % n), True) for n in range(17))
+    asyncio.run(t.mutate('phil', upsert=upsert))
+    assert not client.mutate_in.called
+    key, entry, options = client.replace.call_args[0]
+    assert len(entry['perm']) == 17 and options['cas'] == 1
+
+def test_get_many_misses():
+    from couchbase.exceptions import DocumentNotFoundException
+    bucket, client = mock_bucket()
+    client.get_multi.return_value = mock.Mock(
+        results={'User:phil': mock_result({'role': 'user'})},
+        exceptions={'User:bob': DocumentNotFoundException()})
+    t = CouchbaseTable(bucket, 'User')
+    assert t.get_many(['phil', 'bob']) == {'phil': {'role': 'user'}}
+    keys = client.get_multi.call_args[0][0]
+    assert sorted(keys) == ['User:bob', 'User:phil']
+    assert t.get_many([]) == {}
+    assert client.get_multi.call_count == 1
+
+@raises(BackendIOException)
+def test_get_many_errors():
+    from couchbase.exceptions import TimeoutException
+    bucket, client = mock_bucket()
+    client.get_multi.return_value = mock.Mock(
+        results={}, exceptions={'User:bob': TimeoutException()})
+    CouchbaseTable(bucket, 'User').get_many(['bob'])
+
+def test_paged_iteration():
+    bucket, client = mock_bucket(['User:a', 'User:b'], ['User:b', 'User:c'])
+    client.get_multi.side_effect = [
+        mock.Mock(results={'User:a': mock_result({'n': 1}),
+                           'User:b': mock_result({'n': 2})}, exceptions={}),
+        # c deleted in the meantime
+        mock.Mock(results={}, exceptions={})]
+    t = CouchbaseTable(bucket, 'User', page_size=2)
+    assert list(t.items()) == [('a', {'n': 1}), ('b', {'n': 2})]
+    first, following = [c[0][2] for c in bucket.view_query.call_args_list]
+    assert first['limit'] == 2 and first['skip'] == 0
+    assert 'startkey_docid' not in first
+    # the cursor row is fetched again, then dropped
+    assert following['startkey_docid'] == 'User:b'
+    assert following['limit'] == 3 and following['skip'] == 0
+
+def test_range_options():
+    from couchbase.views import ViewOrdering
+    bucket, client = mock_bucket(['User:b:2', 'User:b:1'])
+    t = CouchbaseTable(bucket, 'User')
+    assert t.range(prefix='b:', descending=True, skip=3, limit=2) == \
+        ['b:2', 'b:1']
+    opts = bucket.view_query.call_args[0][2]
+    assert opts['startkey_docid'] == u'User:b:\uffff'
+    assert opts['endkey_docid'] == 'User:b:'
+    assert opts['order'] == ViewOrdering.DESCENDING
+    assert opts['skip'] == 3 and opts['limit'] == 2
+
+def test_counter():
+    from couchbase.exceptions import DocumentNotFoundException
+    bucket, client = mock_bucket()
+    binary = client.binary.return_value
+    t = CouchbaseTable(bucket, 'User')
+    assert t.insert('phil', {})
+    options = binary.increment.call_args[0][1]
+    assert binary.increment.call_args[0][0] == '_count:User'
+    assert options['delta'].value == 1
+    del t['phil']
+    assert binary.decrement.call_args[0][0] == '_count:User'
+    # deleting a missing entry leaves the counter alone
+    client.remove.side_effect = DocumentNotFoundException()
+    del t['phil']
+    assert binary.decrement.call_count == 1
+    client.get.return_value = mock_result(3)
+    assert len(t) == 3
+    assert client.get.call_args[0][0] == '_count:User'
+
+def test_counter_rebuilt():
+    from couchbase.exceptions import DocumentNotFoundException
+    bucket, client = mock_bucket(['User:a', 'User:b'])
+    client.get.side_effect = DocumentNotFoundException()
+    t = CouchbaseTable(bucket, 'User')
+    assert len(t) == 2
+    client.upsert.assert_called_once_with('_count:User', 2)
+
+def test_counter_failure_is_not_fatal():
+    from couchbase.exceptions import TimeoutException
+    bucket, client = mock_bucket()
+    client.binary.return_value.increment.side_effect = TimeoutException()
+    assert CouchbaseTable(bucket, 'User').insert('phil', {})
+
+def test_mutate_paths():
+    import couchbase.subdocument as SD
+    bucket, client = mock_bucket()
+    t = CouchbaseTable(bucket, 'User')
+    t.mutate('phil', upsert={('perm', 'a.b`c'): True, ('role',): 'user'})
+    client.mutate_in.assert_called_once_with('User:phil', [
+        SD.upsert('`perm`.`a.b``c`', True, create_parents=True),
+        SD.upsert('`role`', 'user', create_parents=True)])
+
+def test_mutate_increment():
+    import couchbase.subdocument as SD
+    bucket, client = mock_bucket()
+    t = CouchbaseTable(bucket, 'User')
+    t.mutate('phil', upsert={('hash',): 'h'}, increment={('gen',): 1})
+    client.mutate_in.assert_called_once_with('User:phil', [
+        SD.upsert('`hash`', 'h', create_parents=True),
+        SD.counter('`gen`', 1, create_parents=True)])
+
+def test_mutate_removals():
+    import couchbase.subdocument as SD
+    from couchbase.exceptions import CasMismatchException
+    bucket, client = mock_bucket()
+    found = mock.Mock(cas=7)
+    found.exists.side_effect = lambda n: n == 0
+    client.lookup_in.return_value = found
+    client.mutate_in.side_effect = [CasMismatchException(), None]
+    t = CouchbaseTable(bucket, 'User')
+    t.mutate('phil', upsert={('role',): 'user'},
+             remove=[('perm', 'a'), ('perm', 'missing')])
+    assert client.lookup_in.call_args[0][1] == [SD.exists('`perm`.`a`'),
+        SD.exists('`perm`.`missing`')]
+    # retried after the conflict, against the same document version
+    assert client.mutate_in.call_count == 2
+    key, specs, options = client.mutate_in.call_args[0]
+    assert specs == [SD.upsert('`role`', 'user', create_parents=True),
+                     SD.remove('`perm`.`a`')]
+    assert options['cas'] == 7
+
+def test_mutate_nothing_to_remove():
+    bucket, client = mock_bucket()
+    found = mock.Mock(cas=7)
+    found.exists.return_value = False
+    client.lookup_in.return_value = found
+    CouchbaseTable(bucket, 'User').mutate('phil', remove=[('perm', 'a')])
+    assert not client.mutate_in.called
+
+@raises(KeyError)
+def test_mutate_missing_entry():
+    from couchbase.exceptions import DocumentNotFoundException
+    bucket, client = mock_bucket()
+    client.mutate_in.side_effect = DocumentNotFoundException()
+    CouchbaseTable(bucket, 'User').mutate('phil', upsert={('role',): 'user'})
+
+def test_pop_conflict():
+    from couchbase.exceptions import CasMismatchException
+    bucket, client = mock_bucket()
+    client.get.side_effect = [mock_result({'n': 1}, cas=1),
+                              mock_result({'n': 2}, cas=2)]
+    client.remove.side_effect = [CasMismatchException(), None]
+    t = CouchbaseTable(bucket, 'User')
+    # the version removed is the one returned
+    assert t.pop('phil') == {'n': 2}
+    assert client.remove.call_args[0][1]['cas'] == 2
+    assert client.binary.return_value.decrement.call_count == 1
+
+@raises(ConcurrentUpdateException)
+def test_pop_too_many_conflicts():
+    from couchbase.exceptions import CasMismatchException
+    bucket, client = mock_bucket()
+    client.get.return_value = mock_result({})
+    client.remove.side_effect = CasMismatchException()
+    CouchbaseTable(bucket, 'User', cas_retries=3).pop('phil')
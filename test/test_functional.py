@@ -19,7 +19,7 @@ import shutil
 import sys
 
 import testutils
-from cork import Cork
+from cork import Cork, MemoryBackend
 
 REDIR = '302 Found'
 
@@ -29,6 +29,7 @@ class Test(object):
     def __init__(self):
         self._tmpdir = None
         self._tmproot = None
+        self._conf_source = None
         self._app = None
         self._starting_dir = os.getcwd()
 
@@ -38,39 +39,41 @@ class Test(object):
         """Populate a directory with valid configuration files, to be run just once
         The files are not modified by each test
         """
-        self._tmpdir = os.path.join(self,_tmproot, "cork_functional_test_source")
+        self._conf_source = os.path.join(self._tmproot, "cork_functional_test_source")
 
         # only do this once, as advertised
-        if os.path.exists(self._tmpdir): return
+        if os.path.exists(self._conf_source): return
 
-        os.mkdir(self._tmpdir)
-        os.mkdir(self._tmpdir + "/example_conf")
+        os.mkdir(self._conf_source)
+        os.mkdir(self._conf_source + "/example_conf")
 
-        cork = Cork(os.path.join(self._tmpdir, "example_conf"), initialize=True)
-
-        cork._store.roles['admin'] = 100
-        cork._store.roles['editor'] = 60
-        cork._store.roles['user'] = 50
-        cork._store._savejson('roles', cork._store.roles)
+        backend = MemoryBackend(roles={
+            'admin': {'level': 100},
+            'editor': {'level': 60},
+            'user': {'level': 50},
+        })
+        cork = Cork(backend=backend)
 
         tstamp = str(datetime.utcnow())
-        username = password = 'admin'
-        cork._store.users[username] = {
-            'role': 'admin',
-            'hash': cork._hash(username, password),
-            'email_addr': username + '@localhost.local',
-            'desc': username + ' test user',
-            'creation_date': tstamp
-        }
-        username = password = ''
-        cork._store.users[username] = {
-            'role': 'user',
-            'hash': cork._hash(username, password),
-            'email_addr': username + '@localhost.local',
-            'desc': username + ' test user',
-            'creation_date': tstamp
-        }
-        cork._store._save_users()
+        for username, role in (('admin', 'admin'), ('', 'user')):
+            password = username
+            backend.users[username] = {
+                'role': role,
+                'hash': cork._hash(username, password),
+                'email_addr': username + '@localhost.local',
+                'desc': username + ' test user',
+                'company': 'ACME',
+                'perm': {},
+                'validated': True,
+                'creation_date': tstamp
+            }
+
+        # dump the tables in the format loaded by simple_webapp
+        for name in ('users', 'roles'):
+            path = os.path.join(self._conf_source, 'example_conf',
+                                '%s.json' % name)
+            with open(path, 'w') as f:
+                json.dump(dict(getattr(backend, name).items()), f)
 
     def remove_temp_dir(self):
         p = os.path.join(self._tmproot, 'cork_functional_test_wd')
@@ -96,6 +99,7 @@ class Test(object):
         # purge the temporary test directory
         self.remove_temp_dir()
 
+        self.populate_conf_directory()
         self.populate_temp_dir()
         self.create_app_instance()
         self._app.reset()
@@ -124,7 +128,7 @@ class Test(object):
 
         # copy the needed files
         shutil.copytree(
-            os.path.join(self._starting_dir, 'test/example_conf'),
+            os.path.join(self._conf_source, 'example_conf'),
             os.path.join(self._tmpdir, 'example_conf')
         )
         shutil.copytree(
@@ -185,11 +189,11 @@ class Test(object):
         print('myrole', repr(p))
 
         p = self._app.get('/admin')
-        assert 'Welcome' in p.body, repr(p)
+        assert 'Welcome' in p.text, repr(p)
 
         p = self._app.get('/my_role', status=200)
         assert p.status == '200 OK'
-        assert p.body == 'admin', "Sta"
+        assert p.text == 'admin', "Sta"
 
         print("Login performed")
 
@@ -304,9 +308,9 @@ class Test(object):
             'password': password,
             'role': 'user'
         })
-        retj = json.loads(ret.body)
+        retj = json.loads(ret.text)
         assert 'ok' in retj and retj['ok'] == True, "Failed user creation: %s" % \
-            ret.body
+            ret.text
 
         # log out
         assert self._app.get('/logout').status == REDIR
@@ -0,0 +1,99 @@
+#
+# Unit tests for the password hashing schemes
+#
+
+from nose import SkipTest
+from nose.tools import assert_raises, raises
+import mock
+
+from cork import AAAException, hashing
+
+
+def test_schemes_roundtrip():
+    for hasher in (hashing.PBKDF2Hasher(iterations=1000),
+                   hashing.ScryptHasher(n=2 ** 10)):
+        h = hasher.hash(b'secret')
+        assert hashing.identify(h) == hasher.name
+        assert hashing.verify_password(b'secret', h)
+        assert not hashing.verify_password(b'secreT', h)
+        assert not hasher.needs_rehash(h)
+
+def test_needs_rehash():
+    h = hashing.PBKDF2Hasher(iterations=1000).hash(b'secret')
+    assert hashing.PBKDF2Hasher(iterations=2000).needs_rehash(h)
+    assert hashing.ScryptHasher().needs_rehash(h)
+    assert hashing.PBKDF2Hasher().needs_rehash('cAEBAQEB')
+
+def test_salt():
+    hasher = hashing.PBKDF2Hasher(iterations=1000)
+    assert hasher.hash(b'secret', b'salt') == hasher.hash(b'secret', b'salt')
+    assert hasher.hash(b'secret') != hasher.hash(b'secret')
+
+def test_malformed_hashes():
+    for h in ('', '$', '$pbkdf2-sha256$i=x$$', '$pbkdf2-sha256$i=1000$!$!',
+              'not base64'):
+        assert not hashing.verify_password(b'secret', h), h
+
+def test_get_hasher():
+    assert isinstance(hashing.get_hasher(), hashing.PBKDF2Hasher)
+    assert isinstance(hashing.get_hasher('scrypt'), hashing.ScryptHasher)
+    hasher = hashing.ScryptHasher()
+    assert hashing.get_hasher(hasher) is hasher
+    with assert_raises(ValueError):
+        hashing.get_hasher('md5')
+
+def test_argon2():
+    try:
+        import argon2
+    except ImportError:
+        raise SkipTest("argon2-cffi is not installed")
+    hasher = hashing.Argon2Hasher(time_cost=1, memory_cost=1024)
+    h = hasher.hash(b'secret')
+    assert hashing.verify_password(b'secret', h)
+    assert not hashing.verify_password(b'other', h)
+    assert hashing.Argon2Hasher().needs_rehash(h)
+
+def test_argon2_missing():
+    h = '$argon2id$v=19$m=1024,t=1,p=4$c2FsdHNhbHQ$aGFzaGhhc2g'
+    with mock.patch.dict('sys.modules', {'argon2': None,
+                                         'argon2.exceptions': None}):
+        assert not hashing.verify_password(b'secret', h)
+
+@raises(AAAException)
+def test_invalid_parameters():
+    hashing.verify_password(b'secret', '$pbkdf2-sha256$i=0$c2FsdA==$aGFzaA==')
+
+@raises(AAAException)
+def test_no_iterations():
+    hashing.PBKDF2Hasher(iterations=0)
+
+def test_pool_executor():
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(2) as executor:
+        pool = hashing.HashingPool(executor, concurrency=2)
+        h = pool.run(hashing.PBKDF2Hasher(iterations=1000).hash, b'secret')
+        assert pool.run(hashing.verify_password, b'secret', h)
+
+def test_pool_queue_timeout():
+    import threading
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return 'done'
+
+    pool = hashing.HashingPool(concurrency=1, queue_timeout=0.05)
+    results = []
+    t = threading.Thread(target=lambda: results.append(pool.run(slow)))
+    t.start()
+    started.wait(5)
+    with assert_raises(hashing.HashingBusyException) as busy:
+        pool.run(slow)
+    assert isinstance(busy.exception, AAAException)
+    release.set()
+    t.join()
+    assert results == ['done']
+    # the slot is free again
+    assert pool.run(len, 'ab') == 2
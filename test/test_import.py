@@ -0,0 +1,28 @@
+#
+# Check that `import cork` does not load optional or heavy dependencies
+#
+
+from nose.tools import assert_raises
+import os
+import subprocess
+import sys
+
+DEFERRED = ('bottle', 'beaker', 'smtplib', 'email.mime', 'uuid', 'asyncio',
+            'sqlite3', 'couchbase')
+
+
+def test_deferred_imports():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = ("import sys, cork; "
+            "print(' '.join(m for m in %r if m in sys.modules))" % (DEFERRED,))
+    out = subprocess.check_output([sys.executable, '-c', code],
+        env=dict(os.environ, PYTHONPATH=root), universal_newlines=True)
+    assert out.split() == [], out
+
+def test_lazy_exports():
+    import cork
+    assert cork.AsyncCork.__name__ == 'AsyncCork'
+    assert cork.SqliteBackend.__module__ == 'cork.sqlite_backend'
+    assert 'AsyncCork' in dir(cork)
+    with assert_raises(AttributeError):
+        cork.Nonexistent
@@ -0,0 +1,136 @@
+#
+# Unit tests for the in-memory storage backend
+#
+
+from nose.tools import assert_raises
+from threading import Thread
+
+from cork import MemoryBackend
+from cork.memory_backend import MemoryTable
+
+
+def test_backend_tables():
+    b = MemoryBackend(roles={'admin': {'level': 100}})
+    for name in b.table_names:
+        assert hasattr(b, name), name
+    assert b.roles['admin'] == {'level': 100}
+    assert len(b.users) == 0
+    assert b.reconcile_counts()['roles'] == 1
+    assert b.cache_stats() == {}
+
+def test_get_set_delete():
+    t = MemoryTable()
+    t['a'] = {'x': 1}
+    assert 'a' in t
+    assert t['a'] == {'x': 1}
+    assert t.get('b') is None
+    assert t.get_many(['a', 'b']) == {'a': {'x': 1}}
+    assert t.pop('a') == {'x': 1}
+    assert 'a' not in t
+    with assert_raises(KeyError):
+        t.pop('a')
+    del t['a']  # not an error
+
+def test_values_are_copies():
+    t = MemoryTable({'a': {'x': {'y': 1}}})
+    t['a']['x']['y'] = 2
+    assert t['a'] == {'x': {'y': 1}}
+
+def test_range():
+    t = MemoryTable(dict((n, {}) for n in ('a', 'b:1', 'b:2', 'b:3', 'c')))
+    assert t.range() == ['a', 'b:1', 'b:2', 'b:3', 'c']
+    assert t.range(limit=2, skip=1) == ['b:1', 'b:2']
+    assert t.range(start_after='b:1') == ['b:2', 'b:3', 'c']
+    assert t.range(start_after='aa', limit=1) == ['b:1']
+    assert t.range(descending=True, limit=2) == ['c', 'b:3']
+    assert t.range(descending=True, start_after='b:2') == ['b:1', 'a']
+    assert t.range(prefix='b:') == ['b:1', 'b:2', 'b:3']
+    assert t.range(prefix='b:', start_after='b:1', limit=1) == ['b:2']
+    assert t.range(prefix='b:', descending=True) == ['b:3', 'b:2', 'b:1']
+
+def test_iteration():
+    t = MemoryTable(dict((str(n), {'n': n}) for n in range(5)), page_size=2)
+    assert list(t) == ['0', '1', '2', '3', '4']
+    assert list(t.keys()) == list(t)
+    assert [v['n'] for v in t.values()] == [0, 1, 2, 3, 4]
+    for name, entry in t.items():
+        t.pop(name)  # deleting while iterating is allowed
+    assert len(t) == 0
+
+def test_thread_safety():
+    t = MemoryTable()
+    def worker(n):
+        for i in range(200):
+            t['%d:%d' % (n, i)] = {}
+    threads = [Thread(target=worker, args=(n,)) for n in range(8)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    assert len(t) == 1600
+    assert t.range() == sorted(t.range())
+
+def test_mutate():
+    t = MemoryTable({'a': {'x': 1, 'perm': {'p': 1, 'q': 2}}})
+    t.mutate('a', upsert={('x',): 2, ('perm', 'r'): 3, ('new', 'y'): 4},
+             remove=[('perm', 'p'), ('perm', 'missing'), ('nope', 'z')])
+    assert t['a'] == {'x': 2, 'perm': {'q': 2, 'r': 3}, 'new': {'y': 4}}
+    with assert_raises(KeyError):
+        t.mutate('b', upsert={('x',): 1})
+
+def test_mutate_increment():
+    t = MemoryTable({'a': {'x': 1}})
+    t.mutate('a', increment={('x',): 2, ('new', 'y'): 1})
+    t.mutate('a', increment={('new', 'y'): 1})
+    assert t['a'] == {'x': 3, 'new': {'y': 2}}
+
+def test_mutate_expect():
+    t = MemoryTable({'a': {'x': 1, 'perm': {'p': 1}}})
+    assert not t.mutate('a', upsert={('x',): 2}, expect={('x',): 0})
+    assert not t.mutate('a', upsert={('x',): 2}, expect={('perm', 'q'): 1})
+    assert t['a']['x'] == 1
+    assert t.mutate('a', upsert={('x',): 2},
+                    expect={('x',): 1, ('perm', 'p'): 1, ('y',): None})
+    assert t['a']['x'] == 2
+
+def test_insert():
+    t = MemoryTable()
+    assert t.insert('a', {'x': 1})
+    assert not t.insert('a', {'x': 2})
+    assert t['a'] == {'x': 1}
+    assert t.range() == ['a']
+
+def test_concurrent_user_updates():
+    from cork import Cork
+    b = MemoryBackend(roles={'user': {'level': 50}})
+    b.users['phil'] = {'role': 'user', 'hash': '', 'email_addr': None,
+        'company': 'ACME', 'perm': {'drop': True}, 'validated': True,
+        'creation_date': 0}
+    aaa = Cork(backend=b)
+
+    def worker(n):
+        for i in range(50):
+            aaa.user('phil').update(permissions={'%d:%d' % (n, i): True})
+        aaa.user('phil').remove_permissions(['drop'])
+    threads = [Thread(target=worker, args=(n,)) for n in range(8)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    perm = b.users['phil']['perm']
+    assert len(perm) == 400, len(perm)
+    assert 'drop' not in perm
+
+def test_expiry():
+    t = MemoryTable()
+    assert t.insert('gone', {'x': 1}, ttl=-1)
+    assert t.insert('kept', {'x': 2}, ttl=60)
+    assert t.insert('rewritten', {'x': 3}, ttl=-1) and 'rewritten' not in t
+    assert t.insert('rewritten', {'x': 4}, ttl=-1)
+    t['rewritten'] = {'x': 5}  # no expiry
+    assert 'gone' not in t
+    assert t.get('gone') is None
+    assert t.range() == ['kept', 'rewritten']
+    assert len(t) == 2
+    assert t.insert('gone', {'x': 6})
+    assert t.purge_expired() == 0
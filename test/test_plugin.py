@@ -0,0 +1,113 @@
+#
+# Unit tests for the Bottle plugin
+#
+
+from nose.tools import assert_raises, raises
+import bottle
+import mock
+import wsgiref.util
+
+from cork import AAAException, Cork, CorkPlugin, MemoryBackend
+from cork import hashing
+
+
+def new_app():
+    aaa = Cork(backend=MemoryBackend(roles={'admin': {'level': 100},
+        'editor': {'level': 60}, 'user': {'level': 50}}),
+        session_mode='cookie', secret_keys=['key'],
+        password_hasher=hashing.PBKDF2Hasher(iterations=1000))
+    for username, role in (('ed', 'editor'), ('joe', 'user')):
+        aaa._store.users[username] = {'role': role, 'company': 'ACME',
+            'hash': aaa._hash(username, 'pwd'), 'email_addr': None,
+            'perm': {}, 'validated': True, 'creation_date': 0}
+    app = bottle.Bottle()
+    app.install(CorkPlugin(aaa))
+
+    @app.post('/login/<username>')
+    def login(username):
+        aaa.login(username, 'pwd')
+
+    @app.route('/public')
+    def public():
+        return 'public'
+
+    @app.route('/any', auth=True)
+    def any_user():
+        return aaa.current_user.username
+
+    @app.route('/edit', auth={'role': 'editor'})
+    def edit():
+        return 'edit'
+
+    @app.route('/users_only', auth={'role': 'user', 'fixed_role': True,
+                                    'fail_redirect': '/public'})
+    def users_only():
+        return 'users'
+
+    return aaa, app
+
+def call(app, path, cookie=None, method='GET'):
+    """Run a request through the app
+
+    :returns: (status code, body, session cookie set by the response)
+    """
+    environ = {'REQUEST_METHOD': method, 'PATH_INFO': path}
+    wsgiref.util.setup_testing_defaults(environ)
+    if cookie:
+        environ['HTTP_COOKIE'] = 'cork=%s' % cookie
+    status = []
+    body = b''.join(app(environ, lambda s, h, exc_info=None: status.append((s, h))))
+    s, headers = status[0]
+    set_cookie = [v.split(';')[0][len('cork='):] for k, v in headers
+                  if k == 'Set-Cookie' and v.startswith('cork=')]
+    return int(s.split()[0]), body.decode(), (set_cookie or [None])[0]
+
+def login(app, username):
+    return call(app, '/login/%s' % username, method='POST')[2]
+
+
+def test_unprotected_route():
+    aaa, app = new_app()
+    assert call(app, '/public')[:2] == (200, 'public')
+
+def test_unauthenticated():
+    aaa, app = new_app()
+    assert call(app, '/any')[0] == 401
+    assert call(app, '/edit', cookie='bogus')[0] == 401
+
+def test_role_threshold():
+    aaa, app = new_app()
+    ed, joe = login(app, 'ed'), login(app, 'joe')
+    assert call(app, '/any', ed)[:2] == (200, 'ed')
+    assert call(app, '/edit', ed)[:2] == (200, 'edit')
+    assert call(app, '/edit', joe)[0] == 403
+
+def test_fail_redirect():
+    aaa, app = new_app()
+    ed, joe = login(app, 'ed'), login(app, 'joe')
+    assert call(app, '/users_only', joe)[:2] == (200, 'users')
+    assert call(app, '/users_only', ed)[0] == 302
+
+def test_requirement_compiled_once():
+    aaa, app = new_app()
+    ed = login(app, 'ed')
+    call(app, '/edit', ed)
+    with mock.patch.object(aaa._store.roles, 'get') as get, \
+            mock.patch.object(aaa._store.users, 'get') as users_get:
+        for i in range(3):
+            assert call(app, '/edit', ed)[0] == 200
+        assert not get.called and not users_get.called
+
+def test_invalid_route_config():
+    aaa, app = new_app()
+    # routes are prepared when added in debug mode, on first use otherwise
+    with assert_raises(AAAException):
+        @app.route('/bad', auth={'role': 'nonexistent'})
+        def bad():
+            return 'bad'
+        app.routes[-1].call
+
+@raises(bottle.PluginError)
+def test_duplicate_plugin():
+    aaa, app = new_app()
+    app.install(CorkPlugin(aaa))
@@ -0,0 +1,42 @@
+#
+# Unit tests for the roles snapshot
+#
+
+from nose.tools import assert_raises
+
+from cork import MemoryBackend
+from cork.roles import RoleTable
+
+
+def test_lookups():
+    roles = RoleTable({'admin': 100, 'editor': 60, 'user': 50, 'guest': 0},
+                      version='v1')
+    assert roles.version == 'v1'
+    assert roles.level('editor') == 60
+    assert roles.level('nonexistent') is None
+    assert 'user' in roles and 'nonexistent' not in roles
+    assert len(roles) == 4
+    assert roles.items() == [('admin', 100), ('editor', 60), ('guest', 0),
+                             ('user', 50)]
+
+def test_roles_at_or_above():
+    roles = RoleTable({'admin': 100, 'editor': 60, 'user': 50, 'guest': 0})
+    assert roles.roles_at_or_above(60) == ('editor', 'admin')
+    assert roles.roles_at_or_above(51) == ('editor', 'admin')
+    assert roles.roles_at_or_above(0) == ('guest', 'user', 'editor', 'admin')
+    assert roles.roles_at_or_above(101) == ()
+
+def test_immutable():
+    levels = {'admin': 100}
+    roles = RoleTable(levels)
+    levels['user'] = 50
+    assert 'user' not in roles
+    with assert_raises(TypeError):
+        roles.levels['user'] = 50
+
+def test_load():
+    backend = MemoryBackend(roles={'admin': {'level': 100},
+                                   'user': {'level': 50}})
+    roles = RoleTable.load(backend.roles, 'v2')
+    assert roles.items() == [('admin', 100), ('user', 50)]
+    assert roles.version == 'v2'
@@ -0,0 +1,240 @@
+#
+# Unit tests for the SQLite storage backend
+#
+
+from nose.tools import assert_raises
+from threading import Thread
+import os
+import shutil
+import tempfile
+
+from cork import BackendIOException, Cork, SqliteBackend
+
+tmpdir = None
+
+
+def setup_backend(**kw):
+    global tmpdir
+    tmpdir = tempfile.mkdtemp()
+    return SqliteBackend(os.path.join(tmpdir, 'cork.db'), **kw)
+
+def teardown_backend(backend):
+    backend.close()
+    shutil.rmtree(tmpdir)
+
+
+def test_wal_mode():
+    b = setup_backend()
+    try:
+        conn = b.connection
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+    finally:
+        teardown_backend(b)
+
+def test_lookups_use_primary_keys():
+    b = setup_backend()
+    try:
+        b.roles['user'] = {'level': 50}
+        aaa = Cork(backend=b)
+        aaa._store.users['phil'] = {'role': 'user', 'hash': '',
+            'email_addr': 'p@a.a', 'company': 'ACME', 'perm': {},
+            'validated': True, 'creation_date': 0}
+        aaa.rebuild_indexes()
+        conn = b.connection
+        queries = []
+        conn.set_trace_callback(queries.append)
+        try:
+            assert aaa._lookup_email('p@a.a') == 'phil'
+            assert [u[0] for u in aaa.users_by_company('ACME')] == ['phil']
+            assert [u[0] for u in aaa.users_by_role('user')] == ['phil']
+        finally:
+            conn.set_trace_callback(None)
+        selects = [q for q in queries if q.startswith('SELECT')]
+        assert selects
+        for q in selects:
+            plan = repr(conn.execute("EXPLAIN QUERY PLAN " + q).fetchall())
+            assert 'SCAN' not in plan, (q, plan)
+    finally:
+        teardown_backend(b)
+
+def test_table():
+    b = setup_backend(page_size=2)
+    try:
+        t = b.users
+        t['phil'] = {'role': 'user', 'email_addr': 'p@a.a', 'perm': {'x': 1}}
+        assert 'phil' in t
+        assert 'bob' not in t
+        assert t['phil']['perm'] == {'x': 1}
+        assert t.get('bob') is None
+        t['bob'] = {'role': 'user'}
+        t['bob'] = {'role': 'admin'}
+        assert len(t) == 2
+        assert t.get_many(['bob', 'carl']) == {'bob': {'role': 'admin'}}
+        t['carl'] = {}
+        assert list(t) == ['bob', 'carl', 'phil']
+        assert [name for name, e in t.items()] == ['bob', 'carl', 'phil']
+        assert t.pop('carl') == {}
+        del t['carl']
+        with assert_raises(KeyError):
+            t.pop('carl')
+    finally:
+        teardown_backend(b)
+
+def test_range():
+    b = setup_backend()
+    try:
+        t = b.roles
+        for name in ('a', 'b:1', 'b:2', 'b:3', 'c'):
+            t[name] = {}
+        assert t.range() == ['a', 'b:1', 'b:2', 'b:3', 'c']
+        assert t.range(limit=2, skip=1) == ['b:1', 'b:2']
+        assert t.range(start_after='b:1') == ['b:2', 'b:3', 'c']
+        assert t.range(descending=True, start_after='b:2') == ['b:1', 'a']
+        assert t.range(prefix='b:', start_after='b:1', limit=1) == ['b:2']
+        assert t.range(prefix='b:', descending=True) == ['b:3', 'b:2', 'b:1']
+    finally:
+        teardown_backend(b)
+
+def test_threads():
+    b = setup_backend()
+    try:
+        def worker(n):
+            for i in range(20):
+                b.pending_registrations['%d:%d' % (n, i)] = {'creation_date': i}
+            b.close()
+        threads = [Thread(target=worker, args=(n,)) for n in range(4)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        assert len(b.pending_registrations) == 80
+    finally:
+        teardown_backend(b)
+
+def test_cork_with_sqlite():
+    b = setup_backend()
+    try:
+        b.roles['user'] = {'level': 50}
+        aaa = Cork(backend=b)
+        aaa._store.users['phil'] = {'role': 'user', 'hash': aaa._hash('phil', 'pwd'),
+            'email_addr': 'p@a.a', 'company': 'ACME', 'perm': {},
+            'validated': True, 'creation_date': 0}
+        aaa.rebuild_indexes()
+        assert aaa._lookup_email('p@a.a') == 'phil'
+        assert [u[0] for u in aaa.users_by_company('ACME')] == ['phil']
+        assert aaa.user('phil').level == 50
+        assert aaa.verify_password('phil', 'pwd')
+    finally:
+        teardown_backend(b)
+
+def test_mutate():
+    b = setup_backend()
+    try:
+        b.users['phil'] = {'role': 'user', 'perm': {'p': 1}}
+        b.users.mutate('phil', upsert={('role',): 'admin', ('perm', 'q'): 2},
+                       remove=[('perm', 'p')])
+        assert b.users['phil'] == {'role': 'admin', 'perm': {'q': 2}}
+        assert b.users.range(prefix='ph') == ['phil']
+    finally:
+        teardown_backend(b)
+
+def test_mutate_increment():
+    b = setup_backend()
+    try:
+        b.users['phil'] = {'role': 'user'}
+        b.users.mutate('phil', increment={('gen',): 1})
+        b.users.mutate('phil', upsert={('role',): 'admin'},
+                       increment={('gen',): 1})
+        assert b.users['phil'] == {'role': 'admin', 'gen': 2}
+    finally:
+        teardown_backend(b)
+
+def test_mutate_expect():
+    b = setup_backend()
+    try:
+        b.users['phil'] = {'role': 'user', 'hash': 'old'}
+        assert not b.users.mutate('phil', upsert={('hash',): 'new'},
+                                  expect={('hash',): 'other'})
+        assert b.users['phil']['hash'] == 'old'
+        assert b.users.mutate('phil', upsert={('hash',): 'new'},
+                              expect={('hash',): 'old'})
+        assert b.users['phil']['hash'] == 'new'
+    finally:
+        teardown_backend(b)
+
+def test_insert():
+    b = setup_backend()
+    try:
+        assert b.roles.insert('user', {'level': 50})
+        assert not b.roles.insert('user', {'level': 60})
+        assert b.roles['user'] == {'level': 50}
+    finally:
+        teardown_backend(b)
+
+def test_write_errors_surface():
+    b = setup_backend()
+    try:
+        b.connection.execute("DROP TABLE %s" % b.roles.table_name)
+        with assert_raises(BackendIOException):
+            b.roles['user'] = {'level': 50}
+    finally:
+        teardown_backend(b)
+
+def test_concurrent_user_updates():
+    b = setup_backend()
+    try:
+        b.roles['user'] = {'level': 50}
+        b.users['phil'] = {'role': 'user', 'hash': '', 'email_addr': None,
+            'company': 'ACME', 'perm': {'drop': True}, 'validated': True,
+            'creation_date': 0}
+        aaa = Cork(backend=b)
+
+        def worker(n):
+            for i in range(25):
+                aaa.user('phil').update(permissions={'%d:%d' % (n, i): True})
+            aaa.user('phil').remove_permissions(['drop'])
+            b.close()
+        threads = [Thread(target=worker, args=(n,)) for n in range(8)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        perm = b.users['phil']['perm']
+        assert len(perm) == 200, len(perm)
+        assert 'drop' not in perm
+    finally:
+        teardown_backend(b)
+
+def test_expiry():
+    b = setup_backend()
+    try:
+        t = b.pending_registrations
+        assert t.insert('gone', {'creation_date': 1}, ttl=-1)
+        assert t.insert('kept', {'creation_date': 2}, ttl=60)
+        assert 'gone' not in t
+        assert t.get_many(['gone', 'kept']) == {'kept': {'creation_date': 2}}
+        assert t.range() == ['kept'] and list(t) == ['kept']
+        assert len(t) == 1
+        t.mutate('kept', upsert={('x',): 1})
+        assert b.connection.execute("SELECT expires FROM %s WHERE name = ?"
+            % t.table_name, ('kept',)).fetchone()[0] is not None
+        assert t.purge_expired() == 1
+        assert t.insert('gone', {'creation_date': 3}, ttl=-1)
+        # an expired entry is replaced
+        assert t.insert('gone', {'creation_date': 4})
+        assert t['gone'] == {'creation_date': 4}
+        with assert_raises(ValueError):
+            b.users.insert('phil', {}, ttl=60)
+    finally:
+        teardown_backend(b)
+
+def test_expiry_column_migration():
+    b = setup_backend(initialize=False)
+    try:
+        b.connection.execute("CREATE TABLE register "
+            "(name TEXT PRIMARY KEY, data TEXT NOT NULL, creation_date)")
+        b.pending_registrations.create()
+        assert b.pending_registrations.insert('a', {'creation_date': 1},
+                                              ttl=60)
+    finally:
+        teardown_backend(b)
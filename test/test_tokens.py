@@ -0,0 +1,66 @@
+#
+# Unit tests for the signed tokens
+#
+
+from nose import SkipTest
+from nose.tools import assert_raises
+
+from cork import tokens
+import testutils
+
+
+def assert_invalid(signer, purpose, token):
+    with assert_raises(tokens.InvalidTokenException):
+        signer.verify(purpose, token)
+
+def test_roundtrip():
+    signer = tokens.TokenSigner('key')
+    token = signer.sign('reset', ['jane', 'x'], 60)
+    assert signer.verify('reset', token) == ['jane', 'x']
+    assert all(c.isalnum() or c in '-_.' for c in token), token
+
+def test_purpose():
+    signer = tokens.TokenSigner('key')
+    assert_invalid(signer, 'register', signer.sign('reset', ['jane'], 60))
+
+def test_expiry():
+    signer = tokens.TokenSigner('key')
+    with assert_raises(tokens.ExpiredTokenException):
+        signer.verify('reset', signer.sign('reset', ['jane'], 0))
+
+def test_key_rotation():
+    old = tokens.TokenSigner(['old'])
+    new = tokens.TokenSigner([b'new', 'old'])
+    assert new.verify('reset', old.sign('reset', ['jane'], 60)) == ['jane']
+    assert_invalid(old, 'reset', new.sign('reset', ['jane'], 60))
+
+def test_random_key():
+    assert_invalid(tokens.TokenSigner(), 'reset',
+                   tokens.TokenSigner().sign('reset', ['jane'], 60))
+
+def test_malformed():
+    signer = tokens.TokenSigner('key')
+    token = signer.sign('reset', ['jane'], 60)
+    for bad in ('', 'a.b', 'a.b.c.d', '2' + token[1:], token + 'A',
+                token.replace('.', '..', 1), u'1.\xe9.\xe9', None, 42):
+        assert_invalid(signer, 'reset', bad)
+
+def test_fingerprint():
+    assert tokens.fingerprint('a', 'b') == tokens.fingerprint('a', 'b')
+    assert tokens.fingerprint('a', 'b') != tokens.fingerprint('ab', '')
+
+def test_sealed():
+    if not tokens.sealing_available():
+        raise SkipTest("cryptography is not installed")
+    signer = tokens.TokenSigner(['new', 'old'])
+    token = signer.seal('register', [{'username': 'jane'}], 60)
+    assert 'jane' not in token
+    assert signer.unseal('register', token) == [{'username': 'jane'}]
+    old = tokens.TokenSigner('old').seal('register', ['jane'], 60)
+    assert signer.unseal('register', old) == ['jane']
+    for bad in (testutils.tamper(token), token.replace('e1.', '1.'), '',
+                'e1.!', old[:10]):
+        with assert_raises(tokens.InvalidTokenException):
+            signer.unseal('register', bad)
+    with assert_raises(tokens.InvalidTokenException):
+        signer.unseal('reset', token)
@@ -16,3 +16,9 @@ def purge_temp_directory(test_dir):
     """Remove the test directory"""
     assert test_dir
     shutil.rmtree(test_dir)
+
+def tamper(token):
+    """Change a character in the middle of a token. Replacing the last
+    characters may only change base64 padding bits."""
+    i = len(token) // 2
+    return token[:i] + ('B' if token[i] == 'A' else 'A') + token[i + 1:]